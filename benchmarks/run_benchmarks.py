@@ -0,0 +1,139 @@
+'''
+Benchmark each pipeline stage on synthetic slides, without tensorflow.
+
+Each stage runs in a fresh spawned process, so its peak RSS is measured on its own.
+Segmentation is replaced by a stub which cuts tiles from the ground truth labels.
+Results are written as JSON, to compare between commits:
+
+    python benchmarks/run_benchmarks.py --sizes 4000x4000 12000x8000 --densities 2000 --output results.json
+'''
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import pathlib
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent))
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+import vectra_deepcell_analyser as vda
+from synthetic import SyntheticSlide, stub_segment
+
+
+FOLDER = 'bench'
+
+
+def _stages(name, labels_file, with_overlay:bool):
+    membrane = 'ECad'
+    markers = list(vda.panel_data.ImmunePanel.channel_map.values())
+    stages = [('split', vda.split_immune_qptiff, (FOLDER, name), {})]
+    stages.append(('tile', _tile_all, (name, markers), {}))
+    stages += [
+        ('mean_marker', vda.generate_mean_immune_marker, (FOLDER, name), {}),
+        ('segment_stub', stub_segment, (FOLDER, name, labels_file), dict(membrane_channel=membrane)),
+        ('stitch', vda.stitch_deepcell_labels, (FOLDER, name), dict(membrane_channel=membrane)),
+        ('centroids', vda.calculate_centroids, (FOLDER, name), dict(membrane_channel=membrane)),
+        ('markers', vda.compute_immune_markers, (FOLDER, name), dict(membrane_channel=membrane)),
+    ]
+    if with_overlay:
+        stages.append(('overlay', vda.make_outline_overlay, (FOLDER, name), dict(membrane_channel=membrane)))
+    return stages
+
+
+def _tile_all(name, markers):
+    for marker in markers:
+        vda.tile_for_deepcell(FOLDER, f'{name}_{marker}')
+
+
+def _run_stage(workdir, config, function, args, kwargs):
+    # runs in a fresh process, so ru_maxrss is the peak of this stage alone
+    os.chdir(workdir)
+    for k, v in config.items():
+        setattr(vda.config.DeepcellConfig, k, v)
+    wall, cpu = time.perf_counter(), time.process_time()
+    function(*args, **kwargs)
+    wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu += children.ru_utime + children.ru_stime
+    return wall, cpu, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=pathlib.Path(__file__).parent,
+            capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(sizes, densities, workdir, with_overlay=True, seed=0):
+    config = {k: v for k, v in vars(vda.config.DeepcellConfig).items() if not k.startswith('_')}
+    # every run recomputes, so stage times are comparable
+    config['use_cache'] = False
+    context = multiprocessing.get_context('spawn')
+    results = []
+    for height, width in sizes:
+        for density in densities:
+            name = f'synthetic_{height}x{width}_{int(density)}'
+            slide = SyntheticSlide(height, width, density, seed)
+            qptiff = pathlib.Path(workdir, 'qptiffs', FOLDER, f'{name}.qptiff')
+            labels_file = pathlib.Path(workdir, 'ground_truth', f'{name}_labels.tif').resolve()
+            tstart = time.perf_counter()
+            slide.write_qptiff(qptiff)
+            slide.write_labels(labels_file)
+            print(f'Generated {name} in {time.perf_counter() - tstart:.1f}s')
+
+            megapixels = height * width / 1e6
+            stages = {}
+            for stage, function, args, kwargs in _stages(name, labels_file, with_overlay):
+                with ProcessPoolExecutor(1, mp_context=context) as executor:
+                    wall, cpu, rss = executor.submit(_run_stage, workdir, config, function, args, kwargs).result()
+                stages[stage] = {
+                    'wall_s': round(wall, 3),
+                    'cpu_s': round(cpu, 3),
+                    'peak_rss_mb': round(rss / 2**20, 1),
+                    'megapixels_per_s': round(megapixels / max(wall, 1e-9), 2),
+                }
+                print(f'{name} {stage}: {wall:.2f}s, {rss / 2**20:.0f} MB')
+            results.append({'name': name, 'height': height, 'width': width, 'density': density, 'stages': stages})
+    return {
+        'commit': _git_commit(),
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'cpu_count': os.cpu_count(),
+        'config': config,
+        'slides': results,
+    }
+
+
+def _size(s):
+    height, width = s.lower().split('x')
+    return int(height), int(width)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=_size, nargs='+', default=[(4000, 4000)], help='slide sizes as HEIGHTxWIDTH')
+    parser.add_argument('--densities', type=float, nargs='+', default=[2000], help='cells per megapixel')
+    parser.add_argument('--tile-size', type=int, default=None, help='overrides DeepcellConfig tile width and height')
+    parser.add_argument('--workdir', default=None, help='where slides and stage outputs are written, defaults to a temporary directory')
+    parser.add_argument('--no-overlay', action='store_true', help='skip the outline overlay stage')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='benchmark_results.json')
+    args = parser.parse_args()
+
+    if args.tile_size is not None:
+        vda.config.DeepcellConfig.tile_width = vda.config.DeepcellConfig.tile_height = args.tile_size
+    with tempfile.TemporaryDirectory() as tmp:
+        workdir = pathlib.Path(args.workdir if args.workdir is not None else tmp).resolve()
+        workdir.mkdir(exist_ok=True, parents=True)
+        results = run_benchmarks(args.sizes, args.densities, workdir, not args.no_overlay, args.seed)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'Wrote {args.output}')
@@ -0,0 +1,119 @@
+'''
+Synthetic Vectra-like slides for benchmarking, and a deterministic stub segmenter standing in for Mesmer.
+
+Cells are discs on a jittered grid, one per grid cell, so they never overlap and every strip of the slide
+can be generated independently. Channel pages carry PerkinElmer ImageDescription XML like real qptiffs,
+and the matching ground truth labels are written alongside.
+'''
+import pathlib
+import numpy as np
+import tifffile
+
+import vectra_deepcell_analyser as vda
+from vectra_deepcell_analyser._helpers._tiff_writer import _iter_tiles, _write_tiled
+
+
+class SyntheticSlide:
+    def __init__(self, height:int, width:int, density:float=2000, seed:int=0, dtype='uint8', strip_height:int=512):
+        '''density is cells per megapixel'''
+        self.height = height
+        self.width = width
+        self.pitch = max(8, int(round(np.sqrt(1e6 / density))))
+        self.dtype = np.dtype(dtype)
+        self.strip_height = strip_height
+        rng = np.random.default_rng(seed)
+        self.grid = (-(-height // self.pitch), -(-width // self.pitch))
+        # radius leaves a one pixel gap to the grid cell edge, jitter keeps the disc inside its grid cell
+        self.radius = rng.uniform(0.25, 0.45, self.grid) * self.pitch
+        slack = np.maximum(self.pitch / 2 - self.radius - 1, 0)
+        self.centre_y = (np.arange(self.grid[0])[:, None] + 0.5) * self.pitch + rng.uniform(-1, 1, self.grid) * slack
+        self.centre_x = (np.arange(self.grid[1])[None, :] + 0.5) * self.pitch + rng.uniform(-1, 1, self.grid) * slack
+        self.expression = rng.uniform(0.1, 1, self.grid + (len(vda.panel_data.ImmunePanel.channel_map),))
+        self.noise_seed = seed
+
+    def _cells(self, y0:int, y1:int):
+        '''Grid cell index and normalised distance to its cell centre for each pixel of rows y0:y1.'''
+        y = np.arange(y0, y1)[:, None]
+        x = np.arange(self.width)[None, :]
+        gy, gx = y // self.pitch, x // self.pitch
+        gy, gx = np.broadcast_to(gy, (y1 - y0, self.width)), np.broadcast_to(gx, (y1 - y0, self.width))
+        dist = np.hypot(y - self.centre_y[gy, gx], x - self.centre_x[gy, gx]) / self.radius[gy, gx]
+        return gy, gx, dist
+
+    def _labels_window(self, y0:int, y1:int):
+        gy, gx, dist = self._cells(y0, y1)
+        labels = (gy * self.grid[1] + gx + 1).astype('uint32')
+        labels[dist >= 1] = 0
+        return labels
+
+    def iter_labels(self):
+        for y0 in range(0, self.height, self.strip_height):
+            yield y0, self._labels_window(y0, min(y0 + self.strip_height, self.height))
+
+    def iter_channel(self, channel:int, marker:str):
+        '''DAPI fills the nucleus, ECad rings the membrane, other markers fill the cell scaled by per cell expression.'''
+        peak = np.iinfo(self.dtype).max if np.issubdtype(self.dtype, np.integer) else 1
+        for y0 in range(0, self.height, self.strip_height):
+            y1 = min(y0 + self.strip_height, self.height)
+            gy, gx, dist = self._cells(y0, y1)
+            if marker == 'DAPI':
+                signal = (dist < 0.6).astype('float32')
+            elif marker == 'ECad':
+                signal = ((dist > 0.75) & (dist < 1)).astype('float32')
+            else:
+                signal = (dist < 1) * self.expression[gy, gx, channel]
+            noise = np.random.default_rng((self.noise_seed, channel, y0)).uniform(0, 0.1, signal.shape)
+            yield y0, (np.clip(signal * 0.85 + noise, 0, 1) * peak).astype(self.dtype)
+
+    def write_qptiff(self, path):
+        '''Write one tiled page per panel channel, each with a PerkinElmer ImageDescription naming its fluorophore.'''
+        path = pathlib.Path(path)
+        path.parent.mkdir(exist_ok=True, parents=True)
+        tile = vda.config.DeepcellConfig.tiff_tile_size
+        shape = (self.height, self.width)
+        with tifffile.TiffWriter(path, bigtiff=True) as tw:
+            for channel, (fluor, marker) in enumerate(vda.panel_data.ImmunePanel.channel_map.items()):
+                description = (f'<?xml version="1.0" encoding="utf-16"?><PerkinElmer-QPI-ImageDescription>'
+                    f'<DescriptionVersion>2</DescriptionVersion><ImageType>FullResolution</ImageType>'
+                    f'<Name>{fluor}</Name></PerkinElmer-QPI-ImageDescription>')
+                tw.write(_iter_tiles(self.iter_channel(channel, marker), shape, tile),
+                    shape=shape, dtype=self.dtype, tile=(tile, tile), compression='zlib',
+                    description=description, metadata=None)
+
+    def write_labels(self, path):
+        path = pathlib.Path(path)
+        path.parent.mkdir(exist_ok=True, parents=True)
+        _write_tiled(path, self.iter_labels(), (self.height, self.width), 'uint32')
+
+
+def stub_segment(folder, name, labels_file,
+        compartment='whole-cell',
+        nucleus_channel:str='DAPI',
+        membrane_channel:str='ECad',
+        interior_threshold:float=None,
+        maxima_threshold:float=None):
+    '''
+    Write deepcell_labelled_tiles for a sample by cutting padded tiles out of the ground truth labels,
+    relabelled 1..n within each tile like Mesmer output. Deterministic, and needs no tensorflow.
+    '''
+    from vectra_deepcell_analyser.config import DeepcellConfig
+    from vectra_deepcell_analyser._helpers._tiff_window import _TiffWindowReader
+    it = interior_threshold if interior_threshold is not None else DeepcellConfig.interior_threshold
+    mt = maxima_threshold if maxima_threshold is not None else DeepcellConfig.maxima_threshold
+    basename = f'{name}_{compartment}_{nucleus_channel}_{membrane_channel}_{str(int(it*1000))}_{str(int(mt*1000))}'
+    outfolder = pathlib.Path('deepcell_labelled_tiles', folder, name, basename)
+    outfolder.mkdir(exist_ok=True, parents=True)
+    with _TiffWindowReader(labels_file) as labels:
+        height, width = labels.shape
+        for x in range(0, width, DeepcellConfig.tile_width):
+            for y in range(0, height, DeepcellConfig.tile_height):
+                x0 = max(0, x - DeepcellConfig.tile_padding_x)
+                y0 = max(0, y - DeepcellConfig.tile_padding_y)
+                x1 = min(x + DeepcellConfig.tile_width + DeepcellConfig.tile_padding_x, width)
+                y1 = min(y + DeepcellConfig.tile_height + DeepcellConfig.tile_padding_y, height)
+                tile = labels.window(y0, y1, x0, x1)
+                ids, inverse = np.unique(tile, return_inverse=True)
+                if ids[0] != 0:
+                    inverse = inverse + 1
+                tifffile.imwrite(pathlib.Path(outfolder, f'{basename}_{x0}_{y0}.tif'),
+                    inverse.reshape(tile.shape).astype('int32'))
@@ -1,120 +1,206 @@
+import logging
 import vectra_deepcell_analyser as vda
-# timer for logging
+# timer for logging, records a stage metric (see vda.metrics)
 from vectra_deepcell_analyser._helpers._timer import _Timer
 
+# stage metrics are logged at INFO, per tile metrics at DEBUG
+logging.basicConfig(level=logging.INFO)
+# to also keep every stage and tile record as JSON lines:
+# vda.metrics.add_sink(vda.metrics.JsonLinesSink('metrics.jsonl'))
+
 
 # Configure
 vda.config.DeepcellConfig.tile_height = 4000
 vda.config.DeepcellConfig.tile_width = 4000
 vda.config.DeepcellConfig.tile_padding_x = 100
 vda.config.DeepcellConfig.tile_padding_y = 100
+# or plan tile size, padding and batch size for the slide from the memory available to the segmentation workers:
+# vda.plan_tiles((height, width), memory_budget=64 * 1024**3, n_workers=4).apply()
 
 folder = 'test'
 # If file is None, will run on all files in folder
 file = 'TEST_SAMPLE'
 
-
-# Run
-'''
-Split the original qptiff into multiple .tif images, one for each channel.
-Files are named based on the Panel class given.
-This step expects qptiffs from vectra and so expects a piece of metadata describing the wavelength in the qptiff stack
-Currently specific ImmunePanel is hard coded in, TODO: create more general method
-
-Input: 'qptiffs/<folder>/<file>.qptiff'
-Outputs: 'unstacked/<folder>/<file>_<marker>.tif'
-'''
-with _Timer('Split'):
-    vda.split_immune_qptiff(folder, file)
-
-'''
-Tiles the split images based on configured DeepcellConfig static variables
-
-Input: 'unstacked/<folder>/<file>_*.tif
-Output: 'tiled_for_deepcell/<folder>/<file>_<marker>/<file>_<marker>_<x>_<y>.png'
-'''
-with _Timer('Tile'):
-    vda.tile_for_deepcell(folder, file)
-
-'''
-Averages all markers which are not DAPI
-This can be useful in case there is no specific membrane marker.
-In this case, the average of all other markers is used to approximate a membrane marker. 
-This works on the tiled images to avoid memory issues
-
-Input: 'tiled_for_deepcell/<folder>/<file>_<marker>/<file>_<marker>_<x>_<y>.png'
-Output: 'tiled_for_deepcell/<folder>/<file>_AVGMARKER/<file>_AVGMARKER_<x>_<y>.png'
-'''
-with _Timer('Mean Membrane Marker'):
-    vda.generate_mean_immune_marker(folder, file)
-
-'''
-Segment each tile using deepcell.
-Specify Deepcell compartment here, defaults to 'whole-cell'
-Deepcell parameters can be passed in as arguments here, otherwise parameters set in DeepcellConfig will be used.
-Also specify which channels to use as nuclear and membrane markers. Defaults to find channels called DAPI and ECad.
-
-Input: 'tiled_for_deepcell/<folder>/<file>_<membrane marker>/<file>_<membrane marker>_<x>_<y>.png'
-       'tiled_for_deepcell/<folder>/<file>_<nuclear marker>/<file>_<nuclear marker>_<x>_<y>.png'
-Output: 'deepcell_labelled_tiles/<folder>/<file>/<file>_<deepcell config>/<file>_<deepcell config>_<x>_<y>.tif'
-'''
-with _Timer('Segment'):
-    vda.segment_with_deepcell(folder, file)
-
-'''
-These tiles are then stitched back together.
-Note currently this is very slow as stitch goes through many steps.
-Tiles are first stitched along x-direction and written to file.
-Once everyting is stitched along x-axis, stitch together along y.
-
-Input: 'deepcell_labelled_tiles/<folder>/<file>/<file>_<deepcell config>/<file>_<deepcell config>_<x>_<y>.tif'
-Intermediate: 'deepcell_labelled_tiles_x_stitched/<folder>/<file>/<file>_<deepcell config>/<file>_<deepcell config>_<y>.tif'
-Output: 'deepcell_labelled/<folder>/<file>/<file>_<deepcell config>.tif'
-'''
-with _Timer('Stitch'):
-    vda.stitch_deepcell_labels(folder, file)
-
-
-# Postprocessing
 '''
-Once segmented may want to convert segmentation to cell outlines
-Currently this is quite clunky, since can't add as overlay to original image.
-Instead create new image from nuclear and membrane markers, then draw on segmented cell outlines.
-Therefore have to provide nuclear and membrane channels, as well as used deepcell config to this method
-
-Input: 'deepcell_labelled/<folder>/<file>/<file>_<deepcell config>.tif'
-       'unstacked/<folder>/<file>/<file>_<membrane marker>.tif'
-       'unstacked/<folder>/<file>/<file>_<nuclear marker>.tif'
-Output: 'outlined/<folder>/<file>_<outlined>.tif'
+To run every sample in the folder concurrently under a memory budget instead of the stages in main below:
+    vda.run_cohort(folder, memory_budget=64 * 1024**3)
+auto_tile=True plans the tiles of each sample for the budget, see vda.plan_tiles
 '''
-# Can easily create memory issues since loading huge images to RAM
-#with _Timer('Make Outline Overlay'):
-#    vda.make_outline_overlay(folder, file)
 
-'''
-Useful to get centroids from segmentation
-Note currently very memory inefficient, but not had problems running on clusters (probably won't run on laptop)
-Creates csv with cell centroids
-Also creates geojson which can be loaded into visualisation software. Tested with QuPath, to overlay centroids onto original image
-
-Input: 'deepcell_labelled/<folder>/<file>/<file>_<deepcell config>.tif'
-Output: 'centroids/<folder>/<file>/<file>_<deepcell config>.csv'
-        'centroids/<folder>/<file>/<file>_<deepcell config>.geojson'
-'''
-with _Timer('Calculate Centroids'):
-    vda.calculate_centroids(folder, file)
 
-'''
-Can also use segmentation and calculate average marker intensity across each cell.
-Requires Panel to be specified (so it knows what channels to look for)
-Currently only for specific ImmunePanel, TODO: create general version of method for new panels
-Creates csv with cell id, centroid and average marker intensities
-
-Input: 'deepcell_labelled/<folder>/<file>/<file>_<deepcell config>.tif'
-       'unstacked/<folder>/<file>/<file>_<markers>.tif'
-Output: 'output/<folder>/<file>/<file>_<deepcell config>.csv'
-'''
-with _Timer('Calculate Avg Marker Intenstity For Each Cell'):
-    vda.compute_immune_markers(folder, file)
-
-    
\ No newline at end of file
+# Run
+# stages with n_workers > 1 spawn worker processes, which import this script again, so the stages only run as __main__
+def main():
+    '''
+    Split the original qptiff into multiple .tif images, one for each channel.
+    Files are named based on the Panel class given.
+    This step expects qptiffs from vectra and so expects a piece of metadata describing the wavelength in the qptiff stack
+    Currently specific ImmunePanel is hard coded in, TODO: create more general method
+    Channels are decoded and written concurrently on a thread pool, streamed in bands of tiles, into tiled compressed BigTIFFs
+    (split_immune_qptiff(folder, file, contiguous=True) writes uncompressed files which can be memory mapped instead)
+
+    Input: 'qptiffs/<folder>/<file>.qptiff'
+    Outputs: 'unstacked/<folder>/<file>_<marker>.tif'
+    '''
+    '''
+    Alternatively the stages can read channels straight from the qptiff, without the unstacked copies:
+        vda.config.DeepcellConfig.channels_from_qptiff = True
+    vda.open_slide(folder, file) gives the same lazy, windowed access for analysis, e.g. vda.open_slide(folder, file)['CD8'][y0:y1, x0:x1]
+    '''
+    with _Timer('Split'):
+        vda.split_immune_qptiff(folder, file)
+
+    '''
+    Tiles the split images based on configured DeepcellConfig static variables
+    With DeepcellConfig.skip_background_tiles = True, only tiles holding tissue are written, segmented and stitched.
+    The tissue mask is found from a downsampled DeepcellConfig.tissue_channel image by vda.detect_tissue(folder, file),
+    which is run automatically when needed: 'tissue/<folder>/<file>_tissue.npz'
+
+    Input: 'unstacked/<folder>/<file>_*.tif
+    Output: 'tiled_for_deepcell/<folder>/<file>_<marker>/<file>_<marker>_<x>_<y>.png'
+    '''
+    '''
+    Alternatively tiling, segmentation and stitching (and the centroid/marker tables) can run in memory,
+    skipping the tiled_for_deepcell and deepcell_labelled_tiles files:
+        vda.run_pipeline_in_memory(folder, file)
+    '''
+    with _Timer('Tile'):
+        vda.tile_for_deepcell(folder, file)
+
+    '''
+    Averages all markers which are not DAPI
+    This can be useful in case there is no specific membrane marker.
+    In this case, the average of all other markers is used to approximate a membrane marker. 
+    This works on the tiled images to avoid memory issues, tiles are processed in parallel and keep the input dtype
+    Alternatively generate_mean_immune_marker(folder, file, from_unstacked=True) writes 'unstacked/<folder>/<file>_AVGMARKER.tif'
+    once for the whole slide, which can then be tiled like any other channel
+
+    Input: 'tiled_for_deepcell/<folder>/<file>_<marker>/<file>_<marker>_<x>_<y>.png'
+    Output: 'tiled_for_deepcell/<folder>/<file>_AVGMARKER/<file>_AVGMARKER_<x>_<y>.png'
+    '''
+    with _Timer('Mean Membrane Marker'):
+        vda.generate_mean_immune_marker(folder, file)
+
+    '''
+    Segment each tile using deepcell.
+    Specify Deepcell compartment here, defaults to 'whole-cell'
+    Deepcell parameters can be passed in as arguments here, otherwise parameters set in DeepcellConfig will be used.
+    Also specify which channels to use as nuclear and membrane markers. Defaults to find channels called DAPI and ECad.
+    Mesmer is loaded once per process and tiles of the same shape are predicted in batches of DeepcellConfig.batch_size.
+    Set n_workers (or DeepcellConfig.n_workers) to segment with a pool of processes, each using threads_per_worker threads.
+    Worker processes are spawned, so scripts using n_workers > 1 need an `if __name__ == '__main__':` guard.
+    backend='watershed' segments with a classical threshold, distance transform and watershed on the CPU instead of Mesmer,
+    for quick previews and parameter exploration. Output files are named the same, so the later stages are unchanged.
+    To sweep interior/maxima thresholds, set DeepcellConfig.cache_model_outputs = True: Mesmer's network outputs are stored once
+    as float16 tiles ('deepcell_raw_tiles/<folder>/<file>/<file>_<nuclear marker>_<membrane marker>/'), and each further
+    threshold or compartment only reruns post-processing, in parallel over tiles:
+        for interior_threshold in (0.1, 0.2, 0.3):
+            vda.segment_with_deepcell(folder, file, interior_threshold=interior_threshold)
+
+    Input: 'tiled_for_deepcell/<folder>/<file>_<membrane marker>/<file>_<membrane marker>_<x>_<y>.png'
+           'tiled_for_deepcell/<folder>/<file>_<nuclear marker>/<file>_<nuclear marker>_<x>_<y>.png'
+    Output: 'deepcell_labelled_tiles/<folder>/<file>/<file>_<deepcell config>/<file>_<deepcell config>_<x>_<y>.tif'
+    '''
+    with _Timer('Segment'):
+        vda.segment_with_deepcell(folder, file)
+
+    '''
+    These tiles are then stitched back together.
+    All tiles are stitched in a single pass. Each tile keeps its unpadded core, labels of the same cell
+    on either side of a seam are joined with a union-find, and the slide is relabelled once with sequential ids.
+    Tile rows are streamed into a tiled, compressed BigTIFF, so only a few tile rows are held in memory.
+    The older two step stitch (stitch_deepcell_labels_x then stitch_deepcell_labels_y) is still available.
+
+    Input: 'deepcell_labelled_tiles/<folder>/<file>/<file>_<deepcell config>/<file>_<deepcell config>_<x>_<y>.tif'
+    Output: 'deepcell_labelled/<folder>/<file>/<file>_<deepcell config>.tif'
+    '''
+    with _Timer('Stitch'):
+        vda.stitch_deepcell_labels(folder, file)
+
+
+    # Postprocessing
+    '''
+    Once segmented may want to convert segmentation to cell outlines
+    Currently this is quite clunky, since can't add as overlay to original image.
+    Instead create new image from nuclear and membrane markers, then draw on segmented cell outlines.
+    Therefore have to provide nuclear and membrane channels, as well as used deepcell config to this method
+    Tiles are rendered in parallel as uint8 RGB into a tiled pyramidal OME-TIFF, which QuPath can open directly
+
+    Input: 'deepcell_labelled/<folder>/<file>/<file>_<deepcell config>.tif'
+           'unstacked/<folder>/<file>/<file>_<membrane marker>.tif'
+           'unstacked/<folder>/<file>/<file>_<nuclear marker>.tif'
+    Output: 'outlined/<folder>/<file>_<deepcell config>_outlined.ome.tif'
+            'outlined/<folder>/<file>_<deepcell config>_outline_mask.tif'
+    '''
+    with _Timer('Make Outline Overlay'):
+        vda.make_outline_overlay(folder, file)
+
+    '''
+    Useful to get centroids from segmentation
+    Label image is read in row strips of DeepcellConfig.strip_height, so memory scales with the number of cells, not the slide size
+    Creates csv with cell centroids
+    Also creates geojson which can be loaded into visualisation software. Tested with QuPath, to overlay centroids onto original image
+
+    Input: 'deepcell_labelled/<folder>/<file>/<file>_<deepcell config>.tif'
+    Output: 'centroids/<folder>/<file>/<file>_<deepcell config>_centroids.csv' (.parquet if DeepcellConfig.table_format = 'parquet')
+            'centroids/<folder>/<file>/<file>_<deepcell config>_centroids.geojson'
+    '''
+    with _Timer('Calculate Centroids'):
+        vda.calculate_centroids(folder, file)
+
+    '''
+    GeoJSON for QuPath, streamed to file. Centroids as one MultiPoint, or with polygons=True each cell's outline,
+    traced from the label image on tiles in a process pool and simplified by DeepcellConfig.geojson_simplify_tolerance.
+    ndjson=True writes one feature per line instead.
+
+    Output: 'centroids/<folder>/<file>/<file>_<deepcell config>_centroids.geojson'
+            'centroids/<folder>/<file>/<file>_<deepcell config>_outlines.geojson' with polygons=True
+    '''
+    with _Timer('Cell Outline GeoJSON'):
+        vda.centroid_geojson(folder, file, polygons=True, n_workers=4)
+
+    '''
+    Spatial index over the centroids, for radius, k nearest neighbour, window/polygon and neighbour count queries.
+    Distances are in um (DeepcellConfig.image_mpp), points and windows in pixels like the centroid table.
+    e.g. number of ECad positive cells within 30um of each cell:
+        index = vda.spatial.load_spatial_index(folder, file)
+        index.neighbour_counts(30, among=markers['ECad'] > threshold)
+
+    Input: 'centroids/<folder>/<file>/<file>_<deepcell config>_centroids.csv' (or .parquet)
+    Output: 'centroids/<folder>/<file>/<file>_<deepcell config>_spatial_index.npz'
+    '''
+    with _Timer('Build Spatial Index'):
+        vda.build_spatial_index(folder, file)
+
+    '''
+    Cell contact graph, which cells touch and the length of their shared boundary in pixels.
+    e.g. Object Ids of the cells touching cell 10:
+        contacts = vda.load_cell_adjacency(folder, file)
+        contacts[10].indices
+
+    Input: 'deepcell_labelled/<folder>/<file>/<file>_<deepcell config>.tif'
+    Output: 'centroids/<folder>/<file>/<file>_<deepcell config>_adjacency.npz'
+    '''
+    with _Timer('Cell Adjacency'):
+        vda.calculate_cell_adjacency(folder, file)
+
+    '''
+    Can also use segmentation and calculate average marker intensity across each cell.
+    Requires Panel to be specified (so it knows what channels to look for)
+    Currently only for specific ImmunePanel, TODO: create general version of method for new panels
+    Creates csv with cell id and mean, std, min and max marker intensities (percentiles=(50, 90) adds approximate percentiles)
+    Label and channel images are streamed in row strips, so memory does not grow with slide size
+
+    Input: 'deepcell_labelled/<folder>/<file>/<file>_<deepcell config>.tif'
+           'unstacked/<folder>/<file>/<file>_<markers>.tif'
+    Output: 'output/<folder>/<file>/<file>_<deepcell config>.csv' (.parquet if DeepcellConfig.table_format = 'parquet')
+
+    Tables can be read lazily by column and Object Id, e.g.
+        vda.tables.read_cells(folder, file, ['centroid_x_pixels', 'centroid_y_pixels', 'CD8'])
+    '''
+    with _Timer('Calculate Avg Marker Intenstity For Each Cell'):
+        vda.compute_immune_markers(folder, file)
+
+
+if __name__ == '__main__':
+    main()
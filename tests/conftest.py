@@ -0,0 +1,61 @@
+import pathlib
+import sys
+
+import pytest
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(ROOT / 'benchmarks'))
+
+import vectra_deepcell_analyser as vda
+from vectra_deepcell_analyser.config import DeepcellConfig
+
+
+FOLDER = 'test'
+
+
+@pytest.fixture(autouse=True)
+def restore_config():
+    '''Stages read DeepcellConfig globals, so each test's changes are undone afterwards.'''
+    saved = {k: v for k, v in vars(DeepcellConfig).items() if not k.startswith('_')}
+    yield
+    for k in [k for k in vars(DeepcellConfig) if not k.startswith('_')]:
+        if k not in saved:
+            delattr(DeepcellConfig, k)
+    for k, v in saved.items():
+        setattr(DeepcellConfig, k, v)
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    '''Stages read and write relative to the working directory.'''
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+@pytest.fixture
+def synthetic_sample(workdir):
+    '''
+    A 900x1100 synthetic qptiff, split into channels, on a grid of 400 pixel tiles.
+    Returns the sample name and the ground truth labels file.
+    '''
+    from synthetic import SyntheticSlide
+    return write_sample(SyntheticSlide(900, 1100, density=4000, seed=1))
+
+
+def write_sample(slide, name='sample'):
+    '''Write a synthetic slide as a split qptiff with its ground truth labels, on a grid of 400 pixel tiles.'''
+    DeepcellConfig.tile_width = DeepcellConfig.tile_height = 400
+    DeepcellConfig.tile_padding_x = DeepcellConfig.tile_padding_y = 50
+    DeepcellConfig.tiff_tile_size = 128
+    DeepcellConfig.strip_height = 256
+    slide.write_qptiff(pathlib.Path('qptiffs', FOLDER, f'{name}.qptiff'))
+    labels_file = pathlib.Path('truth', f'{name}_labels.tif')
+    slide.write_labels(labels_file)
+    vda.split_immune_qptiff(FOLDER, name)
+    return name, labels_file
+
+
+def tile_sample(name, markers=('DAPI', 'ECad')):
+    for marker in markers:
+        vda.tile_for_deepcell(FOLDER, f'{name}_{marker}')
@@ -0,0 +1,74 @@
+import json
+import shutil
+
+import numpy as np
+import pytest
+import tifffile
+
+import vectra_deepcell_analyser as vda
+from vectra_deepcell_analyser.config import DeepcellConfig
+from vectra_deepcell_analyser._helpers._zarr_store import _labels_path
+
+from conftest import FOLDER
+
+
+BASENAME = 'sample_whole-cell_DAPI_ECad_200_75'
+
+
+@pytest.fixture
+def labelled_sample(synthetic_sample):
+    '''The synthetic sample with its ground truth as the stitched labels.'''
+    name, labels_file = synthetic_sample
+    path = _labels_path(FOLDER, name, BASENAME)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    shutil.copy(labels_file, path)
+    truth = tifffile.imread(labels_file)
+    return name, truth
+
+
+def _outfile(name, kind, extension):
+    return f'centroids/{FOLDER}/{name}/{BASENAME}_{kind}.{extension}'
+
+
+def test_centroids_as_one_multipoint(labelled_sample):
+    name, truth = labelled_sample
+    vda.centroid_geojson(FOLDER, name)
+    with open(_outfile(name, 'centroids', 'geojson')) as f:
+        detection, = json.load(f)
+    points = np.array(detection['coordinates'])
+    ids = np.unique(truth[truth > 0])
+    assert detection['type'] == 'MultiPoint' and points.shape == (ids.size, 2)
+    # (x, y) of the first cell's centroid
+    y, x = np.nonzero(truth == ids[0])
+    np.testing.assert_allclose(points[0], (x.mean(), y.mean()))
+
+
+def test_centroids_as_ndjson_points(labelled_sample):
+    name, truth = labelled_sample
+    vda.centroid_geojson(FOLDER, name, ndjson=True)
+    with open(_outfile(name, 'centroids', 'ndjson')) as f:
+        features = [json.loads(line) for line in f]
+    assert [f['id'] for f in features] == np.unique(truth[truth > 0]).tolist()
+    assert all(f['geometry']['type'] == 'Point' for f in features)
+
+
+def test_outline_polygons_hold_each_cell(labelled_sample):
+    name, truth = labelled_sample
+    DeepcellConfig.geojson_simplify_tolerance = 0
+    vda.centroid_geojson(FOLDER, name, polygons=True, n_workers=1)
+    with open(_outfile(name, 'outlines', 'geojson')) as f:
+        serial = json.load(f)['features']
+
+    ids = np.unique(truth[truth > 0])
+    assert sorted(f['id'] for f in serial) == ids.tolist()
+    for feature in serial[::25]:
+        ring = np.array(feature['geometry']['coordinates'][0])
+        y, x = np.nonzero(truth == feature['id'])
+        # outlines run along pixel corners, half a pixel outside the cell's pixel centres
+        np.testing.assert_allclose(ring.min(axis=0), (x.min() - 0.5, y.min() - 0.5), atol=0.5)
+        np.testing.assert_allclose(ring.max(axis=0), (x.max() + 0.5, y.max() + 0.5), atol=0.5)
+
+    vda.centroid_geojson(FOLDER, name, polygons=True, n_workers=2)
+    with open(_outfile(name, 'outlines', 'geojson')) as f:
+        pooled = json.load(f)['features']
+    assert pooled == serial
@@ -0,0 +1,58 @@
+import numpy as np
+import tifffile
+
+import vectra_deepcell_analyser as vda
+from vectra_deepcell_analyser.config import DeepcellConfig
+from vectra_deepcell_analyser.cell_adjacency import _ContactAccumulator
+from vectra_deepcell_analyser._helpers._zarr_store import _labels_path
+
+from conftest import FOLDER
+
+
+BASENAME = 'sample_whole-cell_DAPI_ECad_200_75'
+
+
+def _touching_labels(height, width, n_cells, seed=0):
+    '''Voronoi cells, so most cells touch, with scattered background pixels.'''
+    rng = np.random.default_rng(seed)
+    seeds = rng.uniform((0, 0), (height, width), (n_cells, 2))
+    y, x = np.mgrid[:height, :width]
+    distance = (y[..., None] - seeds[:, 0])**2 + (x[..., None] - seeds[:, 1])**2
+    labels = (np.argmin(distance, axis=-1) + 1).astype('uint32')
+    labels[rng.uniform(size=labels.shape) < 0.05] = 0
+    return labels
+
+
+def _brute_force_contacts(labels):
+    n = int(labels.max()) + 1
+    contacts = np.zeros((n, n), dtype='int64')
+    for a, b in ((labels[:, :-1], labels[:, 1:]), (labels[:-1], labels[1:])):
+        for p, q in zip(a.reshape(-1).tolist(), b.reshape(-1).tolist()):
+            if p != q and p > 0 and q > 0:
+                contacts[p, q] += 1
+                contacts[q, p] += 1
+    return contacts
+
+
+def test_strips_with_halo_match_brute_force():
+    labels = _touching_labels(300, 250, 80)
+    accumulator = _ContactAccumulator()
+    # merge on almost every strip
+    accumulator.merge_size = 16
+    strip_height = 97
+    for y0 in range(0, labels.shape[0], strip_height):
+        accumulator.add_strip(labels[y0:y0+strip_height+1], halo=y0 + strip_height < labels.shape[0])
+    np.testing.assert_array_equal(accumulator.to_sparse().toarray(), _brute_force_contacts(labels))
+
+
+def test_calculate_cell_adjacency_matches_brute_force(workdir):
+    DeepcellConfig.strip_height = 97
+    labels = _touching_labels(300, 250, 80, seed=1)
+    path = _labels_path(FOLDER, 'sample', BASENAME)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tifffile.imwrite(path, labels)
+
+    vda.calculate_cell_adjacency(FOLDER, 'sample')
+    contacts = vda.load_cell_adjacency(FOLDER, 'sample')
+    np.testing.assert_array_equal(contacts.toarray(), _brute_force_contacts(labels))
+    assert contacts.nnz > 300
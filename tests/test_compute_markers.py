@@ -0,0 +1,47 @@
+import numpy as np
+import pandas as pd
+
+import vectra_deepcell_analyser as vda
+from vectra_deepcell_analyser.compute_markers import _MarkerStatsAccumulator, _CalculateMarkers, _DEFAULT_STATISTICS
+
+from conftest import FOLDER
+
+
+def _labels(height, width, pitch, seed=0):
+    '''Connected square cells on a grid with one pixel gaps, and random channel values.'''
+    y, x = np.mgrid[:height, :width]
+    labels = (y // pitch) * (-(-width // pitch)) + x // pitch + 1
+    labels[(y % pitch == 0) | (x % pitch == 0)] = 0
+    rng = np.random.default_rng(seed)
+    return labels, [rng.integers(0, 256, labels.shape).astype('uint8') for _ in range(2)]
+
+
+def test_percentiles_match_cells_and_histograms_stay_bounded():
+    labels, channels = _labels(300, 400, 20)
+    accumulator = _MarkerStatsAccumulator(2, [(0, 256), (0, 256)], 256, (10, 50, 90))
+    most_open = 0
+    for y in range(0, labels.shape[0], 32):
+        accumulator.add_strip(labels[y:y+32], (c[y:y+32] for c in channels))
+        most_open = max(most_open, accumulator.open_labels.size)
+    table = accumulator.to_dataframe(['a', 'b'])
+
+    # only the cell rows a 32 row strip can touch, not all 300 cells
+    assert most_open <= 3 * (-(-labels.shape[1] // 20))
+    for cell in (1, 57, table.index[-1]):
+        for marker, channel in zip('ab', channels):
+            values = channel[labels == cell]
+            for q in (10, 50, 90):
+                # one bin per value, so the interpolated estimate is within one of the true percentile
+                assert abs(table.loc[cell, f'{marker}_p{q}'] - np.percentile(values, q)) <= 1
+
+
+def test_entry_points_share_default_statistics(synthetic_sample):
+    name, labels_file = synthetic_sample
+    from synthetic import stub_segment
+    stub_segment(FOLDER, name, labels_file)
+    vda.stitch_deepcell_labels(FOLDER, name)
+    vda.compute_immune_markers(FOLDER, name)
+    table = pd.read_csv(f'output/{FOLDER}/{name}/{name}_whole-cell_DAPI_ECad_200_75.csv', index_col='Object Id')
+
+    assert _CalculateMarkers.__init__.__defaults__[0] == _DEFAULT_STATISTICS
+    assert {'DAPI', 'DAPI_std', 'DAPI_min', 'DAPI_max'} <= set(table.columns)
@@ -0,0 +1,34 @@
+import pathlib
+
+import vectra_deepcell_analyser as vda
+from vectra_deepcell_analyser.panel_data import ImmunePanel
+
+from conftest import FOLDER, tile_sample
+
+
+def _mtimes(folder):
+    return {f.name: f.stat().st_mtime_ns for f in pathlib.Path(folder).rglob('*') if f.is_file() and not f.name.startswith('.')}
+
+
+def test_rerun_keeps_avgmarker_segmentation_cached(synthetic_sample):
+    name, _ = synthetic_sample
+    tile_sample(name, list(ImmunePanel.channel_map.values()))
+    vda.generate_mean_immune_marker(FOLDER, name)
+    vda.segment_with_deepcell(FOLDER, name, membrane_channel='AVGMARKER', backend='watershed')
+    avgmarker = _mtimes(pathlib.Path('tiled_for_deepcell', FOLDER, f'{name}_AVGMARKER'))
+    labels = _mtimes(pathlib.Path('deepcell_labelled_tiles', FOLDER, name))
+
+    vda.generate_mean_immune_marker(FOLDER, name)
+    vda.segment_with_deepcell(FOLDER, name, membrane_channel='AVGMARKER', backend='watershed')
+    assert len(avgmarker) == 9
+    assert _mtimes(pathlib.Path('tiled_for_deepcell', FOLDER, f'{name}_AVGMARKER')) == avgmarker
+    assert _mtimes(pathlib.Path('deepcell_labelled_tiles', FOLDER, name)) == labels
+
+
+def test_unstacked_rerun_is_skipped(synthetic_sample):
+    name, _ = synthetic_sample
+    vda.generate_mean_immune_marker(FOLDER, name, from_unstacked=True)
+    outfile = pathlib.Path('unstacked', FOLDER, f'{name}_AVGMARKER.tif')
+    mtime = outfile.stat().st_mtime_ns
+    vda.generate_mean_immune_marker(FOLDER, name, from_unstacked=True)
+    assert outfile.stat().st_mtime_ns == mtime
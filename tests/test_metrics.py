@@ -0,0 +1,33 @@
+import pytest
+
+import vectra_deepcell_analyser as vda
+from vectra_deepcell_analyser.metrics import Collector, _measure
+
+from conftest import FOLDER, tile_sample
+
+
+@pytest.fixture
+def collector():
+    sink = vda.metrics.add_sink(Collector())
+    yield sink
+    vda.metrics.remove_sink(sink)
+
+
+def test_failed_stage_is_recorded(collector):
+    with pytest.raises(RuntimeError):
+        with _measure('stitch', sample='s') as m:
+            m.count('seams', 2)
+            raise RuntimeError('tile missing')
+    record, = collector.drain()
+    assert record['error'] == 'RuntimeError: tile missing'
+    assert record['counts'] == {'seams': 2} and record['wall_s'] >= 0
+
+
+def test_segment_record_reports_tiles_per_second(synthetic_sample, collector):
+    name, _ = synthetic_sample
+    tile_sample(name)
+    vda.segment_with_deepcell(FOLDER, name, backend='watershed', n_workers=1)
+    record, = [r for r in collector.drain() if r['stage'] == 'segment' and r['level'] == 'stage']
+    assert record['counts']['tiles'] == 9
+    assert record['tiles_per_s'] == pytest.approx(9 / record['wall_s'], rel=1e-2)
+    assert 'error' not in record
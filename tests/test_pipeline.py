@@ -0,0 +1,82 @@
+import numpy as np
+import pytest
+
+import vectra_deepcell_analyser as vda
+from vectra_deepcell_analyser.config import DeepcellConfig
+from vectra_deepcell_analyser._helpers._zarr_store import _labels_reader
+from vectra_deepcell_analyser.pipeline import _InMemoryDeepcellWorker
+
+from conftest import FOLDER, tile_sample
+
+
+BASENAME = 'sample_whole-cell_DAPI_ECad_200_75'
+
+
+def _stitched_labels(name):
+    with _labels_reader(FOLDER, name, BASENAME) as reader:
+        return reader.window(0, reader.shape[0])
+
+
+def test_zarr_storage_matches_tiff(synthetic_sample):
+    name, _ = synthetic_sample
+    tile_sample(name)
+    vda.segment_with_deepcell(FOLDER, name, backend='watershed', n_workers=2, threads_per_worker=1)
+    vda.stitch_deepcell_labels(FOLDER, name)
+    tiff = _stitched_labels(name)
+
+    DeepcellConfig.storage = 'zarr'
+    vda.split_immune_qptiff(FOLDER, name)
+    vda.segment_with_deepcell(FOLDER, name, backend='watershed', n_workers=2, threads_per_worker=1)
+    vda.stitch_deepcell_labels(FOLDER, name)
+    zarr = _stitched_labels(name)
+
+    assert tiff.max() > 100
+    np.testing.assert_array_equal(tiff, zarr)
+
+
+def test_in_memory_pipeline_matches_tiff_and_holds_one_tile_row(synthetic_sample, monkeypatch):
+    name, _ = synthetic_sample
+    tile_sample(name)
+    vda.segment_with_deepcell(FOLDER, name, backend='watershed', n_workers=1)
+    vda.stitch_deepcell_labels(FOLDER, name)
+    tiff = _stitched_labels(name)
+
+    held = []
+    write_tile = _InMemoryDeepcellWorker._write_tile
+    def _write_tile(self, x0, y0, labels):
+        write_tile(self, x0, y0, labels)
+        held.append({y for _, y in self.labels})
+    monkeypatch.setattr(_InMemoryDeepcellWorker, '_write_tile', _write_tile)
+    vda.run_pipeline_in_memory(FOLDER, name, backend='watershed', centroids=False, markers=False)
+
+    assert held and max(len(rows) for rows in held) == 1
+    np.testing.assert_array_equal(tiff, _stitched_labels(name))
+
+
+def test_pooled_in_memory_pipeline_matches_serial(synthetic_sample, monkeypatch):
+    name, _ = synthetic_sample
+    vda.run_pipeline_in_memory(FOLDER, name, backend='watershed', centroids=False, markers=False, n_workers=1)
+    serial = _stitched_labels(name)
+
+    # pool workers send their label tiles back, which the parent holds one tile row of
+    held = []
+    receive_batch = _InMemoryDeepcellWorker._receive_batch
+    def _receive_batch(self, result):
+        batch = receive_batch(self, result)
+        held.append({y for _, y in self.labels})
+        return batch
+    monkeypatch.setattr(_InMemoryDeepcellWorker, '_receive_batch', _receive_batch)
+    vda.run_pipeline_in_memory(FOLDER, name, backend='watershed', centroids=False, markers=False, n_workers=2, threads_per_worker=1)
+
+    assert held and max(len(rows) for rows in held) == 1
+    np.testing.assert_array_equal(serial, _stitched_labels(name))
+
+
+def test_zarr_stitch_rejects_another_tile_grid(synthetic_sample):
+    name, _ = synthetic_sample
+    DeepcellConfig.storage = 'zarr'
+    vda.split_immune_qptiff(FOLDER, name)
+    vda.segment_with_deepcell(FOLDER, name, backend='watershed', n_workers=1)
+    DeepcellConfig.tile_width = 500
+    with pytest.raises(ValueError, match='tile grid'):
+        vda.stitch_deepcell_labels(FOLDER, name)
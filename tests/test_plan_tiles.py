@@ -0,0 +1,27 @@
+import pytest
+
+import vectra_deepcell_analyser as vda
+from vectra_deepcell_analyser.config import DeepcellConfig
+
+
+@pytest.mark.parametrize('shape, memory_budget, n_workers', [
+    ((10000, 12000), 8 << 30, 1),
+    ((30000, 45000), 64 << 30, 4),
+    ((20000, 20000), 16 << 30, 2),
+])
+def test_every_stage_fits_the_budget(shape, memory_budget, n_workers):
+    plan = vda.plan_tiles(shape, memory_budget, n_workers)
+    assert max(plan.memory.values()) <= memory_budget
+    assert min(plan.tile_width, plan.tile_height) >= DeepcellConfig.plan_min_tile
+
+
+def test_tiles_shrink_for_post_processing_workers():
+    DeepcellConfig.cache_model_outputs = True
+    DeepcellConfig.postprocess_workers = 16
+    plan = vda.plan_tiles((20000, 20000), 16 << 30, 1)
+    assert plan.memory['segment'] <= 16 << 30
+
+
+def test_stages_tiling_cannot_fit_raise():
+    with pytest.raises(ValueError, match='markers'):
+        vda.plan_tiles((30000, 45000), 8 << 30, 1)
@@ -0,0 +1,34 @@
+import os
+import pathlib
+
+from vectra_deepcell_analyser.scheduler import _CohortScheduler, _Task
+from vectra_deepcell_analyser.panel_data import ImmunePanel
+
+from conftest import FOLDER
+
+
+def _die():
+    # as when the OOM killer ends a worker process
+    os._exit(1)
+
+
+def _touch(path):
+    pathlib.Path(path).touch()
+
+
+def test_scheduler_recovers_from_a_dead_worker(workdir):
+    for name in ('a', 'b'):
+        p = pathlib.Path('qptiffs', FOLDER, f'{name}.qptiff')
+        p.parent.mkdir(parents=True, exist_ok=True)
+        p.touch()
+    scheduler = _CohortScheduler(FOLDER, ['a', 'b'], ImmunePanel, 'whole-cell', 'DAPI', 'ECad', None, None,
+        memory_budget=100, n_processes=2, backend='watershed')
+    # each task takes the whole budget, so b only starts once a's worker has died
+    tasks = {
+        'a': [_Task('a', 'die', 'io', 100, _die, ()), _Task('a', 'after', 'io', 100, _touch, ('a_after',), deps=['die'])],
+        'b': [_Task('b', 'touch', 'io', 100, _touch, ('b_touch',))],
+    }
+    scheduler._sample_tasks = lambda name: tasks[name]
+
+    assert scheduler.process() == {'a': 'failed', 'b': 'done'}
+    assert pathlib.Path('b_touch').exists() and not pathlib.Path('a_after').exists()
@@ -0,0 +1,77 @@
+import os
+import pathlib
+
+import numpy as np
+import tifffile
+
+import vectra_deepcell_analyser as vda
+from vectra_deepcell_analyser.config import DeepcellConfig
+
+from conftest import FOLDER, tile_sample
+
+
+def _label_tiles(name):
+    folder = next(pathlib.Path('deepcell_labelled_tiles', FOLDER, name).iterdir())
+    return {f.name: tifffile.imread(f) for f in sorted(folder.glob('*.tif'))}
+
+
+def test_pooled_workers_use_parent_config(synthetic_sample):
+    name, _ = synthetic_sample
+    tile_sample(name)
+    DeepcellConfig.use_cache = False
+    # not the default, so workers still on the class defaults would label differently
+    DeepcellConfig.watershed_min_size = 400
+
+    vda.segment_with_deepcell(FOLDER, name, backend='watershed', n_workers=1)
+    serial = _label_tiles(name)
+    vda.segment_with_deepcell(FOLDER, name, backend='watershed', n_workers=2, threads_per_worker=1)
+    pooled = _label_tiles(name)
+
+    assert serial.keys() == pooled.keys() and len(serial) == 9
+    for tile, labels in serial.items():
+        np.testing.assert_array_equal(labels, pooled[tile], err_msg=tile)
+
+
+class _RawWatershedEngine(vda.segmenters._WatershedEngine):
+    '''The watershed backend split into predict_raw and postprocess, posing as a tensorflow model.'''
+    uses_tensorflow = True
+
+    def predict_raw(self, nuc_batch, mem_batch):
+        return np.stack((nuc_batch, mem_batch), axis=-1).astype('float16')
+
+    def postprocess(self, raw_batch, shape):
+        import sys
+        assert 'tensorflow' not in sys.modules, 'post-processing workers should not load tensorflow'
+        raw_batch = raw_batch.astype('float32')
+        return self.segment(raw_batch[..., 0], raw_batch[..., 1])
+
+
+def test_postprocess_workers_skip_tensorflow(synthetic_sample):
+    name, _ = synthetic_sample
+    tile_sample(name)
+    DeepcellConfig.cache_model_outputs = True
+    DeepcellConfig.postprocess_workers = 2
+
+    # predicting serially, as pooled predict workers size tensorflow's thread pools
+    vda.segment_with_deepcell(FOLDER, name, backend=_RawWatershedEngine, n_workers=1)
+    assert len(_label_tiles(name)) == 9
+
+
+# read when a pool worker imports this module to unpickle its engine, after numpy but before its initializer runs
+_IMPORT_THREADS = os.environ.get('OMP_NUM_THREADS')
+
+
+class _ThreadCheckingEngine(vda.segmenters._WatershedEngine):
+    def segment(self, nuc_batch, mem_batch):
+        assert _IMPORT_THREADS == '3', f'worker started with OMP_NUM_THREADS={_IMPORT_THREADS}'
+        return super().segment(nuc_batch, mem_batch)
+
+
+def test_pooled_workers_start_with_thread_limits(synthetic_sample):
+    name, _ = synthetic_sample
+    tile_sample(name)
+    saved = os.environ.get('OMP_NUM_THREADS')
+
+    vda.segment_with_deepcell(FOLDER, name, backend=_ThreadCheckingEngine, n_workers=2, threads_per_worker=3)
+    assert len(_label_tiles(name)) == 9
+    assert os.environ.get('OMP_NUM_THREADS') == saved
@@ -0,0 +1,44 @@
+import pathlib
+import shutil
+
+import numpy as np
+import tifffile
+
+import vectra_deepcell_analyser as vda
+from vectra_deepcell_analyser.config import DeepcellConfig
+from vectra_deepcell_analyser.panel_data import ImmunePanel
+from vectra_deepcell_analyser._helpers._zarr_store import _labels_reader
+
+from conftest import FOLDER
+
+
+def _unstacked(name, marker):
+    return tifffile.imread(pathlib.Path('unstacked', FOLDER, f'{name}_{marker}.tif'))
+
+
+def test_slide_channels_match_unstacked(synthetic_sample):
+    name, _ = synthetic_sample
+    with vda.open_slide(FOLDER, name) as slide:
+        assert slide.markers == list(ImmunePanel.channel_map.values())
+        assert slide.shape == (900, 1100)
+        cd8 = _unstacked(name, 'CD8')
+        np.testing.assert_array_equal(slide['CD8'][:, :], cd8)
+        np.testing.assert_array_equal(slide['CD8'][130:290, 470:520], cd8[130:290, 470:520])
+        # Slide.window is x first, the stack is (marker, y, x)
+        stack = slide.window(470, 130, 520, 290, markers=['DAPI', 'CD8'])
+        np.testing.assert_array_equal(stack, np.stack([_unstacked(name, 'DAPI')[130:290, 470:520], cd8[130:290, 470:520]]))
+
+
+def test_channels_from_qptiff_matches_unstacked(synthetic_sample):
+    name, _ = synthetic_sample
+    vda.run_pipeline_in_memory(FOLDER, name, backend='watershed', centroids=False, markers=False)
+    with _labels_reader(FOLDER, name, 'sample_whole-cell_DAPI_ECad_200_75') as reader:
+        unstacked = reader.window(0, reader.shape[0])
+
+    # without the unstacked copies, the channels can only come from the qptiff
+    shutil.rmtree(pathlib.Path('unstacked'))
+    DeepcellConfig.channels_from_qptiff = True
+    vda.run_pipeline_in_memory(FOLDER, name, backend='watershed', centroids=False, markers=False)
+    with _labels_reader(FOLDER, name, 'sample_whole-cell_DAPI_ECad_200_75') as reader:
+        np.testing.assert_array_equal(reader.window(0, reader.shape[0]), unstacked)
+    assert unstacked.max() > 100
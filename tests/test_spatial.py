@@ -0,0 +1,17 @@
+import numpy as np
+
+from vectra_deepcell_analyser.spatial import SpatialIndex
+
+
+def test_knn_on_an_empty_index_reports_missing_neighbours():
+    distances, ids = SpatialIndex([], [], [], mpp=0.5).query_knn([(10, 20), (30, 40)], k=3)
+    assert distances.shape == ids.shape == (2, 3)
+    assert np.all(np.isinf(distances)) and np.all(ids == -1)
+
+
+def test_knn_pads_missing_neighbours():
+    index = SpatialIndex([7, 9], [0, 10], [0, 0], mpp=0.5)
+    distances, ids = index.query_knn([(1, 0)], k=3)
+    np.testing.assert_array_equal(ids, [[7, 9, -1]])
+    np.testing.assert_allclose(distances[0, :2], [0.5, 4.5])
+    assert np.isinf(distances[0, 2])
@@ -0,0 +1,170 @@
+import importlib
+import pathlib
+
+import numpy as np
+import pytest
+import tifffile
+
+import vectra_deepcell_analyser as vda
+from vectra_deepcell_analyser.config import DeepcellConfig
+from vectra_deepcell_analyser._helpers._seams import _resolve_seam
+from vectra_deepcell_analyser.pipeline import _InMemoryStitcher
+from vectra_deepcell_analyser.detect_tissue import _occupied_tiles
+
+from conftest import FOLDER, write_sample
+from synthetic import SyntheticSlide
+
+
+def _disc(shape, cy, cx, radius):
+    y, x = np.mgrid[:shape[0], :shape[1]]
+    return np.hypot(y - cy, x - cx) < radius
+
+
+def _resolve(l, r, axis=1, mid=20):
+    return _resolve_seam(l, r, axis, mid, iou_threshold=0.5, min_fragment_size=50)
+
+
+def _merged(merges, a, b):
+    return any({int(p), int(q)} == {a, b} for p, q in merges.T)
+
+
+def test_straddling_cell_is_matched():
+    l, r = np.zeros((40, 40), 'uint32'), np.zeros((40, 40), 'uint32')
+    l[_disc(l.shape, 20, 20, 8)] = 1
+    r[_disc(r.shape, 20, 21, 8)] = 2
+    band, merges, drops = _resolve(l, r)
+    assert _merged(merges, 1, 2) and drops.size == 0
+    assert set(np.unique(band)) == {0, 1, 2}
+
+
+def test_low_iou_cut_cell_is_merged():
+    # both tiles see the cell across the seam line, but cut it differently, IoU is well below 0.5
+    l, r = np.zeros((40, 40), 'uint32'), np.zeros((40, 40), 'uint32')
+    cell = _disc(l.shape, 20, 20, 12)
+    l[cell & (np.arange(40)[None, :] < 23)] = 1
+    r[cell & (np.arange(40)[None, :] >= 17)] = 2
+    band, merges, drops = _resolve(l, r)
+    assert np.count_nonzero(band == 1) >= 50 and np.count_nonzero(band == 2) >= 50
+    assert _merged(merges, 1, 2) and drops.size == 0
+
+
+def test_sliver_without_a_matching_cell_is_dropped():
+    # r's cell reaches back past the seam line, where l sees two other cells, leaving r only a sliver after it
+    l, r = np.zeros((40, 40), 'uint32'), np.zeros((40, 40), 'uint32')
+    l[0:20, 0:20] = 1
+    l[20:40, 0:20] = 3
+    r[10:30, 10:22] = 2
+    band, merges, drops = _resolve(l, r)
+    assert 2 in drops and merges.size == 0
+    # l's cells continue into its core past the band edge, so they are never dropped
+    assert 1 not in drops and 3 not in drops
+
+
+def test_neighbouring_cells_are_not_merged():
+    l, r = np.zeros((40, 40), 'uint32'), np.zeros((40, 40), 'uint32')
+    l[_disc(l.shape, 20, 12, 9)] = 1
+    r[_disc(r.shape, 20, 12, 9)] = 3
+    l[_disc(l.shape, 20, 29, 9)] = 2
+    r[_disc(r.shape, 20, 29, 9)] = 4
+    # r cuts l's right cell a little short, so l's cell 2 loses no pixels while 1 and 3 match
+    band, merges, drops = _resolve(l, r)
+    assert _merged(merges, 1, 3) and _merged(merges, 2, 4)
+    assert not _merged(merges, 1, 4) and not _merged(merges, 2, 3)
+
+
+class _GivenTiles:
+    '''Stands in for the in-memory segmenter, returning the given tiles of each tile row.'''
+    def __init__(self, tiles):
+        self.tiles = tiles
+
+    def segment_row(self, y):
+        return {(x0, y0): tile for (x0, y0), tile in self.tiles.items() if y0 == max(0, y - DeepcellConfig.tile_padding_y)}
+
+
+def _stitch(tiles, shape):
+    stitcher = _InMemoryStitcher(FOLDER, 'corner', _GivenTiles(tiles), shape, 'whole-cell', 'DAPI', 'ECad', None, None)
+    stitcher.process()
+    return tifffile.imread(pathlib.Path('deepcell_labelled', FOLDER, 'corner', 'corner_whole-cell_DAPI_ECad_200_75.tif'))
+
+
+def test_cell_on_a_tile_corner_is_one_cell(workdir):
+    DeepcellConfig.tile_width = DeepcellConfig.tile_height = 100
+    DeepcellConfig.tile_padding_x = DeepcellConfig.tile_padding_y = 20
+    shape = (200, 200)
+    cell = _disc(shape, 100, 100, 14)
+    yy, xx = np.mgrid[:shape[0], :shape[1]]
+    tiles = {}
+    for i, (x, y) in enumerate([(0, 0), (100, 0), (0, 100), (100, 100)]):
+        # every tile cuts the cell differently, along its own diagonal
+        view = cell & (((yy - 100) * (1 if i // 2 else -1) + (xx - 100) * (1 if i % 2 else -1)) < 12)
+        x0, y0 = max(0, x - 20), max(0, y - 20)
+        tiles[(x0, y0)] = view[y0:y + 120, x0:x + 120].astype('int32')
+    labels = _stitch(tiles, shape)
+    ids = np.unique(labels[labels > 0])
+    assert ids.size == 1
+    assert np.count_nonzero(labels) > 0.9 * np.count_nonzero(cell)
+
+
+def _assert_matches_truth(name, labels_file):
+    stitched = tifffile.imread(pathlib.Path('deepcell_labelled', FOLDER, name, f'{name}_whole-cell_DAPI_ECad_200_75.tif'))
+    truth = tifffile.imread(labels_file)
+
+    np.testing.assert_array_equal(stitched > 0, truth > 0)
+    pairs = np.unique(np.stack((stitched[truth > 0], truth[truth > 0])), axis=1)
+    # one stitched label per true cell, and one true cell per stitched label
+    assert np.unique(pairs[0]).size == pairs.shape[1] == np.unique(pairs[1]).size
+
+
+def _stitch_two_step(folder, name):
+    vda.stitch_deepcell_labels_x(folder, name)
+    vda.stitch_deepcell_labels_y(folder, name)
+
+
+@pytest.mark.parametrize('stitch', [vda.stitch_deepcell_labels, _stitch_two_step])
+def test_stitched_stub_segmentation_matches_ground_truth(synthetic_sample, stitch):
+    name, labels_file = synthetic_sample
+    from synthetic import stub_segment
+    stub_segment(FOLDER, name, labels_file)
+    stitch(FOLDER, name)
+    _assert_matches_truth(name, labels_file)
+
+
+class _HalfBlankSlide(SyntheticSlide):
+    '''Cells only left of x=500, so the right column of 400 pixel tiles is background.'''
+    def _cells(self, y0:int, y1:int):
+        gy, gx, dist = super()._cells(y0, y1)
+        return gy, gx, np.where(np.arange(self.width) < 500, dist, np.inf)
+
+
+@pytest.mark.parametrize('stitch', [vda.stitch_deepcell_labels, _stitch_two_step])
+def test_background_tiles_are_not_read(workdir, stitch):
+    from synthetic import stub_segment
+    name, labels_file = write_sample(_HalfBlankSlide(900, 1100, density=4000, seed=1))
+    DeepcellConfig.skip_background_tiles = True
+    assert _occupied_tiles(FOLDER, name) == {(x, y) for x in (0, 400) for y in (0, 400, 800)}
+
+    stub_segment(FOLDER, name, labels_file)
+    # background tiles are never segmented, so their tiles must not be needed
+    tiles_folder = pathlib.Path('deepcell_labelled_tiles', FOLDER, name, f'{name}_whole-cell_DAPI_ECad_200_75')
+    for y0 in (0, 350, 750):
+        pathlib.Path(tiles_folder, f'{tiles_folder.name}_750_{y0}.tif').unlink()
+    stitch(FOLDER, name)
+    _assert_matches_truth(name, labels_file)
+
+
+def test_each_seam_is_resolved_once_and_written_once(synthetic_sample, monkeypatch):
+    name, labels_file = synthetic_sample
+    from synthetic import stub_segment
+    # the package re-exports a function of the same name, so take the module itself
+    stitch_deepcell_labels = importlib.import_module('vectra_deepcell_analyser.stitch_deepcell_labels')
+    stub_segment(FOLDER, name, labels_file)
+    seams = []
+    resolve_seam = stitch_deepcell_labels._resolve_seam
+    monkeypatch.setattr(stitch_deepcell_labels, '_resolve_seam', lambda l, r, axis, *args: seams.append(axis) or resolve_seam(l, r, axis, *args))
+    writes = []
+    write_tiled = stitch_deepcell_labels._write_tiled
+    monkeypatch.setattr(stitch_deepcell_labels, '_write_tiled', lambda path, *args: writes.append(path) or write_tiled(path, *args))
+    vda.stitch_deepcell_labels(FOLDER, name)
+    # 900x1100 in 400 pixel tiles is a 3x3 grid, so 2 vertical seams per row and 2 horizontal seams
+    assert sorted(seams) == [0, 0] + [1]*6
+    assert [p.name for p in writes] == [f'{name}_whole-cell_DAPI_ECad_200_75.tif']
@@ -0,0 +1,70 @@
+import shutil
+
+import pandas as pd
+import pytest
+
+import vectra_deepcell_analyser as vda
+from vectra_deepcell_analyser.config import DeepcellConfig
+from vectra_deepcell_analyser._helpers._zarr_store import _labels_path
+
+from conftest import FOLDER
+
+
+BASENAME = 'sample_whole-cell_DAPI_ECad_200_75'
+
+
+def _read_whole(path):
+    return pd.read_parquet(path).set_index('Object Id') if path.suffix == '.parquet' else pd.read_csv(path, index_col='Object Id')
+
+
+@pytest.fixture(params=['csv', 'parquet'])
+def tabled_sample(request, synthetic_sample):
+    '''Centroid and marker tables of the synthetic sample's ground truth labels, in each table format.'''
+    if request.param == 'parquet':
+        pytest.importorskip('pyarrow')
+    name, labels_file = synthetic_sample
+    path = _labels_path(FOLDER, name, BASENAME)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    shutil.copy(labels_file, path)
+    DeepcellConfig.table_format = request.param
+    # several row groups, so reads by Object Id can skip some
+    DeepcellConfig.parquet_row_group_size = 100
+    vda.calculate_centroids(FOLDER, name)
+    vda.compute_immune_markers(FOLDER, name)
+    return name
+
+
+def test_read_by_object_id_matches_pandas(tabled_sample, monkeypatch):
+    name = tabled_sample
+    centroids = vda.tables.open_centroids(FOLDER, name)
+    assert centroids.path.suffix == f'.{DeepcellConfig.table_format}'
+    whole = _read_whole(centroids.path)
+    assert len(centroids) == len(whole) > 300
+    assert centroids.columns == list(whole.columns)
+
+    read_groups = []
+    if centroids.parquet is not None:
+        read_row_groups = centroids.parquet.read_row_groups
+        monkeypatch.setattr(centroids.parquet, 'read_row_groups', lambda groups, **kwargs: read_groups.append(groups) or read_row_groups(groups, **kwargs))
+    # ids that are not cells are left out, not an error
+    ids = [int(whole.index[5]), int(whole.index[-3]), 10**7, -1]
+    table = centroids.read(['centroid_x_pixels', 'centroid_y_pixels'], object_ids=ids)
+    pd.testing.assert_frame_equal(table, whole.loc[whole.index.isin(ids), ['centroid_x_pixels', 'centroid_y_pixels']])
+    if centroids.parquet is not None:
+        # only the first and last row groups hold the ids
+        assert read_groups == [[0, centroids.parquet.num_row_groups - 1]]
+
+
+def test_read_cells_joins_centroids_and_markers(tabled_sample):
+    name = tabled_sample
+    centroids = _read_whole(vda.tables.open_centroids(FOLDER, name).path)
+    markers = _read_whole(vda.tables.open_markers(FOLDER, name).path)
+    marker = markers.columns[0]
+    ids = list(centroids.index[::7]) + [10**7]
+
+    cells = vda.tables.read_cells(FOLDER, name, ['centroid_y_pixels', marker], object_ids=ids)
+    expected = centroids[['centroid_y_pixels']].join(markers[[marker]], how='inner')
+    pd.testing.assert_frame_equal(cells, expected[expected.index.isin(ids)])
+
+    with pytest.raises(KeyError, match='not a centroid or marker column'):
+        vda.tables.read_cells(FOLDER, name, ['centroid_y_pixels', 'not a column'])
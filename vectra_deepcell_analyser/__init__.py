@@ -1,11 +1,23 @@
 from . import panel_data
 from . import config
+from . import metrics
+from . import segmenters
+from . import spatial
+from . import tables
+from . import slide
 
+from .slide import open_slide
 from .split_channels import split_immune_qptiff
+from .detect_tissue import detect_tissue
 from .tile_for_deepcell import tile_for_deepcell
 from .generate_mean_marker import generate_mean_immune_marker
 from .segment_with_deepcell import segment_with_deepcell
 from .stitch_deepcell_labels import stitch_deepcell_labels, stitch_deepcell_labels_x, stitch_deepcell_labels_y
 from .calculate_centroids import calculate_centroids, centroid_geojson
+from .cell_adjacency import calculate_cell_adjacency, load_cell_adjacency
+from .spatial import build_spatial_index
 from .make_outline_overlay import make_outline_overlay
 from .compute_markers import compute_immune_markers
+from .pipeline import run_pipeline_in_memory
+from .scheduler import run_cohort
+from .plan_tiles import plan_tiles, load_tile_plan
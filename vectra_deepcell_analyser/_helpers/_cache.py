@@ -0,0 +1,104 @@
+import hashlib
+import json
+import os
+import pathlib
+
+from ..config import DeepcellConfig
+
+
+def _fingerprint(path):
+    '''
+    Size and modification time of a file, or a hash of its contents if DeepcellConfig.cache_hash_contents is set.
+    Directories (zarr arrays) are fingerprinted by all the files under them.
+    '''
+    path = pathlib.Path(path)
+    if path.is_dir():
+        files = sorted(pathlib.Path(root, f) for root, _, names in os.walk(path) for f in names)
+        return [[str(f.relative_to(path)), _fingerprint(f)] for f in files]
+    if not path.is_file():
+        return None
+    if DeepcellConfig.cache_hash_contents:
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 24), b''):
+                h.update(chunk)
+        return h.hexdigest()
+    stat = path.stat()
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def _code_version(*sources):
+    '''Hash of the source files of the code producing an output.'''
+    h = hashlib.sha256()
+    for source in sources:
+        with open(source, 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+def _config_fields(*names):
+    return {name: getattr(DeepcellConfig, name) for name in names}
+
+
+def _panel_fields(panel):
+    return {'n_channels': panel.n_channels, 'channel_map': panel.channel_map}
+
+
+def _make_key(inputs, params, code):
+    return json.loads(json.dumps({
+        'inputs': {str(p): _fingerprint(p) for p in inputs},
+        'params': params,
+        'code': code,
+    }, sort_keys=True, default=str))
+
+
+class _StageCache:
+    '''
+    Manifest recording the inputs, parameters and code a stage output was computed from.
+    A stage can be skipped if the manifest matches and all recorded outputs still exist.
+    Disabled by setting DeepcellConfig.use_cache = False.
+    '''
+    def __init__(self, manifest, inputs, params, sources, outputs=()):
+        self.manifest = pathlib.Path(manifest)
+        self.key = _make_key(inputs, params, _code_version(*sources))
+        self.outputs = [str(p) for p in outputs]
+
+    def is_fresh(self):
+        if not DeepcellConfig.use_cache or not self.manifest.is_file():
+            return False
+        with open(self.manifest) as f:
+            recorded = json.load(f)
+        return recorded.get('key') == self.key and all(os.path.exists(p) for p in recorded.get('outputs', []))
+
+    def record(self, outputs=None):
+        outputs = self.outputs if outputs is None else [str(p) for p in outputs]
+        self.manifest.parent.mkdir(exist_ok=True, parents=True)
+        with open(self.manifest, 'w') as f:
+            json.dump({'key': self.key, 'outputs': outputs}, f, indent=1)
+
+
+class _TileManifest:
+    '''
+    Per tile manifest, so individual tiles whose inputs, parameters and code are unchanged can be skipped.
+    '''
+    def __init__(self, manifest, params, sources):
+        self.manifest = pathlib.Path(manifest)
+        self.params = params
+        self.code = _code_version(*sources)
+        self.entries = {}
+        if DeepcellConfig.use_cache and self.manifest.is_file():
+            with open(self.manifest) as f:
+                self.entries = json.load(f)
+
+    def key(self, inputs):
+        return _make_key(inputs, self.params, self.code)
+
+    def is_fresh(self, tile_id:str, key, output):
+        return DeepcellConfig.use_cache and self.entries.get(tile_id) == key and os.path.exists(output)
+
+    def record(self, tile_id:str, key):
+        self.entries[tile_id] = key
+
+    def save(self):
+        with open(self.manifest, 'w') as f:
+            json.dump(self.entries, f)
@@ -0,0 +1,103 @@
+import json
+import numpy as np
+
+from ..config import DeepcellConfig
+from ..metrics import _measure, _profile, _collecting
+from ._zarr_store import _labels_reader
+
+
+# QuPath detection properties, newer QuPath versions read objectType
+_QUPATH_PROPERTIES = {"object_type": "detection", "objectType": "detection", "isLocked": True, "Name": "deepcell"}
+
+
+class _FeatureWriter:
+    '''
+    Streams features, as json strings, into a GeoJSON FeatureCollection or one feature per line (NDJSON),
+    so the whole collection is never held in memory.
+    '''
+    def __init__(self, path, ndjson:bool=False):
+        self.path = path
+        self.ndjson = ndjson
+        self.n = 0
+
+    def __enter__(self):
+        self.f = open(self.path, 'w')
+        if not self.ndjson:
+            self.f.write('{"type": "FeatureCollection", "features": [\n')
+        return self
+
+    def write(self, features):
+        for feature in features:
+            if not self.ndjson and self.n > 0:
+                self.f.write(',\n')
+            self.f.write(feature)
+            if self.ndjson:
+                self.f.write('\n')
+            self.n += 1
+
+    def __exit__(self, *exc):
+        if not self.ndjson:
+            self.f.write('\n]}\n')
+        self.f.close()
+
+
+def _feature(object_id:int, geometry:dict):
+    return json.dumps({'type': 'Feature', 'id': int(object_id), 'geometry': geometry, 'properties': _QUPATH_PROPERTIES})
+
+
+def _point_features(ids, x, y):
+    for object_id, px, py in zip(ids.tolist(), x.tolist(), y.tolist()):
+        yield _feature(object_id, {'type': 'Point', 'coordinates': [px, py]})
+
+
+def _trace_outlines(config, folder, name, basename, window, ids, bboxes):
+    '''
+    Trace and simplify the outline of each cell whose bounding box (min_y, min_x, max_y, max_x, inclusive) lies in
+    the (y0, y1, x0, x1) label window. Runs in a spawned worker, so the parent's DeepcellConfig is applied first.
+    Returns the features as json strings, and the metrics records.
+    '''
+    import skimage.measure
+    for k, v in config.items():
+        setattr(DeepcellConfig, k, v)
+    y0, y1, x0, x1 = window
+    features = []
+    with _collecting() as collector:
+        with _measure('centroid_geojson', 'tile', sample=name, y=y0, x=x0) as m, \
+                _labels_reader(folder, name, basename) as labels, \
+                _profile('geojson.trace_outlines'):
+            im = labels.window(y0, y1, x0, x1)
+            for object_id, (by0, bx0, by1, bx1) in zip(ids.tolist(), bboxes.tolist()):
+                # zero border so every contour is closed
+                mask = np.pad(im[by0-y0:by1-y0+1, bx0-x0:bx1-x0+1] == object_id, 1)
+                contours = skimage.measure.find_contours(mask, 0.5)
+                if not contours:
+                    continue
+                ring = _simplify(max(contours, key=len), DeepcellConfig.geojson_simplify_tolerance)
+                if len(ring) < 4:
+                    continue
+                # contours run between pixel centres, shift to pixel corner coordinates as used by QuPath
+                coords = np.round(ring[:, ::-1] + (bx0 - 0.5, by0 - 0.5), 2)
+                features.append(_feature(object_id, {'type': 'Polygon', 'coordinates': [coords.tolist()]}))
+            m.count('cells', len(features))
+    return features, collector.drain()
+
+
+def _simplify(ring, tolerance:float):
+    '''
+    Simplify a closed ring (first vertex repeated last) by removing vertices closer than tolerance to the line
+    through their neighbours. Each vectorised pass removes vertices whose distance is a local minimum, so no two
+    neighbours go in the same pass. Much faster per cell than Douglas-Peucker for the short rings of traced cells.
+    '''
+    ring = ring[:-1]
+    while len(ring) > 3:
+        before, after = np.roll(ring, 1, axis=0), np.roll(ring, -1, axis=0)
+        chord = after - before
+        cross = np.abs(chord[:, 0] * (ring[:, 1] - before[:, 1]) - chord[:, 1] * (ring[:, 0] - before[:, 0]))
+        distance = cross / np.maximum(np.hypot(chord[:, 0], chord[:, 1]), 1e-12)
+        drop = (distance < tolerance) & (distance <= np.roll(distance, 1)) & (distance < np.roll(distance, -1))
+        if not np.any(drop):
+            break
+        if len(ring) - np.count_nonzero(drop) < 3:
+            drop[np.flatnonzero(drop)[len(ring) - 3:]] = False
+        ring = ring[~drop]
+    return np.concatenate((ring, ring[:1]))
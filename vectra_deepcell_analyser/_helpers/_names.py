@@ -0,0 +1,8 @@
+from ..config import DeepcellConfig
+
+
+def _deepcell_basename(name, compartment, nucleus_channel, membrane_channel, interior_threshold, maxima_threshold):
+    '''<name>_<deepcell config>, naming the stitched labels and every table derived from them.'''
+    it = interior_threshold if interior_threshold is not None else DeepcellConfig.interior_threshold
+    mt = maxima_threshold if maxima_threshold is not None else DeepcellConfig.maxima_threshold
+    return f'{name}_{compartment}_{nucleus_channel}_{membrane_channel}_{str(int(it*1000))}_{str(int(mt*1000))}'
@@ -0,0 +1,89 @@
+import numpy as np
+
+
+def _label_areas(labels:np.ndarray):
+    '''Return the non-zero labels of an array and their pixel counts, using a bincount over the label range.'''
+    values = labels[labels > 0].astype('int64')
+    if values.size == 0:
+        return np.zeros(0, dtype='int64'), np.zeros(0, dtype='int64')
+    lo = values.min()
+    counts = np.bincount(values - lo)
+    ids = np.flatnonzero(counts)
+    return ids + lo, counts[ids]
+
+
+def _lookup(ids:np.ndarray, values:np.ndarray, keys:np.ndarray, default=0):
+    '''Vectorised dictionary lookup of keys in sorted ids.'''
+    out = np.full(keys.shape, default, dtype=values.dtype)
+    if ids.size == 0:
+        return out
+    index = np.minimum(np.searchsorted(ids, keys), ids.size - 1)
+    found = ids[index] == keys
+    out[found] = values[index[found]]
+    return out
+
+
+def _best_partner(a:np.ndarray, b:np.ndarray, intersection:np.ndarray):
+    '''For each label in a, the label in b it shares the most pixels with, and the number of pixels shared.'''
+    order = np.lexsort((-intersection, a))
+    a, b, intersection = a[order], b[order], intersection[order]
+    first = np.r_[True, a[1:] != a[:-1]]
+    return a[first], b[first], intersection[first]
+
+
+def _edge_labels(tile:np.ndarray, axis:int, index:int):
+    '''Labels on the outer edge of a band, which continue into the tile's core outside the band.'''
+    edge = tile[index] if axis == 0 else tile[:, index]
+    return np.unique(edge[edge > 0])
+
+
+def _resolve_seam(l:np.ndarray, r:np.ndarray, axis:int, mid:int, iou_threshold:float, min_fragment_size:int):
+    '''
+    Resolve the overlap band of two neighbouring tiles with globally unique labels.
+    l is the tile before the seam (left or above) and r the tile after it, mid is the index of the seam line along axis.
+    The band must span the whole extent of both tiles along the seam.
+
+    Returns the composed band, label pairs which are the same cell, and labels of orphan fragments to remove.
+    The band takes l before the seam line and r after it, gaps on either side are filled from the other tile.
+    Cells are matched when their IoU within the band is at least iou_threshold. An unmatched label which loses pixels
+    to the other tile is merged into the label it overlaps most if they share at least iou_threshold of the smaller one,
+    as both tiles then saw one cell, cut differently. Otherwise it is removed if it keeps fewer than min_fragment_size
+    pixels and does not continue outside the band.
+    '''
+    before = np.arange(l.shape[axis]) < mid
+    before = before.reshape((-1, 1) if axis == 0 else (1, -1))
+    band = np.where(before, l, r)
+    band = np.where(band > 0, band, np.where(before, r, l))
+
+    # sparse contingency table of the overlap, pair encoded into one int64 key
+    both = (l > 0) & (r > 0)
+    keys = (l[both].astype('int64') << 32) | r[both].astype('int64')
+    keys, intersection = np.unique(keys, return_counts=True)
+    pair_l, pair_r = keys >> 32, keys & 0xffffffff
+
+    l_ids, l_area = _label_areas(l)
+    r_ids, r_area = _label_areas(r)
+    union = _lookup(l_ids, l_area, pair_l) + _lookup(r_ids, r_area, pair_r) - intersection
+    matched = intersection >= iou_threshold * union
+    merges = np.stack((pair_l[matched], pair_r[matched]))
+
+    kept_ids, kept_area = _label_areas(band)
+    merge_targets, drops = [], []
+    for ids, area, own, other, other_ids, other_area, edge in (
+            (l_ids, l_area, pair_l, pair_r, r_ids, r_area, _edge_labels(l, axis, 0)),
+            (r_ids, r_area, pair_r, pair_l, l_ids, l_area, _edge_labels(r, axis, -1))):
+        kept = _lookup(kept_ids, kept_area, ids)
+        cut = (kept < area) & ~np.isin(ids, own[matched])
+        if not np.any(cut):
+            continue
+        partner_of, partner, shared = _best_partner(own, other, intersection)
+        cut_ids, cut_area, cut_kept = ids[cut], area[cut], kept[cut]
+        targets = _lookup(partner_of, partner, cut_ids)
+        same_cell = _lookup(partner_of, shared, cut_ids) >= iou_threshold * np.minimum(cut_area, _lookup(other_ids, other_area, targets))
+        same_cell &= targets > 0
+        merge_targets.append(np.stack((cut_ids[same_cell], targets[same_cell])))
+        drops.append(cut_ids[~same_cell & (cut_kept < min_fragment_size) & ~np.isin(cut_ids, edge)])
+
+    merges = np.concatenate([merges] + merge_targets, axis=1)
+    drops = np.concatenate(drops) if drops else np.zeros(0, dtype='int64')
+    return band, merges, drops
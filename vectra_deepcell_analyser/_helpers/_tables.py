@@ -0,0 +1,69 @@
+import pathlib
+import pandas as pd
+
+from ..config import DeepcellConfig
+
+
+_suffixes = {'csv': '.csv', 'parquet': '.parquet'}
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError as e:
+        raise ImportError('Parquet tables need the pyarrow package') from e
+    return pyarrow
+
+
+def _table_file(stem):
+    '''Table file for a path without its suffix, in DeepcellConfig.table_format.'''
+    if DeepcellConfig.table_format not in _suffixes:
+        raise ValueError(f'Unknown table format "{DeepcellConfig.table_format}", expected one of {list(_suffixes)}')
+    stem = pathlib.Path(stem)
+    return stem.with_name(stem.name + _suffixes[DeepcellConfig.table_format])
+
+
+def _find_table(stem):
+    '''Existing table file for a path without its suffix, preferring DeepcellConfig.table_format.'''
+    preferred = _table_file(stem)
+    candidates = [preferred] + [pathlib.Path(stem).with_name(pathlib.Path(stem).name + s) for s in _suffixes.values()]
+    for path in candidates:
+        if path.is_file():
+            return path
+    raise FileNotFoundError(f'{preferred} does not exist or is a directory')
+
+
+def _table_fields():
+    '''DeepcellConfig fields a table output depends on, for stage cache manifests.'''
+    fields = {'table_format': DeepcellConfig.table_format}
+    if DeepcellConfig.table_format == 'parquet':
+        fields.update(parquet_row_group_size=DeepcellConfig.parquet_row_group_size, parquet_compression=DeepcellConfig.parquet_compression)
+    return fields
+
+
+def _write_table(df:pd.DataFrame, path):
+    '''
+    Write a table indexed by Object Id, as csv or parquet by the file suffix.
+    Parquet keeps typed columns, with Object Id as a column in ascending order, so row group statistics can select ids.
+    '''
+    path = pathlib.Path(path)
+    if path.suffix == '.parquet':
+        pa = _import_pyarrow()
+        table = pa.Table.from_pandas(df.sort_index().reset_index(), preserve_index=False)
+        pa.parquet.write_table(table, path,
+            row_group_size=DeepcellConfig.parquet_row_group_size, compression=DeepcellConfig.parquet_compression)
+    else:
+        df.to_csv(path)
+
+
+def _read_table(path, columns=None):
+    '''Read a table indexed by Object Id, only the given columns if not None.'''
+    path = pathlib.Path(path)
+    if path.suffix == '.parquet':
+        pa = _import_pyarrow()
+        table = pa.parquet.read_table(path, columns=None if columns is None else ['Object Id'] + list(columns))
+        return table.to_pandas().set_index('Object Id')
+    table = pd.read_csv(path, index_col='Object Id', usecols=None if columns is None else ['Object Id'] + list(columns))
+    # usecols keeps the file's column order
+    return table if columns is None else table[list(columns)]
@@ -0,0 +1,87 @@
+import math
+import threading
+import numpy as np
+import tifffile
+
+
+class _TiffWindowReader:
+    '''
+    Reads rectangular windows of a single tiff page without decoding the whole image.
+    Uncompressed contiguous pages are memory mapped, otherwise only the strips/tiles
+    which intersect the requested window are read and decoded.
+    '''
+    def __init__(self, path, page:int=0):
+        self.path = path
+        self.page_index = page
+        self.tf = tifffile.TiffFile(path)
+        self.page = self.tf.pages[page]
+        if self.page.samplesperpixel != 1 or len(self.page.shape) != 2:
+            raise ValueError(f'{path} page {page} should be a single channel 2d image, found shape {self.page.shape}')
+        self.shape = tuple(self.page.shape)
+        self.dtype = self.page.dtype
+        self.ndim = 2
+
+        self._lock = threading.Lock()
+        self._memmap = tifffile.memmap(path, page=page, mode='r') if self.page.is_memmappable else None
+        if self.page.is_tiled:
+            self._segment_shape = (self.page.tilelength, self.page.tilewidth)
+        else:
+            self._segment_shape = (min(self.page.rowsperstrip, self.shape[0]), self.shape[1])
+        self._segments_across = math.ceil(self.shape[1] / self._segment_shape[1])
+
+    def __reduce__(self):
+        # pool workers reopen the file, memory mapping it again
+        return type(self), (self.path, self.page_index)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def close(self):
+        self._memmap = None
+        self.tf.close()
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        key = key + (slice(None),) * (2 - len(key))
+        if len(key) != 2 or not all(isinstance(k, slice) for k in key):
+            raise IndexError(f'Only 2d slices are supported, not {key}')
+        (y0, y1, ystep), (x0, x1, xstep) = (k.indices(n) for k, n in zip(key, self.shape))
+        return self.window(y0, y1, x0, x1)[::ystep, ::xstep]
+
+    def window(self, y0:int, y1:int, x0:int=0, x1:int=None):
+        x1 = self.shape[1] if x1 is None else x1
+        y0, y1 = max(0, y0), min(y1, self.shape[0])
+        x0, x1 = max(0, x0), min(x1, self.shape[1])
+        if y1 <= y0 or x1 <= x0:
+            return np.zeros((max(0, y1-y0), max(0, x1-x0)), dtype=self.dtype)
+        if self._memmap is not None:
+            return np.asarray(self._memmap[y0:y1, x0:x1])
+
+        out = np.zeros((y1-y0, x1-x0), dtype=self.dtype)
+        seg_h, seg_w = self._segment_shape
+        for gy in range(y0 // seg_h, math.ceil(y1 / seg_h)):
+            for gx in range(x0 // seg_w, math.ceil(x1 / seg_w)):
+                index = gy * self._segments_across + gx
+                offset, bytecount = self.page.dataoffsets[index], self.page.databytecounts[index]
+                if not offset or not bytecount:
+                    continue
+                with self._lock:
+                    self.tf.filehandle.seek(offset)
+                    data = self.tf.filehandle.read(bytecount)
+                segment, indices, _ = self.page.decode(data, index, jpegtables=self.page.jpegtables)
+                if segment is None:
+                    continue
+                segment = segment.reshape(segment.shape[-3], segment.shape[-2])
+                sy, sx = indices[-3], indices[-2]
+                wy0, wy1 = max(y0, sy), min(y1, sy + segment.shape[0])
+                wx0, wx1 = max(x0, sx), min(x1, sx + segment.shape[1])
+                out[wy0-y0:wy1-y0, wx0-x0:wx1-x0] = segment[wy0-sy:wy1-sy, wx0-sx:wx1-sx]
+        return out
+
+    def iter_strips(self, strip_height:int):
+        for y0 in range(0, self.shape[0], strip_height):
+            yield y0, self.window(y0, y0 + strip_height)
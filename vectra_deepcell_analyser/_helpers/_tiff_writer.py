@@ -0,0 +1,38 @@
+import numpy as np
+import tifffile
+
+from ..config import DeepcellConfig
+
+
+def _write_tiled(path, strips, shape, dtype, **kwargs):
+    '''
+    Write a row-major stream of (y0, strip) image strips to a tiled, compressed BigTIFF.
+    Only one strip plus one row of tiff tiles is held in memory, and each pixel is written once.
+    Tile size and compression are taken from DeepcellConfig.
+    '''
+    tile_size = DeepcellConfig.tiff_tile_size
+    tifffile.imwrite(path, _iter_tiles(strips, shape, tile_size),
+        shape=shape, dtype=dtype, tile=(tile_size, tile_size),
+        compression=DeepcellConfig.tiff_compression, bigtiff=True, **kwargs)
+
+
+def _iter_tiles(strips, shape, tile_size):
+    leftover = None
+    for _, strip in strips:
+        block = strip if leftover is None else np.concatenate((leftover, strip))
+        n = block.shape[0] // tile_size * tile_size
+        for y in range(0, n, tile_size):
+            yield from _cut_tile_row(block[y:y+tile_size], shape, tile_size)
+        leftover = block[n:].copy() if n < block.shape[0] else None
+    if leftover is not None:
+        yield from _cut_tile_row(leftover, shape, tile_size)
+
+
+def _cut_tile_row(block, shape, tile_size):
+    for x in range(0, shape[1], tile_size):
+        tile = block[:, x:x+tile_size]
+        if tile.shape[:2] != (tile_size, tile_size):
+            padded = np.zeros((tile_size, tile_size) + tile.shape[2:], dtype=tile.dtype)
+            padded[:tile.shape[0], :tile.shape[1]] = tile
+            tile = padded
+        yield tile
@@ -1,13 +1,13 @@
-import time
+from ..metrics import _measure
 
 class _Timer(object):
+    '''Records a stage metric named `name`, see vectra_deepcell_analyser.metrics.'''
     def __init__(self, name=None):
         self.name = name
 
     def __enter__(self):
-        self.tstart = time.time()
+        self.measure = _measure(self.name if self.name else 'timer')
+        return self.measure.__enter__()
 
     def __exit__(self, type, value, traceback):
-        if self.name:
-            print('[%s] ' % self.name,end=None)
-        print('Elapsed: %ss' % (time.time() - self.tstart))
+        return self.measure.__exit__(type, value, traceback)
@@ -0,0 +1,59 @@
+import numpy as np
+
+
+class _UnionFind:
+    '''
+    Disjoint set over integer labels 0..n-1, stored as a numpy parent array.
+    Label 0 is background and is never merged.
+    '''
+    def __init__(self, n:int=1):
+        self.parent = np.arange(n, dtype='int64')
+
+    def grow(self, n:int):
+        if n > self.parent.size:
+            self.parent = np.concatenate((self.parent, np.arange(self.parent.size, n, dtype='int64')))
+
+    def find(self, a:int):
+        root = a
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[a] != root:
+            self.parent[a], a = root, self.parent[a]
+        return root
+
+    def union(self, a:int, b:int):
+        if a == 0 or b == 0:
+            return
+        ra, rb = self.find(a), self.find(b)
+        if ra != rb:
+            # keep the smaller label as root so relabelling is deterministic
+            self.parent[max(ra, rb)] = min(ra, rb)
+
+    def union_pairs(self, a, b):
+        self.grow(int(max(np.max(a, initial=0), np.max(b, initial=0))) + 1)
+        for i, j in zip(np.asarray(a).tolist(), np.asarray(b).tolist()):
+            self.union(i, j)
+
+    def roots(self):
+        roots = self.parent.copy()
+        while True:
+            jumped = roots[roots]
+            if np.array_equal(jumped, roots):
+                return roots
+            roots = jumped
+
+    def lookup_table(self, present=None):
+        '''
+        Table mapping every label to a sequential id of its set, 0 stays background.
+        If a boolean `present` mask is given, only sets containing a present label get an id.
+        '''
+        roots = self.roots()
+        keep = np.zeros(roots.size, dtype=bool)
+        if present is None:
+            keep[roots] = True
+        else:
+            keep[roots[:present.size][present]] = True
+        keep[0] = False
+        ids = np.cumsum(keep)
+        ids[~keep] = 0
+        return ids[roots]
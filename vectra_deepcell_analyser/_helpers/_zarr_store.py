@@ -0,0 +1,156 @@
+import pathlib
+import numpy as np
+
+from ..config import DeepcellConfig
+
+
+def _import_zarr():
+    try:
+        import zarr
+    except ImportError as e:
+        raise ImportError('DeepcellConfig.storage = "zarr" needs the zarr package') from e
+    return zarr
+
+
+def _zarr_major_version(zarr):
+    return int(zarr.__version__.split('.')[0])
+
+
+def _compressor(zarr):
+    cname = DeepcellConfig.zarr_compression
+    if cname is None:
+        return None
+    if _zarr_major_version(zarr) >= 3:
+        return zarr.codecs.BloscCodec(cname=cname, clevel=DeepcellConfig.zarr_compression_level, shuffle='bitshuffle')
+    import numcodecs
+    return numcodecs.Blosc(cname=cname, clevel=DeepcellConfig.zarr_compression_level, shuffle=numcodecs.Blosc.BITSHUFFLE)
+
+
+class _ZarrStore:
+    '''
+    Chunked array store for one sample at zarr/<folder>/<name>.zarr, holding
+        channels/<marker>          unstacked channels
+        tiles/<deepcell basename>  padded label tiles, (tile row, tile column, height, width), one chunk per tile
+        raw/<name>_<nuc>_<mem>/<x0>_<y0>  float16 model outputs of each tile, with DeepcellConfig.cache_model_outputs
+        labels/<deepcell basename> the stitched label mosaic
+    Image arrays are chunked by DeepcellConfig.tile_height x tile_width, so writers of different tiles or
+    tile rows never share a chunk and can run in parallel. Compression is DeepcellConfig.zarr_compression (blosc).
+    '''
+    def __init__(self, folder, name):
+        self.path = pathlib.Path('zarr', folder, f'{name}.zarr')
+
+    def exists(self, key:str):
+        p = pathlib.Path(self.path, key)
+        return pathlib.Path(p, 'zarr.json').is_file() or pathlib.Path(p, '.zarray').is_file()
+
+    def open(self, key:str, mode:str='r'):
+        if not self.exists(key):
+            raise FileNotFoundError(f'{pathlib.Path(self.path, key)} does not exist in the zarr store')
+        zarr = _import_zarr()
+        return zarr.open_array(str(pathlib.Path(self.path, key)), mode=mode)
+
+    def create(self, key:str, shape, dtype, chunks=None):
+        '''Create (or replace) an array, chunked by tile by default.'''
+        zarr = _import_zarr()
+        chunks = chunks if chunks is not None else (DeepcellConfig.tile_height, DeepcellConfig.tile_width) + tuple(shape[2:])
+        path = str(pathlib.Path(self.path, key))
+        if _zarr_major_version(zarr) >= 3:
+            return zarr.create_array(store=path, shape=shape, chunks=chunks, dtype=dtype,
+                fill_value=0, compressors=_compressor(zarr), overwrite=True)
+        return zarr.open_array(path, mode='w', shape=shape, chunks=chunks, dtype=dtype,
+            fill_value=0, compressor=_compressor(zarr))
+
+    def write_strips(self, key:str, strips, shape, dtype):
+        '''Write a row-major stream of (y0, strip) strips, buffered to whole chunk rows so every write is chunk aligned.'''
+        array = self.create(key, shape, dtype)
+        rows = array.chunks[0]
+        buffer, start = [], 0
+        for y0, strip in strips:
+            buffer.append(strip)
+            if y0 + strip.shape[0] - start >= rows:
+                block = np.concatenate(buffer)
+                n = block.shape[0] // rows * rows
+                array[start:start+n] = block[:n]
+                buffer, start = [block[n:]], start + n
+        block = np.concatenate(buffer) if buffer else None
+        if block is not None and block.shape[0] > 0:
+            array[start:start+block.shape[0]] = block
+        return array
+
+
+class _ZarrWindowReader:
+    '''Same interface as _TiffWindowReader, over a zarr array.'''
+    def __init__(self, array):
+        self.array = array
+        self.shape = tuple(array.shape)
+        self.dtype = np.dtype(array.dtype)
+        self.ndim = len(self.shape)
+
+    def window(self, y0:int, y1:int, x0:int=0, x1:int=None):
+        x1 = self.shape[1] if x1 is None else x1
+        return self.array[max(0, y0):min(y1, self.shape[0]), max(0, x0):min(x1, self.shape[1])]
+
+    def __getitem__(self, key):
+        return self.array[key]
+
+    def iter_strips(self, strip_height:int):
+        for y0 in range(0, self.shape[0], strip_height):
+            yield y0, self.window(y0, y0 + strip_height)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _channel_reader(folder, name, marker):
+    '''
+    Window reader for an unstacked channel, from the tiff or the zarr store depending on DeepcellConfig.storage,
+    or from its qptiff page with DeepcellConfig.channels_from_qptiff.
+    '''
+    from ._tiff_window import _TiffWindowReader
+    if DeepcellConfig.storage == 'zarr':
+        return _ZarrWindowReader(_ZarrStore(folder, name).open(f'channels/{marker}'))
+    page = _qptiff_page(folder, name, marker)
+    if page is not None:
+        return _TiffWindowReader(*page)
+    return _TiffWindowReader(pathlib.Path('unstacked', folder, f'{name}_{marker}.tif'))
+
+
+def _channel_path(folder, name, marker):
+    '''Path of an unstacked channel, the tiff, the array directory in the zarr store or the qptiff.'''
+    if DeepcellConfig.storage == 'zarr':
+        return pathlib.Path(_ZarrStore(folder, name).path, 'channels', marker)
+    page = _qptiff_page(folder, name, marker)
+    if page is not None:
+        return page[0]
+    return pathlib.Path('unstacked', folder, f'{name}_{marker}.tif')
+
+
+def _qptiff_page(folder, name, marker):
+    '''(qptiff, page index) of a channel read in place, or None if it is read from unstacked (e.g. AVGMARKER).'''
+    if not DeepcellConfig.channels_from_qptiff:
+        return None
+    from ..slide import _channel_pages
+    from ..panel_data import ImmunePanel
+    path = pathlib.Path('qptiffs', folder, f'{name}.qptiff')
+    pages = _channel_pages(path, ImmunePanel)
+    return (path, pages[marker]) if marker in pages else None
+
+
+def _labels_reader(folder, name, basename):
+    '''Window reader for a stitched label image, from the tiff or the zarr store depending on DeepcellConfig.storage.'''
+    from ._tiff_window import _TiffWindowReader
+    if DeepcellConfig.storage == 'zarr':
+        return _ZarrWindowReader(_ZarrStore(folder, name).open(f'labels/{basename}'))
+    return _TiffWindowReader(pathlib.Path('deepcell_labelled', folder, name, f'{basename}.tif'))
+
+
+def _labels_path(folder, name, basename):
+    if DeepcellConfig.storage == 'zarr':
+        return pathlib.Path(_ZarrStore(folder, name).path, 'labels', basename)
+    return pathlib.Path('deepcell_labelled', folder, name, f'{basename}.tif')
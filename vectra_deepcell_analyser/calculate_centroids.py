@@ -1,12 +1,18 @@
-import tifffile
 import numpy as np
 import pathlib
-import tqdm
 import pandas as pd
-import geojson
+import json
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 
 from .config import DeepcellConfig
-from ._helpers._timer import _Timer
+from ._helpers._zarr_store import _labels_reader, _labels_path
+from ._helpers._cache import _StageCache
+from ._helpers._tables import _table_file, _find_table, _write_table, _table_fields
+from ._helpers import _tables, _tiff_window, _zarr_store
+from ._helpers._geojson import _FeatureWriter, _QUPATH_PROPERTIES, _point_features, _trace_outlines
+from .metrics import _measure, _profile, _logger, _emit
+from .tables import CellTable
 
 def calculate_centroids(folder, name,
         compartment='whole-cell',
@@ -22,9 +28,20 @@ def centroid_geojson(folder, name,
         nucleus_channel:str='DAPI',
         membrane_channel:str='ECad',
         interior_threshold:float=None,
-        maxima_threshold:float=None):
+        maxima_threshold:float=None,
+        polygons:bool=False,
+        ndjson:bool=False,
+        n_workers:int=None):
+    '''
+    Export cells for QuPath, streamed so memory does not grow with the number of cells.
+    By default the centroids are one MultiPoint, or one Point feature per cell if ndjson is True.
+    With polygons=True each cell's outline is traced from the label image, on tiles extended to hold their cells whole,
+    in a pool of n_workers processes, and simplified by DeepcellConfig.geojson_simplify_tolerance pixels.
+
+    Output: 'centroids/<folder>/<name>/<name>_<deepcell config>_centroids.geojson' (or _outlines, .ndjson)
+    '''
     worker = _CalculateCetroidsWorker(folder, name, compartment, nucleus_channel, membrane_channel, interior_threshold, maxima_threshold)
-    worker.make_geojson()
+    worker.make_geojson(polygons, ndjson, n_workers)
 
 
 class _CalculateCetroidsWorker:
@@ -42,48 +59,183 @@ class _CalculateCetroidsWorker:
     def has_processed(self):
         outfolder = pathlib.Path('centroids', self.folder, self.name)
         outfolder.mkdir(exist_ok=True, parents=True)
-        return pathlib.Path(outfolder,  f'{self.infile_basename}_centroids.csv').is_file()
+        return _table_file(pathlib.Path(outfolder, f'{self.infile_basename}_centroids')).is_file()
 
     def process(self):
-        infile = pathlib.Path('deepcell_labelled', self.folder, self.name, f'{self.infile_basename}.tif')
-        if not infile.is_file():
-            raise FileNotFoundError(f'{infile} does not exist or is a directory')
+        infile = _labels_path(self.folder, self.name, self.infile_basename)
+        if not infile.exists():
+            raise FileNotFoundError(f'{infile} does not exist')
         
         outfolder = pathlib.Path('centroids', self.folder, self.name)
         outfolder.mkdir(exist_ok=True, parents=True)
+        outfile = _table_file(pathlib.Path(outfolder, f'{self.infile_basename}_centroids'))
+        cache = _StageCache(pathlib.Path(outfolder, f'.{self.infile_basename}_centroids.manifest.json'),
+            [infile], _table_fields(), [__file__, _tables.__file__, _tiff_window.__file__, _zarr_store.__file__], [outfile])
+        if cache.is_fresh():
+            _logger.info(f'{infile} is unchanged, skipping')
+            return
 
-        with _Timer('Calculate Centroids'):
-            im = tifffile.imread(infile)
-            labelled = im.reshape(im.shape + (1,))
-            indices = np.moveaxis(np.indices(im.shape), 0, 2)
-            formatted = np.dstack((indices, labelled))[im>0,...].reshape((-1, 3))
+        with _measure('centroids', sample=self.name) as m:
+            accumulator = _RegionPropsAccumulator()
+            with _labels_reader(self.folder, self.name, self.infile_basename) as reader:
+                for y0, strip in reader.iter_strips(DeepcellConfig.strip_height):
+                    with _profile('centroids.add_strip'):
+                        accumulator.add_strip(y0, strip)
+                    m.count('strips')
+            centroids = accumulator.to_dataframe()
+            _write_table(centroids, outfile)
+            m.count('cells', len(centroids))
+        cache.record()
 
-            df = pd.DataFrame(formatted, columns=['y', 'x', 'label'])
-            #df.to_csv(pathlib.Path(outfolder, f'{self.infile_basename}_pixel_data.csv'), index=False)
+    def make_geojson(self, polygons:bool=False, ndjson:bool=False, n_workers:int=None):
+        outfolder = pathlib.Path('centroids', self.folder, self.name)
+        outfolder.mkdir(exist_ok=True, parents=True)
+        if not self.has_processed():
+            self.process()
+        kind = 'outlines' if polygons else 'centroids'
+        outfile = pathlib.Path(outfolder, f'{self.infile_basename}_{kind}.{"ndjson" if ndjson else "geojson"}')
+        table = CellTable(_find_table(pathlib.Path(outfolder, f'{self.infile_basename}_centroids')))
 
-            centroids = df.groupby('label').mean()
-            centroids = centroids.rename(columns={'y':'centroid_y_pixels', 'x':'centroid_x_pixels'})
-            centroids['area_pixels'] = df.groupby('label').size()
-            centroids = centroids.join(df.groupby('label').min().rename(columns={'y':'min_y_pixels', 'x':'min_x_pixels'}))
-            centroids = centroids.join(df.groupby('label').max().rename(columns={'y':'max_y_pixels', 'x':'max_x_pixels'}))
+        with _measure('centroid_geojson', sample=self.name, polygons=polygons) as m:
+            if polygons:
+                with _FeatureWriter(outfile, ndjson) as writer:
+                    for features in self._iter_outline_features(table, n_workers):
+                        writer.write(features)
+                m.count('cells', writer.n)
+            elif ndjson:
+                with _FeatureWriter(outfile, ndjson=True) as writer:
+                    for batch in table.iter_batches(['centroid_x_pixels', 'centroid_y_pixels']):
+                        writer.write(_point_features(batch.index.to_numpy(), batch['centroid_x_pixels'].to_numpy(), batch['centroid_y_pixels'].to_numpy()))
+                m.count('cells', writer.n)
+            else:
+                m.count('cells', self._write_multipoint(table, outfile))
 
-            centroids.index = centroids.index.rename('Object Id')
+    def _write_multipoint(self, table, outfile):
+        '''Centroids as a single MultiPoint detection in a list, as read by QuPath, streamed in batches.'''
+        n = 0
+        with open(outfile, 'w') as f:
+            f.write('[{"type": "MultiPoint", "coordinates": [')
+            for batch in table.iter_batches(['centroid_x_pixels', 'centroid_y_pixels']):
+                if len(batch) == 0:
+                    continue
+                f.write((', ' if n > 0 else '') + json.dumps(batch.to_numpy().tolist())[1:-1])
+                n += len(batch)
+            f.write(f'], "properties": {json.dumps(_QUPATH_PROPERTIES)}}}]\n')
+        return n
 
-        with _Timer('Write to File'):
-            centroids.to_csv(pathlib.Path(outfolder, f'{self.infile_basename}_centroids.csv'))
+    def _iter_outline_features(self, table, n_workers:int=None):
+        '''
+        Yield lists of outline features, one list per tile of the label image.
+        Each cell belongs to the tile holding the top left corner of its bounding box,
+        and each tile reads the window covering its cells' bounding boxes, so every cell is whole.
+        '''
+        from .scheduler import _config_snapshot
+        cells = table.read(['min_y_pixels', 'min_x_pixels', 'max_y_pixels', 'max_x_pixels'])
+        ids = cells.index.to_numpy()
+        bboxes = cells.to_numpy().astype('int64')
+        with _labels_reader(self.folder, self.name, self.infile_basename) as labels:
+            height, width = labels.shape
+        tw, th = DeepcellConfig.tile_width, DeepcellConfig.tile_height
+        tile = (bboxes[:, 0] // th) * (-(-width // tw)) + bboxes[:, 1] // tw
+        order = np.argsort(tile, kind='stable')
+        bounds = np.flatnonzero(np.r_[True, tile[order][1:] != tile[order][:-1], True])
+        jobs = []
+        for s, e in zip(bounds[:-1], bounds[1:]):
+            index = order[s:e]
+            # the bounding box of the tile's own cells, so one large label does not enlarge every window
+            (y0, x0), (y1, x1) = bboxes[index, :2].min(axis=0), bboxes[index, 2:].max(axis=0) + 1
+            window = (int(y0), min(int(y1), height), int(x0), min(int(x1), width))
+            jobs.append((window, ids[index], bboxes[index]))
 
-    def make_geojson(self):
-        outfolder = pathlib.Path('centroids', self.folder, self.name)
-        outfolder.mkdir(exist_ok=True, parents=True)
-        if not pathlib.Path(outfolder,  f'{self.infile_basename}_centroids.csv').is_file():
-            self.process()
-        outfile = pathlib.Path(outfolder, f'{self.infile_basename}_centroids.geojson')
+        config = _config_snapshot()
+        n_workers = n_workers if n_workers is not None else DeepcellConfig.n_workers
+        if n_workers <= 1:
+            results = (_trace_outlines(config, self.folder, self.name, self.infile_basename, *job) for job in jobs)
+            for features, records in results:
+                for record in records:
+                    _emit(record)
+                yield features
+            return
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(n_workers, mp_context=context) as executor:
+            futures = [executor.submit(_trace_outlines, config, self.folder, self.name, self.infile_basename, *job) for job in jobs]
+            for future in futures:
+                features, records = future.result()
+                for record in records:
+                    _emit(record)
+                yield features
 
-        with _Timer('Create Geojson'):
-            centroids = pd.read_csv(pathlib.Path(outfolder, f'{self.infile_basename}_centroids.csv'), index_col='Object Id')
-            points = geojson.MultiPoint(
-                list(centroids[['centroid_x_pixels', 'centroid_y_pixels']].itertuples(index=False, name=None)),
-                properties={"object_type": "detection", "isLocked": True, "Name": "deepcell"})
-        
-        with _Timer('Write to File'):
-            geojson.dump([points], open(outfile, 'w'), indent=2)
+
+class _RegionPropsAccumulator:
+    '''
+    Accumulates area, centroid and bounding box of every label from row strips of a label image.
+    Each strip is run length encoded along x, so memory is O(number of labels) plus one strip.
+    '''
+    def __init__(self):
+        self.area = np.zeros(0, dtype='int64')
+        self.sum_y = np.zeros(0, dtype='float64')
+        self.sum_x = np.zeros(0, dtype='float64')
+        self.min_y = np.zeros(0, dtype='int64')
+        self.min_x = np.zeros(0, dtype='int64')
+        self.max_y = np.zeros(0, dtype='int64')
+        self.max_x = np.zeros(0, dtype='int64')
+
+    def _grow(self, n:int):
+        if n <= self.area.size:
+            return
+        extra = max(n, 2*self.area.size) - self.area.size
+        big = np.iinfo('int64').max
+        self.area = np.concatenate((self.area, np.zeros(extra, dtype='int64')))
+        self.sum_y = np.concatenate((self.sum_y, np.zeros(extra, dtype='float64')))
+        self.sum_x = np.concatenate((self.sum_x, np.zeros(extra, dtype='float64')))
+        self.min_y = np.concatenate((self.min_y, np.full(extra, big, dtype='int64')))
+        self.min_x = np.concatenate((self.min_x, np.full(extra, big, dtype='int64')))
+        self.max_y = np.concatenate((self.max_y, np.full(extra, -1, dtype='int64')))
+        self.max_x = np.concatenate((self.max_x, np.full(extra, -1, dtype='int64')))
+
+    def add_strip(self, y0:int, strip:np.ndarray):
+        foreground = strip > 0
+        starts = foreground.copy()
+        starts[:, 1:] &= strip[:, 1:] != strip[:, :-1]
+        ends = foreground
+        ends[:, :-1] &= strip[:, :-1] != strip[:, 1:]
+
+        rows, run_x0 = np.nonzero(starts)
+        if rows.size == 0:
+            return
+        _, run_x1 = np.nonzero(ends)
+        labels = strip[rows, run_x0].astype('int64')
+        lengths = run_x1 - run_x0 + 1
+        rows = rows + y0
+
+        self._grow(int(labels.max()) + 1)
+        n = self.area.size
+        self.area += np.bincount(labels, weights=lengths, minlength=n).astype('int64')
+        self.sum_y += np.bincount(labels, weights=lengths*rows, minlength=n)
+        self.sum_x += np.bincount(labels, weights=lengths*(run_x0+run_x1)/2, minlength=n)
+
+        # runs are in row-major order, so a stable sort keeps rows ascending within each label
+        order = np.argsort(labels, kind='stable')
+        labels = labels[order]
+        group_starts = np.flatnonzero(np.r_[True, labels[1:] != labels[:-1]])
+        group_ends = np.r_[group_starts[1:], labels.size] - 1
+        ids = labels[group_starts]
+        rows = rows[order]
+        self.min_y[ids] = np.minimum(self.min_y[ids], rows[group_starts])
+        self.max_y[ids] = np.maximum(self.max_y[ids], rows[group_ends])
+        self.min_x[ids] = np.minimum(self.min_x[ids], np.minimum.reduceat(run_x0[order], group_starts))
+        self.max_x[ids] = np.maximum(self.max_x[ids], np.maximum.reduceat(run_x1[order], group_starts))
+
+    def to_dataframe(self):
+        ids = np.flatnonzero(self.area)
+        area = self.area[ids]
+        centroids = pd.DataFrame({
+            'centroid_y_pixels': self.sum_y[ids] / area,
+            'centroid_x_pixels': self.sum_x[ids] / area,
+            'area_pixels': area,
+            'min_y_pixels': self.min_y[ids],
+            'min_x_pixels': self.min_x[ids],
+            'max_y_pixels': self.max_y[ids],
+            'max_x_pixels': self.max_x[ids],
+        }, index=pd.Index(ids, name='Object Id'))
+        return centroids
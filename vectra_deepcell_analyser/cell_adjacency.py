@@ -0,0 +1,137 @@
+'''
+Cell contact graph from the stitched label image, for neighbourhood analysis of touching cells.
+
+    vda.calculate_cell_adjacency('experiment', 'sample')
+    contacts = vda.load_cell_adjacency('experiment', 'sample')    # scipy.sparse csr matrix, indexed by Object Id
+    neighbours = contacts[object_id].indices                      # Object Ids of the cells touching object_id
+    shared = contacts[a, b]                                       # shared boundary length of a and b, in pixels
+
+Two cells touch if any of their pixels are 4-neighbours, and their shared boundary is the number of such pixel edges
+(multiply by DeepcellConfig.image_mpp for um). The matrix is symmetric with one row and column per label, 0 being background.
+'''
+import pathlib
+import numpy as np
+
+from .config import DeepcellConfig
+from ._helpers._zarr_store import _labels_reader, _labels_path
+from ._helpers._cache import _StageCache
+from ._helpers._names import _deepcell_basename
+from ._helpers import _tiff_window, _zarr_store
+from .metrics import _measure, _profile, _logger
+
+
+def calculate_cell_adjacency(folder, name,
+        compartment='whole-cell',
+        nucleus_channel:str='DAPI',
+        membrane_channel:str='ECad',
+        interior_threshold:float=None,
+        maxima_threshold:float=None):
+    '''
+    Label image is read in strips of DeepcellConfig.strip_height with one halo row of the next strip,
+    so memory scales with the number of touching pairs, not the slide size.
+
+    Input: 'deepcell_labelled/<folder>/<name>/<name>_<deepcell config>.tif'
+    Output: 'centroids/<folder>/<name>/<name>_<deepcell config>_adjacency.npz', a scipy.sparse matrix
+    '''
+    basename = _deepcell_basename(name, compartment, nucleus_channel, membrane_channel, interior_threshold, maxima_threshold)
+    infile = _labels_path(folder, name, basename)
+    if not infile.exists():
+        raise FileNotFoundError(f'{infile} does not exist')
+    outfolder = pathlib.Path('centroids', folder, name)
+    outfolder.mkdir(exist_ok=True, parents=True)
+    outfile = pathlib.Path(outfolder, f'{basename}_adjacency.npz')
+    cache = _StageCache(pathlib.Path(outfolder, f'.{basename}_adjacency.manifest.json'), [infile], {},
+        [__file__, _tiff_window.__file__, _zarr_store.__file__], [outfile])
+    if cache.is_fresh():
+        _logger.info(f'{infile} is unchanged, skipping')
+        return
+
+    import scipy.sparse
+    with _measure('adjacency', sample=name) as m:
+        accumulator = _ContactAccumulator()
+        with _labels_reader(folder, name, basename) as reader:
+            height = reader.shape[0]
+            for y0 in range(0, height, DeepcellConfig.strip_height):
+                # the halo row pairs the last row of this strip with the first row of the next
+                strip = reader.window(y0, y0 + DeepcellConfig.strip_height + 1)
+                with _profile('adjacency.add_strip'):
+                    accumulator.add_strip(strip, halo=y0 + DeepcellConfig.strip_height < height)
+                m.count('strips')
+        contacts = accumulator.to_sparse()
+        scipy.sparse.save_npz(outfile, contacts, compressed=True)
+        m.count('cells', contacts.shape[0] - 1)
+        m.count('contacts', contacts.nnz // 2)
+    cache.record()
+
+
+def load_cell_adjacency(folder, name,
+        compartment='whole-cell',
+        nucleus_channel:str='DAPI',
+        membrane_channel:str='ECad',
+        interior_threshold:float=None,
+        maxima_threshold:float=None):
+    '''Load the contact matrix saved by calculate_cell_adjacency.'''
+    import scipy.sparse
+    basename = _deepcell_basename(name, compartment, nucleus_channel, membrane_channel, interior_threshold, maxima_threshold)
+    infile = pathlib.Path('centroids', folder, name, f'{basename}_adjacency.npz')
+    if not infile.is_file():
+        raise FileNotFoundError(f'{infile} does not exist or is a directory, run calculate_cell_adjacency first')
+    return scipy.sparse.load_npz(infile).tocsr()
+
+
+class _ContactAccumulator:
+    '''
+    Counts the pixel edges between different labels, from row strips of a label image.
+    Each touching pair is encoded as one uint64 (smaller label << 32 | larger label), so a strip reduces to a
+    np.unique of its pair codes. Per strip counts are merged once the pending codes outnumber the merged ones,
+    so memory stays proportional to the number of distinct pairs.
+    '''
+    # pending codes are always allowed to reach this many before merging
+    merge_size = 1 << 20
+
+    def __init__(self):
+        self.codes = np.zeros(0, dtype='uint64')
+        self.counts = np.zeros(0, dtype='int64')
+        self.pending = []
+        self.n_pending = 0
+        self.n_labels = 1
+
+    def add_strip(self, strip:np.ndarray, halo:bool):
+        '''strip holds one halo row from the next strip if halo is True, which is only paired with the row above it.'''
+        if strip.size == 0:
+            return
+        self.n_labels = max(self.n_labels, int(strip.max()) + 1)
+        core = strip[:-1] if halo else strip
+        self._add_pairs(core[:, :-1], core[:, 1:])
+        self._add_pairs(strip[:-1], strip[1:])
+
+    def _add_pairs(self, a, b):
+        touching = (a != b) & (a > 0) & (b > 0)
+        a, b = a[touching].astype('uint64'), b[touching].astype('uint64')
+        if a.size == 0:
+            return
+        codes, counts = np.unique((np.minimum(a, b) << np.uint64(32)) | np.maximum(a, b), return_counts=True)
+        self.pending.append((codes, counts))
+        self.n_pending += codes.size
+        if self.n_pending > max(self.codes.size, self.merge_size):
+            self._merge()
+
+    def _merge(self):
+        if not self.pending:
+            return
+        codes = np.concatenate([self.codes] + [c for c, _ in self.pending])
+        counts = np.concatenate([self.counts] + [n for _, n in self.pending])
+        self.codes, inverse = np.unique(codes, return_inverse=True)
+        self.counts = np.bincount(inverse, weights=counts, minlength=self.codes.size).astype('int64')
+        self.pending = []
+        self.n_pending = 0
+
+    def to_sparse(self):
+        '''Symmetric csr matrix of shared boundary lengths, one row and column per label.'''
+        import scipy.sparse
+        self._merge()
+        lo = (self.codes >> np.uint64(32)).astype('int64')
+        hi = (self.codes & np.uint64(0xFFFFFFFF)).astype('int64')
+        counts = self.counts.astype('uint32')
+        shape = (self.n_labels, self.n_labels)
+        return scipy.sparse.coo_matrix((np.r_[counts, counts], (np.r_[lo, hi], np.r_[hi, lo])), shape=shape).tocsr()
@@ -1,11 +1,17 @@
-import tifffile
 import pathlib
 import pandas as pd
 import numpy as np
 
 from .config import DeepcellConfig
 from .panel_data import ImmunePanel
-from ._helpers._timer import _Timer
+from ._helpers._zarr_store import _labels_reader, _labels_path, _channel_reader, _channel_path
+from ._helpers._cache import _StageCache, _panel_fields
+from ._helpers._tables import _table_file, _write_table, _table_fields
+from ._helpers import _tables, _tiff_window, _zarr_store
+from .metrics import _measure, _profile, _logger
+
+
+_DEFAULT_STATISTICS = ('mean', 'std', 'min', 'max')
 
 
 def compute_immune_markers(folder, name,
@@ -13,13 +19,25 @@ def compute_immune_markers(folder, name,
         nucleus_channel:str='DAPI',
         membrane_channel:str='ECad',
         interior_threshold:float=None,
-        maxima_threshold:float=None):
-    worker = _CalculateMarkers(folder, name, ImmunePanel, compartment, nucleus_channel, membrane_channel, interior_threshold, maxima_threshold)
+        maxima_threshold:float=None,
+        statistics:tuple=_DEFAULT_STATISTICS,
+        percentiles:tuple=None,
+        percentile_bins:int=64):
+    '''
+    Per cell statistics of every panel marker, streamed from row strips of the label and channel images.
+    percentiles (e.g. (50, 90)) are estimated from percentile_bins bin histograms, which are only held for the
+    cells of the current strip, so memory stays O(number of cells) however many cells there are.
+
+    Output: 'output/<folder>/<name>/<name>_<deepcell config>.csv' (.parquet with DeepcellConfig.table_format = 'parquet')
+    '''
+    worker = _CalculateMarkers(folder, name, ImmunePanel, compartment, nucleus_channel, membrane_channel, interior_threshold, maxima_threshold,
+        statistics, percentiles, percentile_bins)
     worker.process()
 
 
 class _CalculateMarkers:
-    def __init__(self, folder, name, panel, compartment, nucleus_channel, membrane_channel, interior_threshold, maxima_threshold):
+    def __init__(self, folder, name, panel, compartment, nucleus_channel, membrane_channel, interior_threshold, maxima_threshold,
+            statistics=_DEFAULT_STATISTICS, percentiles=None, percentile_bins=64):
         self.folder = folder
         self.name = name
         self.panel = panel
@@ -28,42 +46,210 @@ class _CalculateMarkers:
         self.membrane_channel = membrane_channel
         self.interior_threshold = interior_threshold if interior_threshold is not None else DeepcellConfig.interior_threshold
         self.maxima_threshold = maxima_threshold if maxima_threshold is not None else DeepcellConfig.maxima_threshold
+        self.statistics = tuple(statistics)
+        for stat in self.statistics:
+            if stat not in _MarkerStatsAccumulator.statistics:
+                raise ValueError(f'Unknown statistic "{stat}", expected one of {_MarkerStatsAccumulator.statistics}')
+        self.percentiles = tuple(percentiles) if percentiles is not None else ()
+        self.percentile_bins = percentile_bins
 
         self.deepcell_basename = f'{name}_{compartment}_{nucleus_channel}_{membrane_channel}_{str(int(self.interior_threshold*1000))}_{str(int(self.maxima_threshold*1000))}'
-        self.labelled_file = pathlib.Path(
-            'deepcell_labelled', self.folder, self.name, f'{self.deepcell_basename}.tif')
-        if not self.labelled_file.is_file():
-            raise FileNotFoundError(f'{self.labelled_file} does not exist or is a directory')
-        self.unstacked_folder = pathlib.Path('unstacked', self.folder)
+        self.labelled_file = _labels_path(self.folder, self.name, self.deepcell_basename)
+        if not self.labelled_file.exists():
+            raise FileNotFoundError(f'{self.labelled_file} does not exist')
         for marker in self.panel.channel_map.values():
-            p = pathlib.Path(self.unstacked_folder, f'{self.name}_{marker}.tif')
-            if not p.is_file():
-                raise FileNotFoundError(f'{p} does not exist or is a directory')
+            p = _channel_path(self.folder, self.name, marker)
+            if not p.exists():
+                raise FileNotFoundError(f'{p} does not exist')
 
     def process(self):
         outfolder = pathlib.Path('output', self.folder, self.name)
         outfolder.mkdir(exist_ok=True, parents=True)
-        outfile = pathlib.Path(outfolder, f'{self.deepcell_basename}.csv')
+        outfile = _table_file(pathlib.Path(outfolder, self.deepcell_basename))
+        markers = list(self.panel.channel_map.values())
+        cache = _StageCache(pathlib.Path(outfolder, f'.{self.deepcell_basename}.manifest.json'),
+            [self.labelled_file] + [_channel_path(self.folder, self.name, marker) for marker in markers],
+            dict(_panel_fields(self.panel), statistics=self.statistics, percentiles=self.percentiles, percentile_bins=self.percentile_bins,
+                **_table_fields()),
+            [__file__, _tables.__file__, _tiff_window.__file__, _zarr_store.__file__], [outfile])
+        if cache.is_fresh():
+            _logger.info(f'{self.labelled_file} and markers are unchanged, skipping')
+            return
 
-        with _Timer('Compute Mean Markers'):
-            arrs = []
-            markers = ['Object Id']
-            im = tifffile.imread(self.labelled_file)
-            arrs.append(im.reshape(im.shape + (1,)))
+        with _measure('markers', sample=self.name) as m:
+            labels = _labels_reader(self.folder, self.name, self.deepcell_basename)
+            channels = [self._get_marker(marker) for marker in markers]
+            try:
+                ranges = self._histogram_ranges(channels) if self.percentiles else None
+                accumulator = _MarkerStatsAccumulator(len(markers), ranges, self.percentile_bins, self.percentiles)
+                for y0, label_strip in labels.iter_strips(DeepcellConfig.strip_height):
+                    y1 = y0 + label_strip.shape[0]
+                    with _profile('markers.add_strip'):
+                        accumulator.add_strip(label_strip, (c.window(y0, y1) for c in channels))
+                    m.count('strips')
+            finally:
+                labels.close()
+                for c in channels:
+                    c.close()
+            mean_markers = accumulator.to_dataframe(markers, self.statistics)
+            _write_table(mean_markers, outfile)
+            m.count('cells', len(mean_markers))
+        cache.record()
 
-            for marker in self.panel.channel_map.values():
-                markers.append(marker)
-                arrs.append(self._get_marker(marker))
+    def _get_marker(self, marker):
+        return _channel_reader(self.folder, self.name, marker)
 
-            formatted = np.dstack(arrs)[im>0, ...].reshape((-1, len(markers)))
+    def _histogram_ranges(self, channels):
+        ranges = []
+        for c in channels:
+            if np.issubdtype(c.dtype, np.integer):
+                ranges.append((0, np.iinfo(c.dtype).max + 1))
+                continue
+            lo, hi = np.inf, -np.inf
+            for _, strip in c.iter_strips(DeepcellConfig.strip_height):
+                lo, hi = min(lo, np.min(strip)), max(hi, np.max(strip))
+            ranges.append((float(lo), float(hi) if hi > lo else float(lo) + 1))
+        return ranges
 
-            pixel_data = pd.DataFrame(formatted, columns=markers)
-        
-            mean_markers = pixel_data.groupby('Object Id').mean()
 
-        with _Timer('Write to File'):
-            mean_markers.to_csv(outfile)
+class _MarkerStatsAccumulator:
+    '''
+    Accumulates per label count, sum, sum of squares, min and max of each channel from row strips.
+    Optionally keeps a fixed bin histogram per label and channel to estimate percentiles. Histograms are sparse
+    (label * bins + bin) counts of the open labels only, those in the latest strip. A label missing from a strip
+    can not reappear further down, as labels are connected, so its percentiles are computed and its histogram freed.
+    Memory is O(number of labels) plus one strip per channel.
+    '''
+    statistics = _DEFAULT_STATISTICS
 
-    def _get_marker(self, marker):
-        im = tifffile.imread(pathlib.Path(self.unstacked_folder, f'{self.name}_{marker}.tif'))
-        return im.reshape(im.shape + (1,))
+    def __init__(self, n_channels:int, histogram_ranges=None, histogram_bins:int=64, percentiles=()):
+        self.n_channels = n_channels
+        self.histogram_ranges = histogram_ranges
+        self.histogram_bins = histogram_bins
+        self.percentiles = tuple(percentiles) if histogram_ranges is not None else ()
+        self.count = np.zeros(0, dtype='int64')
+        self.sum = np.zeros((0, n_channels), dtype='float64')
+        self.sumsq = np.zeros((0, n_channels), dtype='float64')
+        self.min = np.zeros((0, n_channels), dtype='float64')
+        self.max = np.zeros((0, n_channels), dtype='float64')
+        self.percentile_values = np.zeros((0, n_channels, len(self.percentiles)), dtype='float64')
+        self.open_labels = np.zeros(0, dtype='int64')
+        self.open_keys = [np.zeros(0, dtype='int64') for _ in range(n_channels)]
+        self.open_counts = [np.zeros(0, dtype='int64') for _ in range(n_channels)]
+        self.closed = np.zeros(0, dtype=bool)
+        self.n_reopened = 0
+
+    def _grow(self, n:int):
+        if n <= self.count.size:
+            return
+        extra = max(n, 2*self.count.size) - self.count.size
+        self.count = np.concatenate((self.count, np.zeros(extra, dtype='int64')))
+        self.sum = np.concatenate((self.sum, np.zeros((extra, self.n_channels))))
+        self.sumsq = np.concatenate((self.sumsq, np.zeros((extra, self.n_channels))))
+        self.min = np.concatenate((self.min, np.full((extra, self.n_channels), np.inf)))
+        self.max = np.concatenate((self.max, np.full((extra, self.n_channels), -np.inf)))
+        if self.percentiles:
+            self.percentile_values = np.concatenate((self.percentile_values,
+                np.full((extra, self.n_channels, len(self.percentiles)), np.nan)))
+            self.closed = np.concatenate((self.closed, np.zeros(extra, dtype=bool)))
+
+    def add_strip(self, label_strip:np.ndarray, channel_strips):
+        mask = label_strip > 0
+        labels = label_strip[mask].astype('int64')
+        if labels.size == 0:
+            self._close_labels(self.open_labels)
+            return
+        self._grow(int(labels.max()) + 1)
+        n = self.count.size
+        self.count += np.bincount(labels, minlength=n)
+
+        # one sort per strip, shared by the min/max reductions of every channel
+        order = np.argsort(labels, kind='stable')
+        group_starts = np.flatnonzero(np.r_[True, labels[order][1:] != labels[order][:-1]])
+        ids = labels[order][group_starts]
+
+        for i, strip in enumerate(channel_strips):
+            values = strip[mask].astype('float64')
+            self.sum[:, i] += np.bincount(labels, weights=values, minlength=n)
+            self.sumsq[:, i] += np.bincount(labels, weights=values*values, minlength=n)
+            sorted_values = values[order]
+            self.min[ids, i] = np.minimum(self.min[ids, i], np.minimum.reduceat(sorted_values, group_starts))
+            self.max[ids, i] = np.maximum(self.max[ids, i], np.maximum.reduceat(sorted_values, group_starts))
+            if self.percentiles:
+                self._add_histogram(i, labels, values)
+        if self.percentiles:
+            reopened = self.closed[ids]
+            if np.any(reopened):
+                self.n_reopened += int(np.count_nonzero(reopened))
+                self.closed[ids] = False
+            self._close_labels(np.setdiff1d(self.open_labels, ids, assume_unique=True))
+            self.open_labels = ids
+
+    def _add_histogram(self, channel:int, labels, values):
+        lo, hi = self.histogram_ranges[channel]
+        bins = ((values - lo) * (self.histogram_bins / (hi - lo))).astype('int64')
+        np.clip(bins, 0, self.histogram_bins - 1, out=bins)
+        keys, counts = np.unique(labels * self.histogram_bins + bins, return_counts=True)
+        keys, inverse = np.unique(np.concatenate((self.open_keys[channel], keys)), return_inverse=True)
+        self.open_counts[channel] = np.bincount(inverse, weights=np.concatenate((self.open_counts[channel], counts)),
+            minlength=keys.size).astype('int64')
+        self.open_keys[channel] = keys
+
+    def _close_labels(self, labels):
+        '''Compute the percentiles of labels which will not be seen again, and free their histograms.'''
+        if not self.percentiles or labels.size == 0:
+            return
+        for channel in range(self.n_channels):
+            keys, counts = self.open_keys[channel], self.open_counts[channel]
+            closing = np.isin(keys // self.histogram_bins, labels)
+            self._percentiles(channel, keys[closing], counts[closing])
+            self.open_keys[channel], self.open_counts[channel] = keys[~closing], counts[~closing]
+        self.closed[labels] = True
+        self.open_labels = np.setdiff1d(self.open_labels, labels, assume_unique=True)
+
+    def _percentiles(self, channel:int, keys, counts):
+        '''Interpolated percentiles from sorted sparse histogram keys, for every label they hold.'''
+        if keys.size == 0:
+            return
+        lo, hi = self.histogram_ranges[channel]
+        width = (hi - lo) / self.histogram_bins
+        labels, bins = keys // self.histogram_bins, keys % self.histogram_bins
+        starts = np.flatnonzero(np.r_[True, labels[1:] != labels[:-1]])
+        ends = np.r_[starts[1:], keys.size] - 1
+        cdf = np.cumsum(counts)
+        # cumulative counts within each label
+        cdf -= np.repeat(np.r_[0, cdf[starts[1:] - 1]], np.diff(np.r_[starts, keys.size]))
+        total = cdf[ends]
+        group = np.repeat(np.arange(starts.size), np.diff(np.r_[starts, keys.size]))
+        for j, q in enumerate(self.percentiles):
+            target = q / 100 * total
+            # first bin whose cumulative count reaches the target
+            b = np.minimum(starts + np.bincount(group, weights=cdf < target[group], minlength=starts.size).astype('int64'), ends)
+            below = cdf[b] - counts[b]
+            fraction = (target - below) / counts[b]
+            self.percentile_values[labels[starts], channel, j] = lo + (bins[b] + fraction) * width
+
+    def to_dataframe(self, markers, statistics=_DEFAULT_STATISTICS):
+        self._close_labels(self.open_labels)
+        if self.n_reopened:
+            _logger.warning(f'{self.n_reopened} labels are not vertically connected, their percentiles only use their lowest part')
+        ids = np.flatnonzero(self.count)
+        count = self.count[ids, None]
+        mean = self.sum[ids] / count
+        columns = {}
+        for stat in statistics:
+            if stat == 'mean':
+                values = mean
+            elif stat == 'std':
+                values = np.sqrt(np.maximum(self.sumsq[ids] / count - mean*mean, 0))
+            elif stat == 'min':
+                values = self.min[ids]
+            elif stat == 'max':
+                values = self.max[ids]
+            for i, marker in enumerate(markers):
+                # mean keeps the bare marker name so existing outputs are unchanged
+                columns[marker if stat == 'mean' else f'{marker}_{stat}'] = values[:, i]
+        for j, q in enumerate(self.percentiles):
+            for i, marker in enumerate(markers):
+                columns[f'{marker}_p{q:g}'] = self.percentile_values[ids, i, j]
+        return pd.DataFrame(columns, index=pd.Index(ids, name='Object Id'))
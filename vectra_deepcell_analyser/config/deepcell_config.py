@@ -8,3 +8,36 @@ class DeepcellConfig:
     image_mpp = 0.4976
     interior_threshold = 0.2
     maxima_threshold = 0.075
+    strip_height = 1024
+    stitch_iou_threshold = 0.5
+    stitch_min_fragment_size = 50
+    tiff_tile_size = 512
+    tiff_compression = 'zlib'
+    batch_size = 4
+    n_workers = 1
+    use_cache = True
+    cache_hash_contents = False
+    memory_budget = None
+    watershed_sigma = 1.0
+    watershed_min_distance_um = 3.0
+    watershed_expansion_um = 5.0
+    watershed_min_size = 20
+    storage = 'tiff'
+    zarr_compression = 'zstd'
+    zarr_compression_level = 3
+    spatial_grid_um = 25.0
+    table_format = 'csv'
+    parquet_compression = 'zstd'
+    parquet_row_group_size = 65536
+    geojson_simplify_tolerance = 0.5
+    skip_background_tiles = False
+    tissue_channel = 'DAPI'
+    tissue_downsample = 16
+    tissue_dilation_um = 50.0
+    plan_min_tile = 512
+    plan_max_tile = 4000
+    plan_max_batch_size = 16
+    plan_padding_um = 50.0
+    cache_model_outputs = False
+    postprocess_workers = None
+    channels_from_qptiff = False
@@ -0,0 +1,114 @@
+import os
+import pathlib
+import numpy as np
+
+from .config import DeepcellConfig
+from ._helpers._zarr_store import _channel_reader, _channel_path
+from ._helpers._cache import _StageCache, _config_fields
+from ._helpers import _tiff_window, _zarr_store
+from .metrics import _measure, _logger
+
+
+def detect_tissue(folder, name):
+    '''
+    Find which segmentation tiles hold tissue, from a downsampled DeepcellConfig.tissue_channel image.
+    With DeepcellConfig.skip_background_tiles set, tiling, mean marker generation and segmentation only process
+    occupied tiles, and the stitchers treat the other tiles as background without reading them.
+    Run automatically by those stages if needed.
+
+    Input: 'unstacked/<folder>/<name>_<tissue channel>.tif'
+    Output: 'tissue/<folder>/<name>_tissue.npz', the tile occupancy grid and the downsampled tissue mask
+    '''
+    worker = _DetectTissue(folder, name)
+    worker.process()
+
+
+def _occupied_tiles(folder, name):
+    '''Grid origins (x, y) of the tiles holding tissue, or None if DeepcellConfig.skip_background_tiles is not set.'''
+    if not DeepcellConfig.skip_background_tiles:
+        return None
+    worker = _DetectTissue(folder, name)
+    worker.process()
+    with np.load(worker.outfile) as f:
+        occupied = f['occupied']
+    return {(int(col) * DeepcellConfig.tile_width, int(row) * DeepcellConfig.tile_height) for row, col in zip(*np.nonzero(occupied))}
+
+
+def _tissue_inputs(folder, name):
+    '''The tissue mask file, as a cache input of stages which depend on it.'''
+    if not DeepcellConfig.skip_background_tiles:
+        return []
+    return [pathlib.Path('tissue', folder, f'{name}_tissue.npz')]
+
+
+class _DetectTissue:
+    '''
+    Tissue is an Otsu threshold of the smoothed, block averaged tissue channel, dilated by DeepcellConfig.tissue_dilation_um
+    so sparse tissue edges are kept. A tile is occupied if its padded extent touches tissue.
+    '''
+    def __init__(self, folder, name):
+        self.folder = folder
+        self.name = name
+        self.outfile = pathlib.Path('tissue', folder, f'{name}_tissue.npz')
+
+    def process(self):
+        infile = _channel_path(self.folder, self.name, DeepcellConfig.tissue_channel)
+        if not infile.exists():
+            raise FileNotFoundError(f'{infile} does not exist')
+        self.outfile.parent.mkdir(exist_ok=True, parents=True)
+        cache = _StageCache(pathlib.Path(self.outfile.parent, f'.{self.name}_tissue.manifest.json'),
+            [infile],
+            _config_fields('tissue_channel', 'tissue_downsample', 'tissue_dilation_um', 'image_mpp',
+                'tile_width', 'tile_height', 'tile_padding_x', 'tile_padding_y'),
+            [__file__, _tiff_window.__file__, _zarr_store.__file__], [self.outfile])
+        if cache.is_fresh():
+            return
+        with _measure('tissue', sample=self.name) as m, \
+                _channel_reader(self.folder, self.name, DeepcellConfig.tissue_channel) as reader:
+            mask = self._tissue_mask(self._downsample(reader))
+            occupied = self._occupancy(mask, reader.shape)
+            m.count('tiles', occupied.size)
+            m.count('occupied_tiles', np.count_nonzero(occupied))
+        _logger.info(f'{self.name}: {np.count_nonzero(occupied)} of {occupied.size} tiles hold tissue')
+        # written under a temporary name and renamed, so concurrent readers never see a partial file
+        tmp = self.outfile.with_name(f'.{self.outfile.name}.{os.getpid()}.tmp.npz')
+        np.savez(tmp, occupied=occupied, mask=mask, downsample=DeepcellConfig.tissue_downsample)
+        os.replace(tmp, self.outfile)
+        cache.record()
+
+    def _downsample(self, reader):
+        '''Block mean of DeepcellConfig.tissue_downsample square blocks, read in strips of whole blocks.'''
+        f = DeepcellConfig.tissue_downsample
+        cols = np.arange(0, reader.shape[1], f)
+        widths = np.diff(np.r_[cols, reader.shape[1]])
+        rows = []
+        for _, strip in reader.iter_strips(f * max(1, DeepcellConfig.strip_height // f)):
+            starts = np.arange(0, strip.shape[0], f)
+            heights = np.diff(np.r_[starts, strip.shape[0]])
+            sums = np.add.reduceat(np.add.reduceat(strip.astype('float64'), starts, axis=0), cols, axis=1)
+            rows.append(sums / heights[:, None] / widths[None, :])
+        return np.concatenate(rows).astype('float32')
+
+    def _tissue_mask(self, small):
+        from scipy import ndimage
+        import skimage.filters
+        smooth = ndimage.gaussian_filter(small, 2)
+        if smooth.max() <= smooth.min():
+            return np.ones(small.shape, dtype=bool)
+        mask = smooth > skimage.filters.threshold_otsu(smooth)
+        radius = DeepcellConfig.tissue_dilation_um / (DeepcellConfig.image_mpp * DeepcellConfig.tissue_downsample)
+        return ndimage.distance_transform_edt(~mask) <= radius
+
+    def _occupancy(self, mask, shape):
+        f = DeepcellConfig.tissue_downsample
+        height, width = shape
+        grid = (-(-height // DeepcellConfig.tile_height), -(-width // DeepcellConfig.tile_width))
+        occupied = np.zeros(grid, dtype=bool)
+        for row in range(grid[0]):
+            for col in range(grid[1]):
+                x, y = col * DeepcellConfig.tile_width, row * DeepcellConfig.tile_height
+                x0, y0 = max(0, x - DeepcellConfig.tile_padding_x), max(0, y - DeepcellConfig.tile_padding_y)
+                x1 = min(x + DeepcellConfig.tile_width + DeepcellConfig.tile_padding_x, width)
+                y1 = min(y + DeepcellConfig.tile_height + DeepcellConfig.tile_padding_y, height)
+                occupied[row, col] = np.any(mask[y0 // f:-(-y1 // f), x0 // f:-(-x1 // f)])
+        return occupied
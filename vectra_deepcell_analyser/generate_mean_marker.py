@@ -3,67 +3,146 @@ import numpy as np
 import pathlib
 import os
 import re
-import tqdm
+from concurrent.futures import ThreadPoolExecutor
 
 from .panel_data import ImmunePanel
 from .config import DeepcellConfig
+from ._helpers._tiff_writer import _write_tiled
+from ._helpers._zarr_store import _ZarrStore, _channel_reader, _channel_path
+from ._helpers._cache import _StageCache, _TileManifest, _config_fields, _panel_fields
+from ._helpers import _tiff_window, _tiff_writer, _zarr_store
+from .metrics import _measure, _logger
 
 
-def generate_mean_immune_marker(folder, name):
-    worker = _GenerateMeanMarker(folder, name, ImmunePanel)
-    worker.process()
+def generate_mean_immune_marker(folder, name, from_unstacked:bool=False, n_workers:int=None):
+    '''
+    Mean of the non DAPI channels, per tile or once for the whole slide with from_unstacked.
+    Tiles, or the whole slide, whose channels and code are unchanged since the last run are skipped,
+    so AVGMARKER tiles keep their fingerprints and segmentation of them stays cached.
+    '''
+    worker = _GenerateMeanMarker(folder, name, ImmunePanel, n_workers)
+    # there are no channel tiles with zarr storage, segmentation reads windows from the store
+    if from_unstacked or DeepcellConfig.storage == 'zarr':
+        worker.process_unstacked()
+    else:
+        worker.process()
+
+
+def _accumulator_dtype(dtype, n:int):
+    # smallest integer type which can hold the sum of n images without overflow
+    dtype = np.dtype(dtype)
+    if not np.issubdtype(dtype, np.integer):
+        return np.promote_types(dtype, 'float32')
+    bound = int(np.iinfo(dtype).max) * n
+    for candidate in ('uint16', 'uint32', 'uint64') if np.iinfo(dtype).min >= 0 else ('int16', 'int32', 'int64'):
+        if np.iinfo(candidate).max >= bound and np.iinfo(candidate).bits >= dtype.itemsize * 8:
+            return np.dtype(candidate)
+    return np.dtype('float64')
+
+
+def _mean_channels(images):
+    '''Mean of same shaped images, accumulated in a compact fixed width type and returned in the input dtype.'''
+    acc = np.zeros(images[0].shape, dtype=_accumulator_dtype(images[0].dtype, len(images)))
+    for im in images:
+        np.add(acc, im, out=acc, casting='unsafe')
+    if np.issubdtype(images[0].dtype, np.integer):
+        return (acc // len(images)).astype(images[0].dtype)
+    return (acc / len(images)).astype(images[0].dtype)
 
 
 class _GenerateMeanMarker:
-    def __init__(self, folder, name, panel):
+    def __init__(self, folder, name, panel, n_workers=None):
         self.folder = folder
         self.name = name
         self.panel = panel
+        self.n_workers = n_workers if n_workers is not None else os.cpu_count()
+        self.channels = [channel for channel in self.panel.channel_map.values() if channel != "DAPI"]
 
     def process(self):
         dapi_tile_folder = pathlib.Path('tiled_for_deepcell', self.folder, f'{self.name}_DAPI')
         if not dapi_tile_folder.is_dir():
-            raise FileNotFoundError('{dapi_tile_folder} does not exist or is not a directory')
+            raise FileNotFoundError(f'{dapi_tile_folder} does not exist or is not a directory')
 
         pathlib.Path('tiled_for_deepcell', self.folder, f'{self.name}_AVGMARKER').mkdir(
             exist_ok=True, parents=True)
         
         pattern = re.compile(f'{self.name}_DAPI_(?P<x0>\d+)_(?P<y0>\d+)\.png')
-        for file in tqdm.tqdm(os.listdir(dapi_tile_folder)):
-            m = pattern.match(file)
-            self._process_tile(int(m['x0']), int(m['y0']))
+        tiles = [(int(m['x0']), int(m['y0'])) for m in map(pattern.match, os.listdir(dapi_tile_folder)) if m]
+        manifest = _TileManifest(pathlib.Path('tiled_for_deepcell', self.folder, f'.{self.name}_AVGMARKER.manifest.json'),
+            _panel_fields(self.panel), [__file__])
+        keys = {tile: manifest.key([self._channel_file(*tile, channel) for channel in self.channels]) for tile in tiles}
+        todo = [tile for tile in tiles if not manifest.is_fresh(f'{tile[0]}_{tile[1]}', keys[tile], self._outfile(*tile))]
+        if len(todo) < len(tiles):
+            _logger.info(f'Skipping {len(tiles) - len(todo)} unchanged tiles')
+        with _measure('mean_marker', sample=self.name) as m, ThreadPoolExecutor(self.n_workers) as executor:
+            for tile in executor.map(lambda tile: self._process_tile(*tile), todo):
+                manifest.record(f'{tile[0]}_{tile[1]}', keys[tile])
+            manifest.save()
+            m.count('tiles', len(todo))
+            m.count('skipped_tiles', len(tiles) - len(todo))
+
+    def process_unstacked(self):
+        '''
+        Generate AVGMARKER once for the whole slide, streamed in strips into unstacked/<folder>/<name>_AVGMARKER.tif,
+        or channels/AVGMARKER of the zarr store.
+        '''
+        inputs = [_channel_path(self.folder, self.name, channel) for channel in self.channels]
+        for p in inputs:
+            if not p.exists():
+                raise FileNotFoundError(f'{p} does not exist')
+        if DeepcellConfig.storage == 'zarr':
+            store = _ZarrStore(self.folder, self.name)
+            outfile = pathlib.Path(store.path, 'channels', 'AVGMARKER')
+            params = _config_fields('zarr_compression', 'zarr_compression_level', 'tile_width', 'tile_height')
+            manifest = pathlib.Path(store.path.parent, f'.{self.name}_AVGMARKER.manifest.json')
+        else:
+            outfile = pathlib.Path('unstacked', self.folder, f'{self.name}_AVGMARKER.tif')
+            params = _config_fields('tiff_tile_size', 'tiff_compression')
+            manifest = pathlib.Path(outfile.parent, f'.{self.name}_AVGMARKER.manifest.json')
+        cache = _StageCache(manifest, inputs, dict(_panel_fields(self.panel), **params),
+            [__file__, _tiff_window.__file__, _tiff_writer.__file__, _zarr_store.__file__], [outfile])
+        if cache.is_fresh():
+            _logger.info(f'{self.name} channels are unchanged, skipping')
+            return
+
+        readers = []
+        try:
+            for channel in self.channels:
+                readers.append(_channel_reader(self.folder, self.name, channel))
+            with _measure('mean_marker', sample=self.name, unstacked=True):
+                strips = self._iter_mean_strips(readers)
+                if DeepcellConfig.storage == 'zarr':
+                    store.write_strips('channels/AVGMARKER', strips, readers[0].shape, readers[0].dtype)
+                else:
+                    _write_tiled(outfile, strips, readers[0].shape, readers[0].dtype)
+        finally:
+            for reader in readers:
+                reader.close()
+        cache.record()
+
+    def _iter_mean_strips(self, readers):
+        with ThreadPoolExecutor(self.n_workers) as executor:
+            for y0 in range(0, readers[0].shape[0], DeepcellConfig.strip_height):
+                y1 = y0 + DeepcellConfig.strip_height
+                yield y0, _mean_channels(list(executor.map(lambda reader: reader.window(y0, y1), readers)))
 
-        
     def _process_tile(self, x0:int, y0:int):
-        mean_im = None
-        n_channels = 0
-        
-        for _, channel in self.panel.channel_map.items():
-            if channel == "DAPI":
-                continue
-            new_im = self._get_channel(x0, y0, channel)
-
-            if mean_im is None:
-                mean_im = new_im
-            else:
-                mean_im = mean_im + new_im
-            n_channels += 1
-        
-        mean_im = mean_im / n_channels
-        mean_im = mean_im.astype('uint8')
-        tifffile.imwrite(
-            pathlib.Path('tiled_for_deepcell', self.folder,
-                f'{self.name}_AVGMARKER',
-                f'{self.name}_AVGMARKER_{x0}_{y0}.png'),
-            mean_im)
+        with _measure('mean_marker', 'tile', sample=self.name, x0=x0, y0=y0):
+            mean_im = _mean_channels([self._get_channel(x0, y0, channel) for channel in self.channels])
+            tifffile.imwrite(self._outfile(x0, y0), mean_im)
+        return x0, y0
+
+    def _outfile(self, x0:int, y0:int):
+        return pathlib.Path('tiled_for_deepcell', self.folder, f'{self.name}_AVGMARKER', f'{self.name}_AVGMARKER_{x0}_{y0}.png')
+
+    def _channel_file(self, x0:int, y0:int, channel:str):
+        return pathlib.Path('tiled_for_deepcell', self.folder, f'{self.name}_{channel}', f'{self.name}_{channel}_{x0}_{y0}.png')
 
     def _get_channel(self, x0:int, y0:int, channel:str):
-        image_file = pathlib.Path('tiled_for_deepcell', self.folder,
-            f'{self.name}_{channel}',
-            f'{self.name}_{channel}_{x0}_{y0}.png')
+        image_file = self._channel_file(x0, y0, channel)
         if not image_file.is_file() or not image_file.exists():
             raise FileNotFoundError(f'{image_file} was not found or is a directory')
         im = tifffile.imread(image_file)
         if not im.ndim == 2:
             raise ValueError(f'{image_file} should have ndim=2, not {im.ndim}')
-        return im.astype(int)
+        return im
@@ -1,9 +1,16 @@
-import tifffile
 import skimage.segmentation
+import tifffile
 import pathlib
+import tempfile
+import math
+import os
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 
 from .config import DeepcellConfig
+from ._helpers._zarr_store import _labels_reader, _labels_path, _channel_reader, _channel_path
+from ._helpers._tiff_writer import _write_tiled
+from .metrics import _measure, _profile
 
 
 def make_outline_overlay(folder, name,
@@ -11,13 +18,20 @@ def make_outline_overlay(folder, name,
         nucleus_channel:str='DAPI',
         membrane_channel:str='ECad',
         interior_threshold:float=None,
-        maxima_threshold:float=None):
-    worker = _OutlineOverlayWorker(folder, name, compartment, nucleus_channel, membrane_channel, interior_threshold, maxima_threshold)
+        maxima_threshold:float=None,
+        n_workers:int=None):
+    worker = _OutlineOverlayWorker(folder, name, compartment, nucleus_channel, membrane_channel, interior_threshold, maxima_threshold, n_workers)
     worker.process()
 
 
 class _OutlineOverlayWorker:
-    def __init__(self, folder, name, compartment, nucleus_channel, membrane_channel, interior_threshold, maxima_threshold):
+    '''
+    Renders cell outlines over the membrane (green) and nucleus (blue) channels as uint8 RGB.
+    Tiles are rendered in parallel with a one pixel halo for the boundaries, scaled by global channel maxima
+    from a strip-wise pre-pass, and written as a tiled pyramidal OME-TIFF.
+    The boundaries of each tile are also kept for the outline mask, so they are only found once.
+    '''
+    def __init__(self, folder, name, compartment, nucleus_channel, membrane_channel, interior_threshold, maxima_threshold, n_workers=None):
         self.folder = folder
         self.name = name
         self.compartment = compartment
@@ -25,37 +39,100 @@ class _OutlineOverlayWorker:
         self.membrane_channel = membrane_channel
         self.interior_threshold = interior_threshold if interior_threshold is not None else DeepcellConfig.interior_threshold
         self.maxima_threshold = maxima_threshold if maxima_threshold is not None else DeepcellConfig.maxima_threshold
+        self.n_workers = n_workers if n_workers is not None else os.cpu_count()
 
         self.deepcell_basename = f'{name}_{compartment}_{nucleus_channel}_{membrane_channel}_{str(int(self.interior_threshold*1000))}_{str(int(self.maxima_threshold*1000))}'
-        self.labelled_file = pathlib.Path(
-            'deepcell_labelled', self.folder, self.name, f'{self.deepcell_basename}.tif')
-        if not self.labelled_file.is_file():
-            raise FileNotFoundError(f'{self.labelled_file} does not exist or is a directory')
-        self.nucleus_file = pathlib.Path(
-            'unstacked', self.folder, f'{self.name}_{self.nucleus_channel}.tif')
-        if not self.nucleus_file.is_file():
-            raise FileNotFoundError(f'{self.nucleus_file} does not exist or is a directory')
-        self.membrane_file = pathlib.Path(
-            'unstacked', self.folder, f'{self.name}_{self.membrane_channel}.tif')
-        if not self.membrane_file.is_file():
-            raise FileNotFoundError(f'{self.membrane_file} does not exist or is a directory')
+        self.labelled_file = _labels_path(self.folder, self.name, self.deepcell_basename)
+        if not self.labelled_file.exists():
+            raise FileNotFoundError(f'{self.labelled_file} does not exist')
+        self.nucleus_file = _channel_path(self.folder, self.name, self.nucleus_channel)
+        if not self.nucleus_file.exists():
+            raise FileNotFoundError(f'{self.nucleus_file} does not exist')
+        self.membrane_file = _channel_path(self.folder, self.name, self.membrane_channel)
+        if not self.membrane_file.exists():
+            raise FileNotFoundError(f'{self.membrane_file} does not exist')
 
     def process(self):
         outfolder = pathlib.Path('outlined', self.folder)
         outfolder.mkdir(exist_ok=True, parents=True)
-        outfile = pathlib.Path(outfolder, f'{self.deepcell_basename}_outlined.qptiff')
+        outfile = pathlib.Path(outfolder, f'{self.deepcell_basename}_outlined.ome.tif')
+
+        with _measure('overlay', sample=self.name) as m, \
+                _labels_reader(self.folder, self.name, self.deepcell_basename) as labelled, \
+                _channel_reader(self.folder, self.name, self.nucleus_channel) as nuc, \
+                _channel_reader(self.folder, self.name, self.membrane_channel) as mem, \
+                tempfile.TemporaryDirectory() as tmp:
+            self.labelled, self.nuc, self.mem = labelled, nuc, mem
+            self.nuc_max = max(np.max(strip) for _, strip in nuc.iter_strips(DeepcellConfig.strip_height))
+            self.mem_max = max(np.max(strip) for _, strip in mem.iter_strips(DeepcellConfig.strip_height))
+
+            tile_size = DeepcellConfig.tiff_tile_size
+            n_levels = max(0, math.ceil(math.log2(max(labelled.shape) / tile_size)))
+            levels = [np.memmap(pathlib.Path(tmp, f'level_{i}.raw'), dtype='uint8', mode='w+',
+                    shape=(math.ceil(labelled.shape[0] / 2**i), math.ceil(labelled.shape[1] / 2**i), 3))
+                for i in range(1, n_levels + 1)]
+            mask = np.memmap(pathlib.Path(tmp, 'outline_mask.raw'), dtype='uint8', mode='w+', shape=labelled.shape)
+            options = dict(tile=(tile_size, tile_size), photometric='rgb', compression=DeepcellConfig.tiff_compression)
+            with tifffile.TiffWriter(outfile, bigtiff=True, ome=True) as tif:
+                tif.write(self._iter_rgb_tiles(mask, levels[0] if levels else None),
+                    shape=labelled.shape + (3,), dtype='uint8', subifds=n_levels, metadata={'axes': 'YXS'}, **options)
+                for i, level in enumerate(levels):
+                    if i > 0:
+                        for y in range(0, level.shape[0], DeepcellConfig.strip_height):
+                            level[y:y+DeepcellConfig.strip_height] = _downsample(
+                                levels[i-1][2*y:2*(y+DeepcellConfig.strip_height)])[:level.shape[0]-y, :level.shape[1]]
+                    tif.write(level, subfiletype=1, **options)
+
+            _write_tiled(pathlib.Path(outfolder, f'{self.deepcell_basename}_outline_mask.tif'),
+                ((y, mask[y:y+DeepcellConfig.strip_height]) for y in range(0, mask.shape[0], DeepcellConfig.strip_height)),
+                labelled.shape, 'uint8')
+            m.count('tiles', self.n_tiles)
+            m.count('levels', n_levels + 1)
+
+    def _outlines(self, y0, y1, x0, x1):
+        # one pixel of halo either side so boundaries match those of the whole image
+        shape = self.labelled.shape
+        hy0, hy1, hx0, hx1 = max(0, y0 - 1), min(y1 + 1, shape[0]), max(0, x0 - 1), min(x1 + 1, shape[1])
+        outlines = skimage.segmentation.find_boundaries(
+            self.labelled.window(hy0, hy1, hx0, hx1), connectivity=1, mode='inner')
+        return outlines[y0-hy0:y1-hy0, x0-hx0:x1-hx0]
+
+    def _render_tile(self, window):
+        y0, y1, x0, x1 = window
+        with _measure('overlay', 'tile', sample=self.name, x0=x0, y0=y0), _profile('overlay.render_tile'):
+            tile_size = DeepcellConfig.tiff_tile_size
+            rgb = np.zeros((tile_size, tile_size, 3), dtype='uint8')
+            rgb[:y1-y0, :x1-x0, 1] = _scale(self.mem.window(y0, y1, x0, x1), self.mem_max)
+            rgb[:y1-y0, :x1-x0, 2] = _scale(self.nuc.window(y0, y1, x0, x1), self.nuc_max)
+            outlines = self._outlines(y0, y1, x0, x1)
+            rgb[:y1-y0, :x1-x0][outlines] = 255
+        return rgb, outlines
+
+    def _iter_rgb_tiles(self, mask, level1=None):
+        tile_size = DeepcellConfig.tiff_tile_size
+        height, width = self.labelled.shape
+        rows = [[(y, min(y + tile_size, height), x, min(x + tile_size, width)) for x in range(0, width, tile_size)]
+            for y in range(0, height, tile_size)]
+        self.n_tiles = sum(len(row) for row in rows)
+        with ThreadPoolExecutor(self.n_workers) as executor:
+            # render the next tile row while the current one is compressed and written
+            pending = executor.map(self._render_tile, rows[0]) if rows else None
+            for i in range(len(rows)):
+                tiles = list(pending)
+                if i + 1 < len(rows):
+                    pending = executor.map(self._render_tile, rows[i + 1])
+                for (y0, y1, x0, x1), (tile, outlines) in zip(rows[i], tiles):
+                    mask[y0:y1, x0:x1] = outlines
+                    if level1 is not None:
+                        level1[y0//2:(y1+1)//2, x0//2:(x1+1)//2] = _downsample(tile)[:(y1-y0+1)//2, :(x1-x0+1)//2]
+                    yield tile
 
-        labelled = tifffile.imread(self.labelled_file)
-        outlines = skimage.segmentation.find_boundaries(labelled, connectivity=1, mode='inner')
-        outlines[outlines>0] = 1
 
-        nuc = tifffile.imread(self.nucleus_file)
-        mem = tifffile.imread(self.membrane_file)
+def _scale(im, maximum):
+    return (im.astype('float32') * (255 / maximum)).astype('uint8') if maximum > 0 else np.zeros(im.shape, dtype='uint8')
 
-        rgb_image = np.stack((mem*0, mem/np.max(mem),nuc/np.max(nuc)), axis=-1)
-        #rgb_image = np.expand_dims(rgb_image, 0)
 
-        rgb_image[outlines>0, :] = 1
-        tifffile.imwrite(outfile, rgb_image)
-        tifffile.imwrite(pathlib.Path(outfolder, f'{self.deepcell_basename}_outline_mask.qptiff'),
-            outlines)
+def _downsample(rgb):
+    pad = np.zeros((rgb.shape[0] + rgb.shape[0] % 2, rgb.shape[1] + rgb.shape[1] % 2, 3), dtype='uint16')
+    pad[:rgb.shape[0], :rgb.shape[1]] = rgb
+    return (pad.reshape(pad.shape[0]//2, 2, pad.shape[1]//2, 2, 3).sum(axis=(1, 3)) // 4).astype('uint8')
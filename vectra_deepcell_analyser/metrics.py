@@ -0,0 +1,237 @@
+'''
+Per stage and per tile metrics.
+
+Every stage records wall and CPU time, peak RSS, bytes read and written and item counts (tiles, cells, seams),
+and tiles or batches within a stage record their own time and counts, with tiles_per_s where tiles are counted.
+A stage that raises still records, with the exception in an error field. Records are plain dicts sent to each
+registered sink. By default they go to the 'vectra_deepcell_analyser' logger, stages at INFO and tiles at DEBUG,
+so nothing is printed unless logging is configured:
+
+    import logging
+    logging.basicConfig(level=logging.INFO)
+    vda.metrics.add_sink(vda.metrics.JsonLinesSink('metrics.jsonl'))
+
+Named hot paths (e.g. 'stitch.resolve_seam') can be profiled with cProfile:
+
+    vda.metrics.enable_profiling('stitch.resolve_seam', output_dir='profiles')
+'''
+import atexit
+import contextlib
+import cProfile
+import json
+import logging
+import pathlib
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    # not available on windows, peak RSS is not recorded
+    resource = None
+
+
+_logger = logging.getLogger('vectra_deepcell_analyser')
+
+
+class LoggingSink:
+    '''Log one line per record, stages at `level` and tiles or batches at `item_level`.'''
+    def __init__(self, logger:logging.Logger=None, level:int=logging.INFO, item_level:int=logging.DEBUG):
+        self.logger = logger if logger is not None else _logger
+        self.level = level
+        self.item_level = item_level
+
+    def __call__(self, record:dict):
+        level = self.level if record['level'] == 'stage' else self.item_level
+        if not self.logger.isEnabledFor(level):
+            return
+        fields = ' '.join(f'{k}={v}' for k, v in record.items()
+            if k not in ('stage', 'level', 'time', 'counts') and v is not None)
+        counts = ' '.join(f'{k}={v}' for k, v in record['counts'].items())
+        self.logger.log(level, f"[{record['stage']}] {fields} {counts}".rstrip())
+
+
+class JsonLinesSink:
+    '''Append each record as one line of JSON.'''
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+        self.lock = threading.Lock()
+
+    def __call__(self, record:dict):
+        line = json.dumps(record, default=str)
+        with self.lock, open(self.path, 'a') as f:
+            f.write(line + '\n')
+
+
+class Collector:
+    '''Keep records in memory, e.g. for tests or to aggregate in-process.'''
+    def __init__(self):
+        self.records = []
+        self.lock = threading.Lock()
+
+    def __call__(self, record:dict):
+        with self.lock:
+            self.records.append(record)
+
+    def drain(self):
+        with self.lock:
+            records, self.records = self.records, []
+        return records
+
+
+_sinks = [LoggingSink()]
+
+
+def add_sink(sink):
+    '''Register a callable taking a record dict.'''
+    _sinks.append(sink)
+    return sink
+
+
+def remove_sink(sink):
+    _sinks.remove(sink)
+
+
+def clear_sinks():
+    _sinks.clear()
+
+
+def _emit(record:dict):
+    for sink in list(_sinks):
+        sink(record)
+
+
+@contextlib.contextmanager
+def _collecting():
+    '''Collect records emitted in this process instead of sending them to the sinks, e.g. to return them from a worker process.'''
+    global _sinks
+    collector = Collector()
+    sinks, _sinks = _sinks, [collector]
+    try:
+        yield collector
+    finally:
+        _sinks = sinks
+
+
+def _peak_rss():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macos
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def _io_bytes():
+    try:
+        with open('/proc/self/io') as f:
+            fields = dict(line.split(': ') for line in f.read().splitlines())
+        return int(fields['rchar']), int(fields['wchar'])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+class _Record:
+    def __init__(self):
+        self.counts = {}
+        self.fields = {}
+
+    def count(self, key:str, n:int=1):
+        self.counts[key] = self.counts.get(key, 0) + int(n)
+
+    def set(self, **fields):
+        self.fields.update(fields)
+
+
+@contextlib.contextmanager
+def _measure(stage:str, level:str='stage', **fields):
+    '''
+    Record the time of the enclosed block. Stage level records also take process CPU time, peak RSS
+    and bytes read and written, which are process wide. Tile level records take the thread CPU time only.
+    Yields a record to add counts (record.count('cells', n)) or fields to. Records counting tiles also get tiles_per_s.
+    The record is emitted even if the block raises, with the exception in its error field.
+    '''
+    record = _Record()
+    start = time.time()
+    wall = time.perf_counter()
+    if level == 'stage':
+        cpu = time.process_time()
+        read, written = _io_bytes()
+    else:
+        cpu = time.thread_time()
+    error = None
+    try:
+        yield record
+    except BaseException as e:
+        error = f'{type(e).__name__}: {e}'
+        raise
+    finally:
+        out = {'stage': stage, 'level': level, 'time': start}
+        out.update(fields)
+        out.update(record.fields)
+        out['wall_s'] = round(time.perf_counter() - wall, 6)
+        if level == 'stage':
+            out['cpu_s'] = round(time.process_time() - cpu, 6)
+            rss = _peak_rss()
+            out['peak_rss_mb'] = round(rss / 2**20, 1) if rss is not None else None
+            read1, written1 = _io_bytes()
+            out['read_bytes'] = read1 - read if read is not None else None
+            out['write_bytes'] = written1 - written if written is not None else None
+        else:
+            out['cpu_s'] = round(time.thread_time() - cpu, 6)
+        if 'tiles' in record.counts and out['wall_s'] > 0:
+            out['tiles_per_s'] = round(record.counts['tiles'] / out['wall_s'], 3)
+        if error is not None:
+            out['error'] = error
+        out['counts'] = record.counts
+        _emit(out)
+
+
+_profiles = {}
+_profile_dir = None
+_profile_lock = threading.Lock()
+_profiling = threading.local()
+
+
+def enable_profiling(*names:str, output_dir='profiles'):
+    '''
+    Profile the named hot paths with cProfile, accumulating over all calls in this process.
+    Stats are written to <output_dir>/<name>.prof by dump_profiles, and at exit.
+    '''
+    global _profile_dir
+    _profile_dir = pathlib.Path(output_dir)
+    for name in names:
+        _profiles.setdefault(name, cProfile.Profile())
+
+
+def disable_profiling():
+    dump_profiles()
+    _profiles.clear()
+
+
+def dump_profiles():
+    for name, profile in _profiles.items():
+        _profile_dir.mkdir(exist_ok=True, parents=True)
+        profile.dump_stats(pathlib.Path(_profile_dir, f'{name}.prof'))
+
+
+atexit.register(lambda: dump_profiles() if _profiles else None)
+
+
+@contextlib.contextmanager
+def _profile(name:str):
+    '''Profile the enclosed block if `name` is enabled. Only one profiled block runs at a time, others run unprofiled.'''
+    profile = _profiles.get(name)
+    if profile is None or getattr(_profiling, 'active', False) or not _profile_lock.acquire(blocking=False):
+        yield
+        return
+    _profiling.active = True
+    try:
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+    finally:
+        _profiling.active = False
+        _profile_lock.release()
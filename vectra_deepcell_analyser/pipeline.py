@@ -0,0 +1,375 @@
+import pathlib
+import inspect
+
+from .config import DeepcellConfig
+from .panel_data import ImmunePanel
+from .metrics import _measure, _logger
+from ._helpers._cache import _StageCache, _config_fields
+from ._helpers._zarr_store import _ZarrStore, _channel_path, _channel_reader
+from ._helpers import _seams, _union_find, _zarr_store
+from ._helpers._tiff_writer import _write_tiled
+from ._helpers._tiff_window import _TiffWindowReader
+from .segment_with_deepcell import _DeepcellWorker, _normalise
+from .segmenters import _get_segmenter
+from .generate_mean_marker import _mean_channels
+from .stitch_deepcell_labels import _StitchDeepcellLabels
+from .calculate_centroids import calculate_centroids
+from .compute_markers import compute_immune_markers
+from .detect_tissue import _tissue_inputs, _occupied_tiles
+
+
+_TILE_FIELDS = ('tile_width', 'tile_height', 'tile_padding_x', 'tile_padding_y')
+
+
+def run_pipeline_in_memory(folder, name,
+        compartment:str='whole-cell',
+        nucleus_channel:str='DAPI',
+        membrane_channel:str='ECad',
+        interior_threshold:float=None,
+        maxima_threshold:float=None,
+        batch_size:int=None,
+        centroids:bool=True,
+        markers:bool=True,
+        backend:str='mesmer',
+        n_workers:int=None,
+        threads_per_worker:int=None):
+    '''
+    Tile, segment and stitch without writing intermediate tiles.
+    Tiles are views into the (memory mapped where possible) unstacked channel images and label tiles
+    are passed straight to the stitcher, one tile row at a time. Only the stitched label image and the tables are written.
+    With n_workers > 1 (default DeepcellConfig.n_workers) the tiles of each row are segmented across one pool of spawned
+    workers kept for the whole slide, each reading its windows from the channels itself.
+
+    Input: 'unstacked/<folder>/<name>_<marker>.tif', or the qptiff with DeepcellConfig.channels_from_qptiff
+    Output: 'deepcell_labelled/<folder>/<name>/<name>_<deepcell config>.tif'
+            'centroids/...' and 'output/...' tables if centroids/markers are True
+    '''
+    worker = _InMemoryPipeline(folder, name, ImmunePanel, compartment, nucleus_channel, membrane_channel,
+        interior_threshold, maxima_threshold, batch_size, backend)
+    worker.process(n_workers, threads_per_worker)
+    if centroids:
+        calculate_centroids(folder, name, compartment, nucleus_channel, membrane_channel, interior_threshold, maxima_threshold)
+    if markers:
+        compute_immune_markers(folder, name, compartment, nucleus_channel, membrane_channel, interior_threshold, maxima_threshold)
+
+
+class _InMemoryPipeline:
+    def __init__(self, folder, name, panel, compartment, nucleus_channel, membrane_channel, interior_threshold, maxima_threshold, batch_size,
+            backend='mesmer'):
+        self.folder = folder
+        self.name = name
+        self.panel = panel
+        self.compartment = compartment
+        self.nucleus_channel = nucleus_channel
+        self.membrane_channel = membrane_channel
+        self.interior_threshold = interior_threshold
+        self.maxima_threshold = maxima_threshold
+        self.batch_size = batch_size
+        self.backend = backend
+
+        markers = [nucleus_channel]
+        if membrane_channel == 'AVGMARKER':
+            markers += [m for m in self.panel.channel_map.values() if m != 'DAPI']
+        else:
+            markers.append(membrane_channel)
+        self.channel_files = {}
+        for marker in markers:
+            p = _channel_path(self.folder, self.name, marker)
+            if not p.exists():
+                raise FileNotFoundError(f'{p} does not exist')
+            self.channel_files[marker] = p
+
+    def process(self, n_workers:int=None, threads_per_worker:int=None):
+        channels = {marker: _channel_reader(self.folder, self.name, marker) for marker in self.channel_files}
+        try:
+            segmenter = _InMemoryDeepcellWorker(self.folder, self.name, channels,
+                self.compartment, self.nucleus_channel, self.membrane_channel,
+                self.interior_threshold, self.maxima_threshold, self.batch_size, self.backend)
+            stitcher = _InMemoryStitcher(self.folder, self.name, segmenter, channels[self.nucleus_channel].shape,
+                self.compartment, self.nucleus_channel, self.membrane_channel,
+                self.interior_threshold, self.maxima_threshold)
+            # tile rows are segmented as the stitcher reaches them, so this record includes stitching
+            with _measure('segment', sample=self.name, in_memory=True) as m, \
+                    segmenter._runner(n_workers, threads_per_worker) as run:
+                segmenter.run = run
+                stitcher.process()
+                m.count('tiles', segmenter.n_tiles)
+        finally:
+            for reader in channels.values():
+                reader.close()
+
+
+class _InMemoryDeepcellWorker(_DeepcellWorker):
+    def __init__(self, folder, name, channels, compartment, nucleus_channel, membrane_channel, interior_threshold, maxima_threshold, batch_size=None,
+            backend='mesmer'):
+        self.folder = folder
+        self.name = name
+        self.channels = channels
+        self.compartment = compartment
+        self.nucleus_channel = nucleus_channel
+        self.membrane_channel = membrane_channel
+        self.interior_threshold = interior_threshold if interior_threshold is not None else DeepcellConfig.interior_threshold
+        self.maxima_threshold = maxima_threshold if maxima_threshold is not None else DeepcellConfig.maxima_threshold
+        self.batch_size = batch_size if batch_size is not None else DeepcellConfig.batch_size
+        self.backend = backend
+        self.engine_class = _get_segmenter(backend)
+        self.shape = channels[nucleus_channel].shape
+        # tile geometry of the parent process, so pool workers cut and place tiles on the same grid
+        self.grid = _config_fields(*_TILE_FIELDS)
+        self.labels = {}
+        self.n_tiles = 0
+        self.run = None
+
+        self.outfile_basename = f'{self.name}_{self.compartment}_{self.nucleus_channel}_{self.membrane_channel}_{str(int(self.interior_threshold*1000))}_{str(int(self.maxima_threshold*1000))}'
+        self.raw_basename = f'{self.name}_{self.nucleus_channel}_{self.membrane_channel}'
+
+    def segment_row(self, y:int):
+        '''
+        Segment the tiles of the tile row at grid position y, returning their labels by padded origin.
+        Only one tile row is held, the previous row's labels are released first.
+        Batches go to self.run, a _runner of the whole slide, and pool workers send their label tiles back.
+        '''
+        self.labels = {}
+        with _measure('segment', 'row', sample=self.name, y=y) as m:
+            for batch in self.run(list(self._batches(self._tiles([y])))):
+                m.count('tiles', len(batch))
+        self.n_tiles += m.counts.get('tiles', 0)
+        return self.labels
+
+    def _window(self, x0:int, y0:int):
+        # tiles are named by their padded origin, recover the grid position to get the padded extent
+        x, y = self._grid_origin(x0, y0)
+        x1 = min(x + self.grid['tile_width'] + self.grid['tile_padding_x'], self.shape[1])
+        y1 = min(y + self.grid['tile_height'] + self.grid['tile_padding_y'], self.shape[0])
+        return slice(y0, y1), slice(x0, x1)
+
+    def _grid_origin(self, x0:int, y0:int):
+        return (x0 + self.grid['tile_padding_x'] if x0 > 0 else 0), (y0 + self.grid['tile_padding_y'] if y0 > 0 else 0)
+
+    def _tiles(self, rows=None):
+        occupied = _occupied_tiles(self.folder, self.name)
+        rows = range(0, self.shape[0], self.grid['tile_height']) if rows is None else rows
+        for y in rows:
+            for x in range(0, self.shape[1], self.grid['tile_width']):
+                if occupied is not None and (x, y) not in occupied:
+                    continue
+                yield max(0, x - self.grid['tile_padding_x']), max(0, y - self.grid['tile_padding_y'])
+
+    def _tile_shape(self, x0:int, y0:int):
+        ys, xs = self._window(x0, y0)
+        return ys.stop - ys.start, xs.stop - xs.start
+
+    def _batches(self, tiles):
+        pending = {}
+        for x0, y0 in tiles:
+            shape = self._tile_shape(x0, y0)
+            batch = pending.setdefault(shape, [])
+            batch.append((x0, y0))
+            if len(batch) >= self.batch_size:
+                yield pending.pop(shape)
+        yield from pending.values()
+
+    def _load_tile(self, x0:int, y0:int):
+        window = self._window(x0, y0)
+        nuc = self.channels[self.nucleus_channel][window]
+        if self.membrane_channel == 'AVGMARKER':
+            others = [c for marker, c in self.channels.items() if marker != self.nucleus_channel]
+            mem = _mean_channels([c[window] for c in others])
+        else:
+            mem = self.channels[self.membrane_channel][window]
+        return _normalise(nuc), _normalise(mem)
+
+    def _write_tile(self, x0:int, y0:int, labels):
+        self.labels[(x0, y0)] = labels
+
+    def _batch_result(self, batch):
+        return batch, [self.labels.pop(tile) for tile in batch]
+
+    def _receive_batch(self, result):
+        batch, labels = result
+        self.labels.update(zip(batch, labels))
+        return batch
+
+    def __getstate__(self):
+        # pool workers get the channels, which reopen themselves, but not the parent's runner or labels
+        return dict(self.__dict__, run=None, labels={})
+
+
+class _InMemoryStitcher(_StitchDeepcellLabels):
+    '''
+    Stitches label tiles as the segmenter produces them, asking it for each tile row in turn with segment_row(y).
+    Tiles are segmented once, so only the tile row being stitched is held, and the first pass keeps its strips
+    in a scratch tiff beside the output for relabelling.
+    '''
+    def __init__(self, folder, name, segmenter, shape, compartment, nucleus_channel, membrane_channel, interior_threshold, maxima_threshold):
+        self.folder = folder
+        self.name = name
+        self.segmenter = segmenter
+        self.tiles, self.tiles_y = None, None
+        self.compartment = compartment
+        self.nucleus_channel = nucleus_channel
+        self.membrane_channel = membrane_channel
+        self.interior_threshold = interior_threshold if interior_threshold is not None else DeepcellConfig.interior_threshold
+        self.maxima_threshold = maxima_threshold if maxima_threshold is not None else DeepcellConfig.maxima_threshold
+        self.original_shape = shape
+
+        self.tile_basename = f'{name}_{compartment}_{nucleus_channel}_{membrane_channel}_{str(int(self.interior_threshold*1000))}_{str(int(self.maxima_threshold*1000))}'
+
+    def process(self):
+        self._stitch()
+
+    def _keep_strips(self, strips):
+        # tiles are only segmented once, so rather than recomposing tile rows the unrelabelled strips are kept in a scratch tiff
+        self.scratch = pathlib.Path('deepcell_labelled', self.folder, self.name, f'.{self.tile_basename}.unstitched.tif')
+        self.scratch.parent.mkdir(exist_ok=True, parents=True)
+        try:
+            _write_tiled(self.scratch, strips, self.original_shape, 'uint32')
+        except BaseException:
+            self.scratch.unlink(missing_ok=True)
+            raise
+
+    def _kept_strips(self):
+        try:
+            with _TiffWindowReader(self.scratch) as reader:
+                yield from reader.iter_strips(DeepcellConfig.tile_height)
+        finally:
+            self.scratch.unlink(missing_ok=True)
+
+    def _load_tile(self, x:int, y:int):
+        if self.tiles_y != y:
+            # the previous tile row is stitched, release it before segmenting the next
+            self.tiles = None
+            self.tiles, self.tiles_y = self.segmenter.segment_row(y), y
+        return self.tiles[self._origin(x, y)]
+
+
+class _ZarrDeepcellWorker(_InMemoryDeepcellWorker):
+    '''
+    Segments windows read straight from channels/<marker> of the zarr store, with no tiling stage.
+    Each label tile is written to its own chunk of tiles/<deepcell basename>, addressed by its tile row and column,
+    so pool workers write concurrently without sharing a chunk. The tile geometry is stored in the array's attributes.
+    '''
+    def __init__(self, folder, name, compartment, nucleus_channel, membrane_channel, interior_threshold, maxima_threshold, batch_size=None,
+            backend='mesmer'):
+        self.store = _ZarrStore(folder, name)
+        markers = [nucleus_channel, membrane_channel]
+        if membrane_channel == 'AVGMARKER' and not self.store.exists('channels/AVGMARKER'):
+            # averaged per window from the other channels
+            markers = [nucleus_channel] + [m for m in ImmunePanel.channel_map.values() if m != 'DAPI']
+        channels = {marker: self.store.open(f'channels/{marker}') for marker in markers}
+        super().__init__(folder, name, channels, compartment, nucleus_channel, membrane_channel,
+            interior_threshold, maxima_threshold, batch_size, backend)
+
+    def process(self, n_workers:int=None, threads_per_worker:int=None):
+        '''Segment every tile, unless the channels, thresholds and code are unchanged since the last run.'''
+        key = f'tiles/{self.outfile_basename}'
+        inputs = [_channel_path(self.folder, self.name, marker) for marker in self.channels] + _tissue_inputs(self.folder, self.name)
+        tile_fields = _config_fields('tile_width', 'tile_height', 'tile_padding_x', 'tile_padding_y', 'skip_background_tiles',
+            *self.engine_class.config_fields)
+        raw = self._caches_raw()
+        if raw:
+            self._predict_raw_store(inputs, tile_fields, n_workers, threads_per_worker)
+            # labels then depend only on the stored outputs
+            inputs = [pathlib.Path(self.store.path, 'raw', self.raw_basename)]
+        cache = _StageCache(pathlib.Path(self.store.path.parent, f'.{self.outfile_basename}_tiles.manifest.json'),
+            inputs,
+            dict(compartment=self.compartment, interior_threshold=self.interior_threshold, maxima_threshold=self.maxima_threshold,
+                backend=self.backend, **tile_fields),
+            [__file__, inspect.getfile(_DeepcellWorker), inspect.getfile(self.engine_class), inspect.getfile(_mean_channels), _zarr_store.__file__],
+            [pathlib.Path(self.store.path, key)])
+        if cache.is_fresh():
+            _logger.info(f'{self.store.path} channels are unchanged, skipping')
+            return
+
+        tile_shape = (min(self.grid['tile_height'] + 2*self.grid['tile_padding_y'], self.shape[0]),
+            min(self.grid['tile_width'] + 2*self.grid['tile_padding_x'], self.shape[1]))
+        grid = (-(-self.shape[0] // self.grid['tile_height']), -(-self.shape[1] // self.grid['tile_width']))
+        self.tiles_array = self.store.create(key, grid + tile_shape, 'int32', chunks=(1, 1) + tile_shape)
+        self.tiles_array.attrs.update(self.grid)
+        with _measure('segment', sample=self.name, storage='zarr') as m:
+            if raw:
+                batches = self._postprocess_run(list(self._tiles()))
+            else:
+                batches = self._run(list(self._batches(self._tiles())), n_workers, threads_per_worker)
+            for batch in batches:
+                m.count('tiles', len(batch))
+                m.count('batches')
+        cache.record()
+
+    def _predict_raw_store(self, inputs, tile_fields, n_workers, threads_per_worker):
+        '''Store the raw outputs of every tile in raw/<raw basename>/<x0>_<y0>, unless the channels and model settings are unchanged.'''
+        cache = _StageCache(pathlib.Path(self.store.path.parent, f'.{self.raw_basename}_raw.manifest.json'),
+            inputs, dict(backend=self.backend, **tile_fields),
+            [__file__, inspect.getfile(_DeepcellWorker), inspect.getfile(self.engine_class)],
+            [pathlib.Path(self.store.path, 'raw', self.raw_basename)])
+        if cache.is_fresh():
+            _logger.info(f'Reusing the model outputs in {self.store.path}')
+            return
+        self.stage = 'predict'
+        with _measure('predict', sample=self.name, storage='zarr') as m:
+            for batch in self._run(list(self._batches(self._tiles())), n_workers, threads_per_worker):
+                m.count('tiles', len(batch))
+                m.count('batches')
+        self.stage = 'segment'
+        cache.record()
+
+    # label tiles are written to the store by the pool workers
+    _batch_result = _DeepcellWorker._batch_result
+    _receive_batch = _DeepcellWorker._receive_batch
+
+    def _write_raw(self, x0:int, y0:int, raw):
+        # one array per tile, as raw outputs are at the model resolution
+        self.store.create(f'raw/{self.raw_basename}/{x0}_{y0}', raw.shape, 'float16', chunks=raw.shape)[...] = raw
+
+    def _load_raw(self, x0:int, y0:int):
+        return self.store.open(f'raw/{self.raw_basename}/{x0}_{y0}')[...]
+
+    def _write_tile(self, x0:int, y0:int, labels):
+        x, y = self._grid_origin(x0, y0)
+        row, column = y // self.grid['tile_height'], x // self.grid['tile_width']
+        if row >= self.tiles_array.shape[0] or column >= self.tiles_array.shape[1]:
+            raise IndexError(f'Tile ({x0}, {y0}) is outside the {self.tiles_array.shape[:2]} tile grid')
+        labels = labels.reshape(labels.shape[:2])
+        self.tiles_array[row, column, :labels.shape[0], :labels.shape[1]] = labels
+
+
+class _ZarrStitcher(_InMemoryStitcher):
+    '''Stitches tiles/<deepcell basename> of the zarr store into labels/<deepcell basename>, chunk by chunk.'''
+    def __init__(self, folder, name, compartment, nucleus_channel, membrane_channel, interior_threshold, maxima_threshold):
+        self.store = _ZarrStore(folder, name)
+        shape = self.store.open(f'channels/{nucleus_channel}').shape
+        super().__init__(folder, name, None, shape, compartment, nucleus_channel, membrane_channel, interior_threshold, maxima_threshold)
+        self.tiles = self.store.open(f'tiles/{self.tile_basename}')
+        # seams and tile cores are placed by DeepcellConfig, which must be the grid the tiles were written on
+        self.grid = {k: self.tiles.attrs.get(k) for k in _TILE_FIELDS}
+        if self.grid != _config_fields(*_TILE_FIELDS):
+            raise ValueError(f'tiles/{self.tile_basename} in {self.store.path} were segmented on the tile grid {self.grid}, '
+                f'but DeepcellConfig has {_config_fields(*_TILE_FIELDS)}. Rerun segment_with_deepcell')
+
+    def process(self):
+        '''Stitch, unless the label tiles, stitching settings and code are unchanged since the last run.'''
+        cache = _StageCache(pathlib.Path(self.store.path.parent, f'.{self.tile_basename}.manifest.json'),
+            [pathlib.Path(self.store.path, 'tiles', self.tile_basename)] + _tissue_inputs(self.folder, self.name),
+            _config_fields('tile_width', 'tile_height', 'tile_padding_x', 'tile_padding_y', 'skip_background_tiles',
+                'stitch_iou_threshold', 'stitch_min_fragment_size', 'zarr_compression', 'zarr_compression_level'),
+            [__file__, inspect.getfile(_StitchDeepcellLabels), _seams.__file__, _union_find.__file__, _zarr_store.__file__],
+            [pathlib.Path(self.store.path, 'labels', self.tile_basename)])
+        if cache.is_fresh():
+            _logger.info(f'{self.store.path} tiles are unchanged, skipping')
+            return
+        self._stitch()
+        cache.record()
+
+    def _load_tile(self, x:int, y:int):
+        x0, y0 = self._origin(x, y)
+        x1 = min(x + self.grid['tile_width'] + self.grid['tile_padding_x'], self.original_shape[1])
+        y1 = min(y + self.grid['tile_height'] + self.grid['tile_padding_y'], self.original_shape[0])
+        return self.tiles[y // self.grid['tile_height'], x // self.grid['tile_width'], :y1 - y0, :x1 - x0]
+
+    # tiles are read again from the store, recomposing tile rows with the kept seam bands
+    _keep_strips = _StitchDeepcellLabels._keep_strips
+    _kept_strips = _StitchDeepcellLabels._kept_strips
+
+    def _write_labels(self, strips):
+        # strips are whole tile rows, so every write is chunk aligned
+        self.store.write_strips(f'labels/{self.tile_basename}', strips, self.original_shape, 'uint32')
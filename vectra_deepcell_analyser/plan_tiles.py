@@ -0,0 +1,183 @@
+'''
+Tile size, padding and batch size from the slide dimensions and the memory available, instead of hand edited DeepcellConfig values.
+
+    plan = vda.plan_tiles((height, width), memory_budget=64 * 1024**3, n_workers=4)
+    plan.memory          # estimated peak bytes of each stage
+    plan.apply()         # sets the DeepcellConfig tile fields used by tiling, segmentation and stitching
+    plan.save('tile_plans/experiment/sample_tile_plan.json')
+
+Tiles are as large as a segmentation worker's share of the budget allows, up to DeepcellConfig.plan_max_tile, and the slide is
+divided into equal tiles rather than full tiles with a thin remainder at the right and bottom edges. The grid is refined until
+every worker has a tile, and tiles are shrunk further while stitching, mean marker or segmentation estimates would not fit.
+Every stage's estimate is checked against the budget.
+run_cohort(..., auto_tile=True) plans each sample and runs its stages with the plan.
+'''
+import json
+import math
+import os
+import pathlib
+
+from .config import DeepcellConfig
+from .segmenters import _get_segmenter
+
+
+# approximate resident size of the loaded Mesmer model
+_MODEL_MEMORY = 2 * 1024**3
+# numpy, scipy, scikit-image and deepcell_toolbox loaded in each post-processing process
+_POSTPROCESS_IMPORT_MEMORY = 300 * 1024**2
+# inputs, resized inputs and the model output heads are float32 per pixel of each batched tile
+_SEGMENT_BYTES_PER_PIXEL = 4 * 12
+# the planned fields, as set by TilePlan.apply
+_PLAN_FIELDS = ('tile_width', 'tile_height', 'tile_padding_x', 'tile_padding_y', 'batch_size', 'n_workers')
+# stages whose estimates follow the tile size
+_TILE_STAGES = ('mean_marker', 'segment', 'stitch')
+
+
+def plan_tiles(shape, memory_budget:int=None, n_workers:int=None, backend='mesmer', n_markers:int=7, itemsize:int=2):
+    '''
+    Plan tiling of a (height, width) slide for n_workers segmentation workers sharing memory_budget bytes
+    (default DeepcellConfig.memory_budget or 3/4 of physical memory). n_markers and itemsize describe the
+    channel images, for the estimates of the other stages. Raises ValueError if a worker cannot fit a tile of
+    DeepcellConfig.plan_min_tile pixels, or if any stage's estimate exceeds memory_budget.
+    '''
+    height, width = shape
+    memory_budget = memory_budget if memory_budget is not None else DeepcellConfig.memory_budget
+    memory_budget = memory_budget if memory_budget is not None else _physical_memory() * 3 // 4
+    n_workers = max(1, n_workers if n_workers is not None else DeepcellConfig.n_workers)
+    model_memory = _MODEL_MEMORY if _get_segmenter(backend).uses_tensorflow else 0
+    padding = math.ceil(DeepcellConfig.plan_padding_um / DeepcellConfig.image_mpp)
+
+    # largest padded square tile a worker can segment in a batch of one
+    available = memory_budget // n_workers - model_memory
+    side = math.isqrt(max(0, available) // _SEGMENT_BYTES_PER_PIXEL) - 2 * padding
+    if side < DeepcellConfig.plan_min_tile:
+        raise ValueError(f'{memory_budget / 1024**3:.1f} GiB for {n_workers} workers does not fit '
+            f'{DeepcellConfig.plan_min_tile} pixel tiles, reduce n_workers or DeepcellConfig.plan_min_tile')
+    side = min(side, DeepcellConfig.plan_max_tile)
+
+    nx, ny = math.ceil(width / side), math.ceil(height / side)
+    # split the longer tiles until every worker has one, while tiles stay above the minimum
+    while nx * ny < n_workers:
+        tw, th = math.ceil(width / (nx + 1)), math.ceil(height / (ny + 1))
+        if width / nx >= height / ny and tw >= DeepcellConfig.plan_min_tile:
+            nx += 1
+        elif th >= DeepcellConfig.plan_min_tile:
+            ny += 1
+        else:
+            break
+    # stitching holds rows of tiles across the whole slide, and mean marker and post-processing workers hold a tile each,
+    # so tiles are split further while those estimates exceed the budget
+    while True:
+        over = [stage for stage in _TILE_STAGES if _plan_memory(shape, itemsize, n_markers, width, height, nx, ny, padding, 1,
+            model_memory, n_workers)[stage] > memory_budget]
+        tw, th = math.ceil(width / (nx + 1)), math.ceil(height / (ny + 1))
+        if not over:
+            break
+        elif over == ['stitch'] and th >= DeepcellConfig.plan_min_tile:
+            ny += 1
+        elif width / nx >= height / ny and tw >= DeepcellConfig.plan_min_tile:
+            nx += 1
+        elif th >= DeepcellConfig.plan_min_tile:
+            ny += 1
+        else:
+            break
+    tile_width, tile_height = math.ceil(width / nx), math.ceil(height / ny)
+    # padding is kept well inside the neighbouring tiles
+    padding_x, padding_y = min(padding, tile_width // 4), min(padding, tile_height // 4)
+
+    tile_pixels = min(tile_width + 2 * padding_x, width) * min(tile_height + 2 * padding_y, height)
+    batch_size = max(1, min(available // (tile_pixels * _SEGMENT_BYTES_PER_PIXEL),
+        DeepcellConfig.plan_max_batch_size, math.ceil(nx * ny / n_workers)))
+    memory = _stage_memory(shape, itemsize, n_markers, tile_width, tile_height, padding_x, padding_y, batch_size, model_memory)
+    memory['segment'] *= n_workers
+    # the other stages scale with the slide and its cells, which tiling cannot change
+    over = {stage: m for stage, m in memory.items() if m > memory_budget}
+    if over:
+        estimates = ', '.join(f'{stage} {m / 1024**3:.1f} GiB' for stage, m in over.items())
+        raise ValueError(f'Estimated peak memory of {estimates} exceeds the {memory_budget / 1024**3:.1f} GiB budget '
+            f'for a {height}x{width} slide, increase memory_budget')
+    return TilePlan(shape, memory_budget, tile_width, tile_height, padding_x, padding_y, batch_size, n_workers, memory)
+
+
+def load_tile_plan(path):
+    '''Load a plan saved by TilePlan.save.'''
+    path = pathlib.Path(path)
+    if not path.is_file():
+        raise FileNotFoundError(f'{path} does not exist or is a directory')
+    with open(path) as f:
+        plan = json.load(f)
+    return TilePlan(tuple(plan['shape']), plan['memory_budget'], **{k: plan[k] for k in _PLAN_FIELDS}, memory=plan['memory'])
+
+
+def _physical_memory():
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+
+def _plan_memory(shape, itemsize, n_markers, width, height, nx, ny, padding, batch_size, model_memory, n_workers):
+    '''_stage_memory of an nx by ny grid of tiles, segmentation for all n_workers.'''
+    memory = _stage_memory(shape, itemsize, n_markers, math.ceil(width / nx), math.ceil(height / ny), padding, padding, batch_size, model_memory)
+    memory['segment'] *= n_workers
+    return memory
+
+
+def _stage_memory(shape, itemsize, n_markers, tile_width, tile_height, tile_padding_x, tile_padding_y, batch_size, model_memory):
+    '''Estimated peak bytes of each stage of one sample, segmentation per worker.'''
+    height, width = shape
+    pixels = height * width
+    tile_pixels = min(tile_width + 2 * tile_padding_x, width) * min(tile_height + 2 * tile_padding_y, height)
+    # a rough upper bound on cells for per-cell tables
+    n_cells = pixels // 50
+    n_threads = min(n_markers, os.cpu_count())
+    segment = model_memory + batch_size * tile_pixels * _SEGMENT_BYTES_PER_PIXEL
+    if DeepcellConfig.cache_model_outputs:
+        # each post-processing process holds its imports, a tile of float32 outputs and its watershed intermediates
+        n_post = DeepcellConfig.postprocess_workers if DeepcellConfig.postprocess_workers is not None else os.cpu_count()
+        segment = max(segment, n_post * (_POSTPROCESS_IMPORT_MEMORY + tile_pixels * 64))
+    return {
+        # a band of tiles per channel thread, decoded, transposed and encoded
+        'split': n_threads * width * DeepcellConfig.tiff_tile_size * itemsize * 3,
+        # a float64 strip of whole blocks, and the downsampled image, mask and distance transform
+        'tissue': DeepcellConfig.strip_height * width * 8 + pixels // DeepcellConfig.tissue_downsample**2 * 24,
+        'tile': pixels * itemsize,
+        'mean_marker': os.cpu_count() * tile_pixels * (n_markers * itemsize + 8),
+        'segment': segment,
+        # pending and current tile row strips, their relabelled copy, and two rows of tiles
+        'stitch': 5 * tile_height * width * 4 + n_cells * 16,
+        'centroids': DeepcellConfig.strip_height * width * 40 + n_cells * 64,
+        'markers': DeepcellConfig.strip_height * width * (4 + n_markers * (itemsize + 8)) + n_cells * n_markers * 40,
+    }
+
+
+class TilePlan:
+    '''Planned DeepcellConfig tile fields for one slide, with the estimated peak bytes of each stage.'''
+    def __init__(self, shape, memory_budget, tile_width, tile_height, tile_padding_x, tile_padding_y, batch_size, n_workers, memory):
+        self.shape = tuple(shape)
+        self.memory_budget = int(memory_budget)
+        self.tile_width = int(tile_width)
+        self.tile_height = int(tile_height)
+        self.tile_padding_x = int(tile_padding_x)
+        self.tile_padding_y = int(tile_padding_y)
+        self.batch_size = int(batch_size)
+        self.n_workers = int(n_workers)
+        self.memory = {stage: int(m) for stage, m in memory.items()}
+
+    def __repr__(self):
+        grid = (math.ceil(self.shape[0] / self.tile_height), math.ceil(self.shape[1] / self.tile_width))
+        return (f'TilePlan({self.tile_width}x{self.tile_height} tiles in a {grid[1]}x{grid[0]} grid, '
+            f'padding {self.tile_padding_x}/{self.tile_padding_y}, batch_size {self.batch_size}, {self.n_workers} workers, '
+            f'peak {max(self.memory.values()) / 1024**3:.1f} of {self.memory_budget / 1024**3:.1f} GiB)')
+
+    def fields(self):
+        '''The DeepcellConfig fields set by the plan.'''
+        return {k: getattr(self, k) for k in _PLAN_FIELDS}
+
+    def apply(self):
+        '''Set the planned fields on DeepcellConfig, so every following stage uses them.'''
+        for k, v in self.fields().items():
+            setattr(DeepcellConfig, k, v)
+
+    def save(self, path):
+        path = pathlib.Path(path)
+        path.parent.mkdir(exist_ok=True, parents=True)
+        with open(path, 'w') as f:
+            json.dump(dict(shape=list(self.shape), memory_budget=self.memory_budget, memory=self.memory, **self.fields()), f, indent=1)
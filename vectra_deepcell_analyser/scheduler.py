@@ -0,0 +1,266 @@
+import pathlib
+import os
+import time
+import multiprocessing
+import tifffile
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+
+from .config import DeepcellConfig
+from .panel_data import ImmunePanel
+from ._helpers._get_files import _get_files
+from .metrics import _logger, _emit, _collecting
+from .split_channels import split_immune_qptiff
+from .detect_tissue import detect_tissue
+from .tile_for_deepcell import tile_for_deepcell
+from .generate_mean_marker import generate_mean_immune_marker
+from .segment_with_deepcell import segment_with_deepcell, _limit_threads, _thread_environment
+from .segmenters import _get_segmenter
+from .stitch_deepcell_labels import stitch_deepcell_labels
+from .calculate_centroids import calculate_centroids
+from .compute_markers import compute_immune_markers
+from .plan_tiles import plan_tiles, _stage_memory, _physical_memory, _MODEL_MEMORY
+
+
+def run_cohort(folder, names=None,
+        compartment:str='whole-cell',
+        nucleus_channel:str='DAPI',
+        membrane_channel:str='ECad',
+        interior_threshold:float=None,
+        maxima_threshold:float=None,
+        memory_budget:int=None,
+        n_processes:int=None,
+        max_segment_tasks:int=1,
+        backend:str='mesmer',
+        auto_tile:bool=False):
+    '''
+    Run split, tile, segment, stitch, centroids and markers for every sample of an experiment folder.
+    The stages of each sample form a dependency graph, and ready stages of all samples are scheduled on a
+    process pool. Each stage has a peak memory estimate from the slide dimensions, and stages only start
+    while the estimates of running stages fit in memory_budget (bytes, default DeepcellConfig.memory_budget
+    or 3/4 of physical memory). At most max_segment_tasks CPU heavy segmentations run at once, sharing the
+    cores, while I/O heavy stages of other samples fill the remaining processes.
+    With auto_tile, each sample's tiles are planned by plan_tiles for a segmentation's share of the budget,
+    saved to 'tile_plans/<folder>/<name>_tile_plan.json' and used by all of that sample's stages.
+
+    Input: 'qptiffs/<folder>/<name>.qptiff'
+    Returns a dict of sample name to 'done' or 'failed'.
+    Worker processes are spawned, so scripts need an `if __name__ == '__main__':` guard.
+    '''
+    if names is None:
+        names = [file[:-len('.qptiff')] for file in sorted(_get_files(pathlib.Path('qptiffs', folder), '.*\.qptiff$'))]
+    scheduler = _CohortScheduler(folder, names, ImmunePanel, compartment, nucleus_channel, membrane_channel,
+        interior_threshold, maxima_threshold, memory_budget, n_processes, max_segment_tasks, backend, auto_tile)
+    return scheduler.process()
+
+
+def _config_snapshot():
+    return {k: v for k, v in vars(DeepcellConfig).items() if not k.startswith('_')}
+
+
+_threads_limited = False
+
+def _run_task(config, threads, tensorflow, function, args, kwargs):
+    # spawned processes start with the default DeepcellConfig, so the parent's settings are applied first
+    global _threads_limited
+    for k, v in config.items():
+        setattr(DeepcellConfig, k, v)
+    if threads is not None and not _threads_limited:
+        # tensorflow thread pools can only be sized before first use in each process
+        _limit_threads(threads, tensorflow)
+        _threads_limited = True
+    # metrics are returned to the parent process, which has the sinks
+    with _collecting() as collector:
+        function(*args, **kwargs)
+    return collector.drain()
+
+
+class _Task:
+    '''
+    One stage of one sample. kind is 'cpu' or 'io', memory is the estimated peak in bytes,
+    config holds DeepcellConfig fields set for this sample only.
+    '''
+    def __init__(self, name, stage, kind, memory, function, args, kwargs=None, deps=(), config=None):
+        self.name = name
+        self.stage = stage
+        self.kind = kind
+        self.memory = int(memory)
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs or {}
+        self.deps = set(deps)
+        self.config = config or {}
+
+
+class _CohortScheduler:
+    def __init__(self, folder, names, panel, compartment, nucleus_channel, membrane_channel, interior_threshold, maxima_threshold,
+            memory_budget=None, n_processes=None, max_segment_tasks=1, backend='mesmer', auto_tile=False):
+        self.folder = folder
+        self.names = list(names)
+        self.panel = panel
+        self.compartment = compartment
+        self.nucleus_channel = nucleus_channel
+        self.membrane_channel = membrane_channel
+        self.interior_threshold = interior_threshold
+        self.maxima_threshold = maxima_threshold
+        memory_budget = memory_budget if memory_budget is not None else DeepcellConfig.memory_budget
+        self.memory_budget = memory_budget if memory_budget is not None else _physical_memory() * 3 // 4
+        self.n_processes = n_processes if n_processes is not None else os.cpu_count()
+        self.max_segment_tasks = max(1, max_segment_tasks)
+        self.backend = backend
+        self.engine_class = _get_segmenter(backend)
+        self.auto_tile = auto_tile
+
+        for name in self.names:
+            p = pathlib.Path('qptiffs', self.folder, f'{name}.qptiff')
+            if not p.is_file():
+                raise FileNotFoundError(f'{p} does not exist or is a directory')
+
+    def process(self):
+        tasks = {}
+        for name in self.names:
+            for task in self._sample_tasks(name):
+                tasks[(name, task.stage)] = task
+        order = {key: i for i, key in enumerate(tasks)}
+        status = {name: 'done' for name in self.names}
+        done = set()
+        running = {}
+        used = 0
+        config = _config_snapshot()
+        threads = max(1, os.cpu_count() // self.max_segment_tasks)
+
+        tstart = time.time()
+        context = multiprocessing.get_context('spawn')
+        # processes are spawned on demand and shared by all stages, so each starts with the segmentation thread counts
+        with _thread_environment(threads):
+            executor = ProcessPoolExecutor(self.n_processes, mp_context=context)
+            try:
+                while tasks or running:
+                    for key in self._pick(tasks, running, used, order, done):
+                        task = tasks.pop(key)
+                        future = executor.submit(_run_task, dict(config, **task.config), threads if task.kind == 'cpu' else None,
+                            self.engine_class.uses_tensorflow, task.function, task.args, task.kwargs)
+                        running[future] = task
+                        used += task.memory
+                    if not running:
+                        break
+                    finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                    lost = []
+                    for future in finished:
+                        task = running.pop(future)
+                        used -= task.memory
+                        try:
+                            records = future.result()
+                        except BrokenProcessPool:
+                            lost.append(task)
+                            continue
+                        except Exception:
+                            _logger.exception(f'{task.name}: {task.stage} failed, skipping its remaining stages')
+                            self._fail(task, tasks, status)
+                            continue
+                        for record in records:
+                            _emit(record)
+                        _logger.info(f'{task.name}: {task.stage} done ({time.time() - tstart:.0f}s)')
+                        done.add((task.name, task.stage))
+                    if lost:
+                        # a worker process died, e.g. killed when out of memory. Every task on the pool fails with it,
+                        # as would any later submit, so the running tasks are failed and the pool is replaced
+                        lost += running.values()
+                        running.clear()
+                        used = 0
+                        for task in lost:
+                            _logger.error(f'{task.name}: {task.stage} failed, a worker process died, skipping its remaining stages')
+                            self._fail(task, tasks, status)
+                        executor.shutdown(wait=True, cancel_futures=True)
+                        executor = ProcessPoolExecutor(self.n_processes, mp_context=context)
+            finally:
+                executor.shutdown()
+        return status
+
+    def _fail(self, task, tasks, status):
+        '''Mark a task's sample failed and drop its remaining stages.'''
+        status[task.name] = 'failed'
+        for key in [key for key in tasks if key[0] == task.name]:
+            del tasks[key]
+
+    def _pick(self, tasks, running, used, order, done):
+        '''
+        Ready tasks to start now, CPU heavy tasks first and then earlier samples first, so whole samples
+        complete early rather than all samples finishing at the end. Tasks are started while their memory estimates fit
+        in the budget, and one task is always allowed if nothing is running so oversized stages still run.
+        '''
+        n_cpu = sum(task.kind == 'cpu' for task in running.values())
+        n_running = len(running)
+        ready = [key for key, task in tasks.items() if all((task.name, dep) in done for dep in task.deps)]
+        ready.sort(key=lambda key: (tasks[key].kind != 'cpu', order[key]))
+        picked = []
+        for key in ready:
+            task = tasks[key]
+            if n_running >= self.n_processes:
+                break
+            if task.kind == 'cpu' and n_cpu >= self.max_segment_tasks:
+                continue
+            if n_running > 0 and used + task.memory > self.memory_budget:
+                continue
+            picked.append(key)
+            used += task.memory
+            n_running += 1
+            n_cpu += task.kind == 'cpu'
+        return picked
+
+    def _sample_tasks(self, name):
+        with tifffile.TiffFile(pathlib.Path('qptiffs', self.folder, f'{name}.qptiff')) as tf:
+            page = tf.pages[0]
+            height, width = page.shape[:2]
+            itemsize = page.dtype.itemsize
+        n_markers = len(self.panel.channel_map)
+        model_memory = _MODEL_MEMORY if self.engine_class.uses_tensorflow else 0
+        config = {}
+        if self.auto_tile:
+            # segmentations share the budget, each running in one process
+            plan = plan_tiles((height, width), self.memory_budget // self.max_segment_tasks, 1, self.engine_class, n_markers, itemsize)
+            plan.save(pathlib.Path('tile_plans', self.folder, f'{name}_tile_plan.json'))
+            _logger.info(f'{name}: {plan}')
+            config = plan.fields()
+            memory = plan.memory
+        else:
+            memory = _stage_memory((height, width), itemsize, n_markers, DeepcellConfig.tile_width, DeepcellConfig.tile_height,
+                DeepcellConfig.tile_padding_x, DeepcellConfig.tile_padding_y, DeepcellConfig.batch_size, model_memory)
+        kwargs = dict(compartment=self.compartment, nucleus_channel=self.nucleus_channel, membrane_channel=self.membrane_channel,
+            interior_threshold=self.interior_threshold, maxima_threshold=self.maxima_threshold)
+
+        tiled = [self.nucleus_channel]
+        if self.membrane_channel == 'AVGMARKER':
+            tiled += [m for m in self.panel.channel_map.values() if m != 'DAPI' and m != self.nucleus_channel]
+        else:
+            tiled.append(self.membrane_channel)
+
+        tasks = [_Task(name, 'split', 'io', memory['split'],
+            split_immune_qptiff, (self.folder, name), dict(n_threads=min(n_markers, os.cpu_count())))]
+        tile_deps = ['split']
+        if DeepcellConfig.skip_background_tiles:
+            tasks.append(_Task(name, 'tissue', 'io', memory['tissue'],
+                detect_tissue, (self.folder, name), deps=['split']))
+            tile_deps = ['tissue']
+        for marker in tiled:
+            tasks.append(_Task(name, f'tile_{marker}', 'io', memory['tile'],
+                tile_for_deepcell, (self.folder, f'{name}_{marker}'), deps=tile_deps))
+        segment_deps = [f'tile_{marker}' for marker in tiled]
+        if self.membrane_channel == 'AVGMARKER':
+            tasks.append(_Task(name, 'mean_marker', 'io', memory['mean_marker'],
+                generate_mean_immune_marker, (self.folder, name), deps=segment_deps))
+            segment_deps = ['mean_marker']
+        tasks += [
+            _Task(name, 'segment', 'cpu', memory['segment'],
+                # the class rather than its name, so backends registered in this process also work in the workers
+                segment_with_deepcell, (self.folder, name), dict(kwargs, n_workers=1, backend=self.engine_class), deps=segment_deps),
+            _Task(name, 'stitch', 'io', memory['stitch'],
+                stitch_deepcell_labels, (self.folder, name), kwargs, deps=['segment']),
+            _Task(name, 'centroids', 'io', memory['centroids'],
+                calculate_centroids, (self.folder, name), kwargs, deps=['stitch']),
+            _Task(name, 'markers', 'io', memory['markers'],
+                compute_immune_markers, (self.folder, name), kwargs, deps=['stitch']),
+        ]
+        for task in tasks:
+            task.config = config
+        return tasks
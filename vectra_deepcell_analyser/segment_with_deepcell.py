@@ -1,11 +1,16 @@
 import tifffile
 import pathlib
 import re
-import tqdm
 import os
+import contextlib
+import multiprocessing
+import inspect
 import numpy as np
 
 from .config import DeepcellConfig
+from ._helpers._cache import _TileManifest, _config_fields
+from .metrics import _measure, _profile, _logger, _emit, _collecting
+from .segmenters import _get_segmenter
 
 def segment_with_deepcell(
         folder, name,
@@ -13,16 +18,99 @@ def segment_with_deepcell(
         nucleus_channel:str='DAPI',
         membrane_channel:str='ECad',
         interior_threshold:float=None,
-        maxima_threshold:float=None):
-    worker = _DeepcellWorker(
+        maxima_threshold:float=None,
+        batch_size:int=None,
+        n_workers:int=None,
+        threads_per_worker:int=None,
+        backend:str='mesmer'):
+    '''
+    Segment each tile with the given backend, 'mesmer' (default) or 'watershed' for a fast CPU preview
+    (see vectra_deepcell_analyser.segmenters). Output naming is the same for every backend.
+    With DeepcellConfig.cache_model_outputs set, Mesmer's network outputs are stored once as float16 tiles in
+    'deepcell_raw_tiles/<folder>/<name>/<name>_<nucleus>_<membrane>/', and other thresholds or compartments
+    only rerun post-processing, on DeepcellConfig.postprocess_workers processes (default all cores).
+    '''
+    if DeepcellConfig.storage == 'zarr':
+        from .pipeline import _ZarrDeepcellWorker as worker_class
+    else:
+        worker_class = _DeepcellWorker
+    worker = worker_class(
         folder, name,
         compartment, nucleus_channel, membrane_channel,
-        interior_threshold, maxima_threshold)
-    worker.process()
+        interior_threshold, maxima_threshold, batch_size, backend)
+    worker.process(n_workers, threads_per_worker)
+
+
+_THREAD_VARIABLES = ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'TF_NUM_INTRAOP_THREADS')
+
+@contextlib.contextmanager
+def _thread_environment(n_threads:int):
+    '''
+    Set the OpenMP/BLAS thread counts in os.environ for processes spawned within the block, restoring them after.
+    Native thread pools read these when numpy is first imported, which in a spawned process happens
+    while unpickling its target, before any initializer runs, so they must be inherited from the parent.
+    '''
+    saved = {var: os.environ.get(var) for var in _THREAD_VARIABLES}
+    os.environ.update({var: str(n_threads) for var in _THREAD_VARIABLES})
+    try:
+        yield
+    finally:
+        for var, value in saved.items():
+            if value is None:
+                os.environ.pop(var, None)
+            else:
+                os.environ[var] = value
+
+
+def _limit_threads(n_threads:int, tensorflow:bool=True):
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        # optional, the thread counts inherited from _thread_environment still apply
+        pass
+    else:
+        # thread pools this process already started are resized too
+        threadpool_limits(n_threads)
+    if not tensorflow:
+        return
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(n_threads)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+
+
+_pool_worker = None
+_pool_engine = None
+
+def _init_pool_worker(config, worker, threads_per_worker):
+    # runs once in each pool process, before tensorflow starts its thread pools
+    # spawned processes start with the default DeepcellConfig, so the parent's settings are applied first
+    global _pool_worker, _pool_engine
+    for k, v in config.items():
+        setattr(DeepcellConfig, k, v)
+    # post-processing stored outputs needs no model, so those workers never import tensorflow
+    _limit_threads(threads_per_worker, worker.engine_class.uses_tensorflow and worker.stage != 'postprocess')
+    _pool_worker = worker
+    _pool_engine = worker._engine()
+
+def _pool_process_batch(batch):
+    # batch metrics are returned to the parent process, which has the sinks
+    with _collecting() as collector:
+        _pool_worker._process_tiles(_pool_engine, batch)
+    return _pool_worker._batch_result(batch), collector.drain()
+
+
+def _normalise(im):
+    im = im.astype('float32')
+    m = np.max(im)
+    return im / m if m > 0 else im
 
 
 class _DeepcellWorker:
-    def __init__(self, folder, name, compartment, nucleus_channel, membrane_channel, interior_threshold, maxima_threshold):
+    # 'segment' runs the backend end to end, 'predict' stores its raw outputs and 'postprocess' labels tiles from them
+    stage = 'segment'
+
+    def __init__(self, folder, name, compartment, nucleus_channel, membrane_channel, interior_threshold, maxima_threshold, batch_size=None,
+            backend='mesmer'):
         self.folder = folder
         self.name = name
         self.compartment = compartment
@@ -30,6 +118,9 @@ class _DeepcellWorker:
         self.membrane_channel = membrane_channel
         self.interior_threshold = interior_threshold if interior_threshold is not None else DeepcellConfig.interior_threshold
         self.maxima_threshold = maxima_threshold if maxima_threshold is not None else DeepcellConfig.maxima_threshold
+        self.batch_size = batch_size if batch_size is not None else DeepcellConfig.batch_size
+        self.backend = backend
+        self.engine_class = _get_segmenter(backend)
 
         self.nuc_folder = pathlib.Path('tiled_for_deepcell', self.folder, f'{self.name}_{self.nucleus_channel}')
         if not self.nuc_folder.is_dir():
@@ -39,38 +130,201 @@ class _DeepcellWorker:
             raise FileNotFoundError(f'{self.mem_folder} does not exist or is not a directory')
         
         self.outfile_basename = f'{self.name}_{self.compartment}_{self.nucleus_channel}_{self.membrane_channel}_{str(int(self.interior_threshold*1000))}_{str(int(self.maxima_threshold*1000))}'
+        # raw outputs hold every compartment and do not depend on the thresholds
+        self.raw_basename = f'{self.name}_{self.nucleus_channel}_{self.membrane_channel}'
+        self.raw_folder = pathlib.Path('deepcell_raw_tiles', self.folder, self.name, self.raw_basename)
+
+    def process(self, n_workers:int=None, threads_per_worker:int=None):
+        '''
+        Segment every tile, skipping tiles whose input tiles, thresholds and code are unchanged since the last run.
+        '''
+        self.outfolder = pathlib.Path('deepcell_labelled_tiles', self.folder, self.name, self.outfile_basename)
+        self.outfolder.mkdir(exist_ok=True, parents=True)
+        raw = self._caches_raw()
+        if raw:
+            self._predict_raw(n_workers, threads_per_worker)
+        self.manifest = _TileManifest(
+            pathlib.Path('deepcell_labelled_tiles', self.folder, self.name, f'.{self.outfile_basename}.manifest.json'),
+            dict(compartment=self.compartment, interior_threshold=self.interior_threshold, maxima_threshold=self.maxima_threshold,
+                backend=self.backend, **_config_fields(*self.engine_class.config_fields)),
+            [__file__, inspect.getfile(self.engine_class)])
+        keys = {}
+        for x0, y0 in self._tiles():
+            keys[(x0, y0)] = self.manifest.key([self._raw_file(x0, y0)] if raw else self._tile_files(x0, y0))
+        todo = [tile for tile, key in keys.items()
+            if not self.manifest.is_fresh(f'{tile[0]}_{tile[1]}', key, self._outfile(*tile))]
+        if len(todo) < len(keys):
+            _logger.info(f'Skipping {len(keys) - len(todo)} unchanged tiles')
+
+        with _measure('segment', sample=self.name) as m:
+            m.count('skipped_tiles', len(keys) - len(todo))
+            if raw:
+                batches = self._postprocess_run(todo)
+            else:
+                batches = self._run(list(self._batches(todo)), n_workers, threads_per_worker)
+            for batch in batches:
+                for x0, y0 in batch:
+                    self.manifest.record(f'{x0}_{y0}', keys[(x0, y0)])
+                self.manifest.save()
+                m.count('tiles', len(batch))
+                m.count('batches')
+
+    def _caches_raw(self):
+        if not DeepcellConfig.cache_model_outputs:
+            return False
+        if not hasattr(self.engine_class, 'predict_raw'):
+            _logger.warning(f'The {self.backend} backend does not store model outputs, DeepcellConfig.cache_model_outputs is ignored')
+            return False
+        return True
+
+    def _predict_raw(self, n_workers:int=None, threads_per_worker:int=None):
+        '''Store the raw outputs of tiles whose input tiles, model settings or code changed since the last run.'''
+        self.raw_folder.mkdir(exist_ok=True, parents=True)
+        manifest = _TileManifest(
+            pathlib.Path(self.raw_folder.parent, f'.{self.raw_basename}.manifest.json'),
+            dict(backend=self.backend, **_config_fields(*self.engine_class.config_fields)),
+            [__file__, inspect.getfile(self.engine_class)])
+        keys = {tile: manifest.key(self._tile_files(*tile)) for tile in self._tiles()}
+        todo = [tile for tile, key in keys.items()
+            if not manifest.is_fresh(f'{tile[0]}_{tile[1]}', key, self._raw_file(*tile))]
+        if len(todo) < len(keys):
+            _logger.info(f'Reusing the model outputs of {len(keys) - len(todo)} tiles')
+
+        self.stage = 'predict'
+        with _measure('predict', sample=self.name) as m:
+            m.count('skipped_tiles', len(keys) - len(todo))
+            for batch in self._run(list(self._batches(todo)), n_workers, threads_per_worker):
+                for x0, y0 in batch:
+                    manifest.record(f'{x0}_{y0}', keys[(x0, y0)])
+                manifest.save()
+                m.count('tiles', len(batch))
+                m.count('batches')
+        self.stage = 'segment'
+
+    def _postprocess_run(self, tiles):
+        '''Label tiles from their stored outputs, one tile per task as post-processing is single threaded.'''
+        self.stage = 'postprocess'
+        n_workers = DeepcellConfig.postprocess_workers if DeepcellConfig.postprocess_workers is not None else os.cpu_count()
+        yield from self._run([[tile] for tile in tiles], min(n_workers, max(1, len(tiles))), 1)
+        self.stage = 'segment'
 
-    def process(self):
-        pathlib.Path('deepcell_labelled_tiles', self.folder, self.name, self.outfile_basename).mkdir(
-            exist_ok=True, parents=True)
+    def _run(self, batches, n_workers:int=None, threads_per_worker:int=None):
+        '''Segment batches of tiles, yielding each batch once its label tiles are written.'''
+        if not batches:
+            return
+        with self._runner(n_workers, threads_per_worker) as run:
+            yield from run(batches)
 
+    @contextlib.contextmanager
+    def _runner(self, n_workers:int=None, threads_per_worker:int=None):
+        '''
+        A function segmenting batches like _run, which can be called again for more batches on the same engine or pool.
+        With n_workers <= 1 batches are segmented in this process, otherwise each spawned worker loads the model once.
+        '''
+        n_workers = n_workers if n_workers is not None else DeepcellConfig.n_workers
+        threads_per_worker = threads_per_worker if threads_per_worker is not None else max(1, os.cpu_count() // n_workers)
+
+        if n_workers <= 1:
+            engine = self._engine()
+            def run(batches):
+                for batch in batches:
+                    self._process_tiles(engine, batch)
+                    yield batch
+            yield run
+            return
+
+        # tensorflow is not fork safe, each spawned worker loads the model once and pulls batches from the pool queue
+        from .scheduler import _config_snapshot
+        context = multiprocessing.get_context('spawn')
+        with _thread_environment(threads_per_worker), context.Pool(n_workers, initializer=_init_pool_worker,
+                initargs=(_config_snapshot(), self, threads_per_worker)) as pool:
+            def run(batches):
+                for result, records in pool.imap_unordered(_pool_process_batch, batches):
+                    for record in records:
+                        _emit(record)
+                    yield self._receive_batch(result)
+            yield run
+
+    def _batch_result(self, batch):
+        '''What a pool worker sends back for a processed batch, its label tiles are already written.'''
+        return batch
+
+    def _receive_batch(self, result):
+        '''The batch of a pool worker's _batch_result, in the parent process.'''
+        return result
+
+    def _engine(self):
+        return self.engine_class(self.compartment, self.interior_threshold, self.maxima_threshold, self.batch_size)
+
+    def _batches(self, tiles):
+        # edge tiles are smaller, so tiles are batched with others of the same shape
+        pending = {}
+        for x0, y0 in tiles:
+            shape = self._tile_shape(x0, y0)
+            batch = pending.setdefault(shape, [])
+            batch.append((x0, y0))
+            if len(batch) >= self.batch_size:
+                yield pending.pop(shape)
+        yield from pending.values()
+
+    def _tiles(self):
         pattern = re.compile(f'{self.name}_{self.nucleus_channel}_(?P<x0>\d+)_(?P<y0>\d+)\.png')
-        for file in os.listdir(self.nuc_folder):
+        for file in sorted(os.listdir(self.nuc_folder)):
             m = pattern.match(file)
-            self._process_tile(int(m['x0']), int(m['y0']))
-
-    def _process_tile(self, x0:int, y0:int):
-        import deepcell
-        print(x0, y0)
-        nuc = tifffile.imread(
-            pathlib.Path(self.nuc_folder, f'{self.name}_{self.nucleus_channel}_{x0}_{y0}.png'))
-        mem = tifffile.imread(
+            if m:
+                yield int(m['x0']), int(m['y0'])
+
+    def _tile_files(self, x0:int, y0:int):
+        return (pathlib.Path(self.nuc_folder, f'{self.name}_{self.nucleus_channel}_{x0}_{y0}.png'),
             pathlib.Path(self.mem_folder, f'{self.name}_{self.membrane_channel}_{x0}_{y0}.png'))
-        im = np.stack((nuc/np.max(nuc), mem/np.max(mem)), axis=-1)
-        im = np.expand_dims(im, 0)
-
-        app = deepcell.applications.Mesmer()
-        interior_threshold = self.interior_threshold
-        maxima_threshold = self.maxima_threshold
-        predictions = app.predict(im,
-            image_mpp=DeepcellConfig.image_mpp,
-            postprocess_kwargs_whole_cell={
-                'interior_threshold': interior_threshold,
-                'maxima_threshold': maxima_threshold},
-            compartment = self.compartment)
-
-        tifffile.imwrite(
-            pathlib.Path('deepcell_labelled_tiles', self.folder, self.name,
-                self.outfile_basename,
-                f'{self.outfile_basename}_{x0}_{y0}.tif'),
-            predictions[0,...])
+
+    def _tile_shape(self, x0:int, y0:int):
+        with tifffile.TiffFile(self._tile_files(x0, y0)[0]) as tf:
+            return tf.pages[0].shape
+
+    def _load_tile(self, x0:int, y0:int):
+        nuc_file, mem_file = self._tile_files(x0, y0)
+        return _normalise(tifffile.imread(nuc_file)), _normalise(tifffile.imread(mem_file))
+
+    def _process_tiles(self, engine, tiles):
+        if self.stage == 'postprocess':
+            return self._postprocess_batch(engine, tiles)
+        return self._process_batch(engine, [(x0, y0) + self._load_tile(x0, y0) for x0, y0 in tiles])
+
+    def _process_batch(self, engine, batch):
+        with _measure('segment', 'batch', sample=self.name, tiles=[(x0, y0) for x0, y0, _, _ in batch]) as m, \
+                _profile('segment.predict'):
+            nuc = np.stack([nuc for _, _, nuc, _ in batch])
+            mem = np.stack([mem for _, _, _, mem in batch])
+            if self.stage == 'predict':
+                for (x0, y0, _, _), raw in zip(batch, engine.predict_raw(nuc, mem)):
+                    self._write_raw(x0, y0, raw)
+            else:
+                for (x0, y0, _, _), tile_labels in zip(batch, engine.segment(nuc, mem)):
+                    self._write_tile(x0, y0, tile_labels)
+            m.count('tiles', len(batch))
+        return len(batch)
+
+    def _postprocess_batch(self, engine, tiles):
+        for x0, y0 in tiles:
+            with _measure('segment', 'tile', sample=self.name, x=x0, y=y0, postprocess=True), \
+                    _profile('segment.postprocess'):
+                labels = engine.postprocess(self._load_raw(x0, y0)[np.newaxis], self._tile_shape(x0, y0))
+                self._write_tile(x0, y0, labels[0])
+        return len(tiles)
+
+    def _raw_file(self, x0:int, y0:int):
+        return pathlib.Path(self.raw_folder, f'{self.raw_basename}_{x0}_{y0}.tif')
+
+    def _write_raw(self, x0:int, y0:int, raw):
+        # the floating point predictor makes the smooth network outputs compress well
+        tifffile.imwrite(self._raw_file(x0, y0), raw, compression='zlib', predictor=True, tile=(256, 256))
+
+    def _load_raw(self, x0:int, y0:int):
+        return tifffile.imread(self._raw_file(x0, y0))
+
+    def _outfile(self, x0:int, y0:int):
+        return pathlib.Path(self.outfolder, f'{self.outfile_basename}_{x0}_{y0}.tif')
+
+    def _write_tile(self, x0:int, y0:int, labels):
+        tifffile.imwrite(self._outfile(x0, y0), labels)
@@ -0,0 +1,174 @@
+'''
+Segmentation backends used by segment_with_deepcell and run_pipeline_in_memory.
+
+A backend is a class constructed with (compartment, interior_threshold, maxima_threshold, batch_size),
+whose segment(nuc_batch, mem_batch) takes two (N, H, W) float32 batches normalised to [0, 1] and returns
+(N, H, W) integer labels, 0 being background. Class attributes `uses_tensorflow` and `config_fields`
+(the DeepcellConfig fields its output depends on) are also expected. Register new backends with register_segmenter,
+the class must be importable by worker processes.
+
+Backends may also split segment into predict_raw(nuc_batch, mem_batch), returning (N, h, w, C) float16 pixelwise outputs,
+and postprocess(raw_batch, shape), returning (N, H, W) labels of the given tile shape. With DeepcellConfig.cache_model_outputs
+set, the raw outputs are stored per tile and only post-processing reruns for new thresholds.
+'''
+import numpy as np
+
+from .config import DeepcellConfig
+
+
+_mesmer = None
+
+# Mesmer.predict's default post-processing settings (deepcell 0.12), repeated when post-processing stored outputs
+_MESMER_WHOLE_CELL_KWARGS = {'maxima_threshold': 0.075, 'maxima_smooth': 0, 'interior_threshold': 0.2, 'interior_smooth': 2,
+    'small_objects_threshold': 15, 'fill_holes_threshold': 15, 'radius': 2}
+_MESMER_NUCLEAR_KWARGS = {'maxima_threshold': 0.1, 'maxima_smooth': 0, 'interior_threshold': 0.2, 'interior_smooth': 2,
+    'small_objects_threshold': 15, 'fill_holes_threshold': 15, 'radius': 2}
+
+def _get_mesmer():
+    # model construction and weight loading dominate per tile cost, so load once per process
+    global _mesmer
+    if _mesmer is None:
+        import deepcell
+        _mesmer = deepcell.applications.Mesmer()
+    return _mesmer
+
+
+class _MesmerEngine:
+    uses_tensorflow = True
+    # DeepcellConfig fields the output depends on, recorded in the tile cache manifest
+    config_fields = ('image_mpp',)
+
+    def __init__(self, compartment, interior_threshold, maxima_threshold, batch_size):
+        self.compartment = compartment
+        self.interior_threshold = interior_threshold
+        self.maxima_threshold = maxima_threshold
+        self.batch_size = batch_size
+
+    @property
+    def app(self):
+        # loaded on first use, post-processing stored outputs does not need the model
+        return _get_mesmer()
+
+    def segment(self, nuc_batch, mem_batch):
+        im = np.stack((nuc_batch, mem_batch), axis=-1)
+        predictions = self.app.predict(im,
+            batch_size=self.batch_size,
+            image_mpp=DeepcellConfig.image_mpp,
+            postprocess_kwargs_whole_cell={
+                'interior_threshold': self.interior_threshold,
+                'maxima_threshold': self.maxima_threshold},
+            compartment=self.compartment)
+        return predictions[..., 0] if predictions.shape[-1] == 1 else predictions
+
+    def predict_raw(self, nuc_batch, mem_batch):
+        '''
+        The network outputs before post-processing, at the model resolution: whole-cell inner distance and interior,
+        then nuclear inner distance and interior. These are the steps of Mesmer.predict before its post-processing.
+        '''
+        im = np.stack((nuc_batch, mem_batch), axis=-1)
+        resized = self.app._resize_input(im, DeepcellConfig.image_mpp)
+        outputs = self.app._run_model(image=resized, batch_size=self.batch_size, pad_mode='constant', preprocess_kwargs={})
+        return np.concatenate(outputs['whole-cell'] + outputs['nuclear'], axis=-1).astype('float16')
+
+    def postprocess(self, raw_batch, shape):
+        '''
+        deepcell's mesmer_postprocess, calling deepcell_toolbox directly: importing deepcell.applications loads tensorflow,
+        which post-processing workers do not need.
+        '''
+        from deepcell_toolbox.deep_watershed import deep_watershed
+        from deepcell_toolbox.utils import resize
+        raw_batch = raw_batch.astype('float32')
+        whole_cell = [raw_batch[..., 0:1], raw_batch[..., 1:2]]
+        nuclear = [raw_batch[..., 2:3], raw_batch[..., 3:4]]
+        whole_cell_kwargs = dict(_MESMER_WHOLE_CELL_KWARGS, interior_threshold=self.interior_threshold, maxima_threshold=self.maxima_threshold)
+        if self.compartment == 'whole-cell':
+            labels = deep_watershed(whole_cell, **whole_cell_kwargs)
+        elif self.compartment == 'nuclear':
+            labels = deep_watershed(nuclear, **_MESMER_NUCLEAR_KWARGS)
+        elif self.compartment == 'both':
+            labels = np.concatenate((deep_watershed(whole_cell, **whole_cell_kwargs), deep_watershed(nuclear, **_MESMER_NUCLEAR_KWARGS)), axis=-1)
+        else:
+            raise ValueError(f'Invalid compartment "{self.compartment}", expected "whole-cell", "nuclear" or "both"')
+        if labels.shape[1:3] != tuple(shape):
+            labels = resize(labels, tuple(shape), labeled_image=True)
+        return labels[..., 0] if labels.shape[-1] == 1 else labels
+
+
+class _WatershedEngine:
+    '''
+    Classical CPU segmentation for previews and parameter exploration, no tensorflow needed.
+    Nuclei are an Otsu threshold of the smoothed nucleus channel, split by a watershed on their distance transform
+    seeded from its local maxima. For 'whole-cell' the nuclei are grown by a watershed on the membrane channel,
+    limited to the hole filled Otsu foreground of the combined channels within DeepcellConfig.watershed_expansion_um.
+    Mesmer's interior and maxima thresholds do not apply and are ignored.
+    '''
+    uses_tensorflow = False
+    config_fields = ('image_mpp', 'watershed_sigma', 'watershed_min_distance_um', 'watershed_expansion_um', 'watershed_min_size')
+
+    def __init__(self, compartment, interior_threshold, maxima_threshold, batch_size):
+        if compartment not in ('whole-cell', 'nuclear'):
+            raise ValueError(f'Unknown compartment "{compartment}", the watershed backend supports "whole-cell" and "nuclear"')
+        self.compartment = compartment
+
+    def segment(self, nuc_batch, mem_batch):
+        return np.stack([self._segment_tile(nuc, mem) for nuc, mem in zip(nuc_batch, mem_batch)])
+
+    def _segment_tile(self, nuc, mem):
+        from scipy import ndimage
+        import skimage.filters
+        import skimage.segmentation
+
+        sigma = DeepcellConfig.watershed_sigma
+        nuc = ndimage.gaussian_filter(nuc, sigma)
+        if nuc.max() <= nuc.min():
+            return np.zeros(nuc.shape, dtype='int32')
+        nuclei = nuc > skimage.filters.threshold_otsu(nuc)
+        nuclei = ndimage.binary_opening(nuclei, iterations=1)
+
+        # one seed per local maximum of the distance transform, at least min_distance apart
+        distance = ndimage.distance_transform_edt(nuclei)
+        min_distance = max(1, int(round(DeepcellConfig.watershed_min_distance_um / DeepcellConfig.image_mpp)))
+        peaks = (distance == ndimage.maximum_filter(distance, size=2*min_distance+1)) & (distance > 1)
+        seeds, _ = ndimage.label(peaks)
+        labels = skimage.segmentation.watershed(-distance, seeds, mask=nuclei)
+        labels = _remove_small(labels, DeepcellConfig.watershed_min_size)
+
+        if self.compartment == 'whole-cell':
+            mem = ndimage.gaussian_filter(mem, sigma)
+            combined = np.maximum(nuc, mem)
+            foreground = combined > skimage.filters.threshold_otsu(combined) if combined.max() > combined.min() else labels > 0
+            # membrane rings enclose unstained cytoplasm
+            foreground = ndimage.binary_fill_holes(foreground)
+            expansion = DeepcellConfig.watershed_expansion_um / DeepcellConfig.image_mpp
+            foreground &= ndimage.distance_transform_edt(labels == 0) <= expansion
+            labels = skimage.segmentation.watershed(mem, labels, mask=foreground | (labels > 0))
+        return labels.astype('int32')
+
+
+def _remove_small(labels, min_size:int):
+    areas = np.bincount(labels.reshape(-1))
+    small = areas < min_size
+    small[0] = False
+    if np.any(small):
+        labels = np.where(small[labels], 0, labels)
+    return labels
+
+
+_segmenters = {
+    'mesmer': _MesmerEngine,
+    'watershed': _WatershedEngine,
+}
+
+
+def register_segmenter(name:str, engine):
+    '''Register a backend class under `name`, to be selected with segment_with_deepcell(..., backend=name).'''
+    _segmenters[name] = engine
+
+
+def _get_segmenter(name):
+    # a backend class can also be given directly
+    if not isinstance(name, str):
+        return name
+    if name not in _segmenters:
+        raise ValueError(f'Unknown segmenter backend "{name}", expected one of {list(_segmenters)}')
+    return _segmenters[name]
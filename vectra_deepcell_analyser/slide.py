@@ -0,0 +1,121 @@
+'''
+Lazy access to the channels of a source qptiff, without splitting it first.
+
+    slide = vda.open_slide('experiment', 'sample')
+    slide.markers                           # panel names of the mapped pages, e.g. ['DAPI', 'CD8', ...]
+    slide.shape, slide.dtype                # from the page headers, nothing is decoded
+    dapi = slide['DAPI'][y0:y1, x0:x1]      # only the tiles/strips of the page holding the window are decoded
+    stack = slide.window(x0, y0, x1, y1)    # (marker, y, x) for every mapped channel
+
+Channels are read by slicing. Their own window method is the internal reader's, in (y0, y1, x0, x1) order
+unlike Slide.window, so it is not part of the interface.
+
+The channel names in the PerkinElmer XML of each page (tag 270) are parsed once per qptiff and mapped to markers by the panel.
+Uncompressed pages are memory mapped. With DeepcellConfig.channels_from_qptiff set, the stages read their channels
+from the qptiff this way instead of the 'unstacked' copies, and split_immune_qptiff is skipped.
+'''
+import os
+import pathlib
+import warnings
+import numpy as np
+import tifffile
+import xmltodict
+
+from .panel_data import ImmunePanel
+from ._helpers._tiff_window import _TiffWindowReader
+
+
+def open_slide(folder, name, panel=ImmunePanel):
+    '''
+    Input: 'qptiffs/<folder>/<name>.qptiff'
+    '''
+    return Slide(pathlib.Path('qptiffs', folder, f'{name}.qptiff'), panel)
+
+
+# (path, size, modification time, panel) to the marker page indices, so each qptiff's metadata is parsed once
+_channel_page_cache = {}
+
+def _channel_pages(path, panel=ImmunePanel):
+    '''Page index of each marker of the panel in a qptiff, in page order. Unmapped channels are warned about and left out.'''
+    path = pathlib.Path(path)
+    if not path.is_file():
+        raise FileNotFoundError(f'{path} was not found or is a directory')
+    stat = os.stat(path)
+    key = (str(path.resolve()), stat.st_size, stat.st_mtime_ns, panel)
+    if key not in _channel_page_cache:
+        pages = {}
+        with tifffile.TiffFile(path) as tf:
+            for i in range(panel.n_channels):
+                channel = _channel_name(tf.pages[i])
+                if channel not in panel.channel_map:
+                    warnings.warn(f"Unmapped channel \"{channel}\", ignoring.", UserWarning)
+                    continue
+                pages[panel.channel_map[channel]] = i
+        _channel_page_cache[key] = pages
+    return _channel_page_cache[key]
+
+
+def _channel_name(page):
+    assert page.tags[270].name == "ImageDescription",\
+        f"Expected tag 270: ImageDescription, found {page.tags[270].name}"
+    im_desc = xmltodict.parse(page.tags[270].value)
+    return im_desc['PerkinElmer-QPI-ImageDescription']['Name']
+
+
+class Slide:
+    '''
+    A qptiff's channels as lazily decoded 2d arrays, indexed by marker. Each channel has its own file handle,
+    opened on first use, so channels can be read from different threads. Open channels are not pickled.
+    '''
+    def __init__(self, path, panel=ImmunePanel):
+        self.path = pathlib.Path(path)
+        self.panel = panel
+        self.pages = _channel_pages(self.path, panel)
+        if not self.pages:
+            raise ValueError(f'{self.path} has no channels mapped by {panel.__name__}')
+        with tifffile.TiffFile(self.path) as tf:
+            page = tf.pages[next(iter(self.pages.values()))]
+            self.shape = tuple(page.shape[:2])
+            self.dtype = page.dtype
+        self._channels = {}
+
+    @property
+    def markers(self):
+        return list(self.pages)
+
+    def __contains__(self, marker):
+        return marker in self.pages
+
+    def __getitem__(self, marker):
+        '''The marker's channel, to be read by slicing as slide[marker][y0:y1, x0:x1].'''
+        if marker not in self.pages:
+            raise KeyError(f'"{marker}" is not a channel of {self.path}, expected one of {self.markers}')
+        if marker not in self._channels:
+            self._channels[marker] = _TiffWindowReader(self.path, page=self.pages[marker])
+        return self._channels[marker]
+
+    def window(self, x0:int, y0:int, x1:int, y1:int, markers=None):
+        '''The (x0, y0) to (x1, y1) window of the given markers (default all), stacked as (marker, y, x).'''
+        markers = self.markers if markers is None else list(markers)
+        if not markers:
+            return np.zeros((0, max(0, y1 - y0), max(0, x1 - x0)), dtype=self.dtype)
+        return np.stack([self[marker].window(y0, y1, x0, x1) for marker in markers])
+
+    def close(self):
+        for channel in self._channels.values():
+            channel.close()
+        self._channels = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['_channels'] = {}
+        return state
+
+    def __repr__(self):
+        return f'Slide({self.path}, {self.shape[1]}x{self.shape[0]} {self.dtype}, {self.markers})'
@@ -0,0 +1,224 @@
+'''
+Spatial index over cell centroids, for neighbourhood queries without brute force O(N^2) scripts.
+
+    vda.build_spatial_index('experiment', 'sample')
+    index = vda.spatial.load_spatial_index('experiment', 'sample')
+    near = index.query_radius(points, 30)                         # Object Ids within 30 um of each point
+    counts = index.count_neighbours(points, 30, among=is_tumour)  # how many of those are tumour cells
+    distances, ids = index.query_knn(points, k=5)
+    ids = index.query_window(x0, y0, x1, y1)
+
+Points and windows are (x, y) in pixels, as in the centroid table, and distances are in um using DeepcellConfig.image_mpp.
+Centroids are bucketed in a uniform grid of DeepcellConfig.spatial_grid_um square cells, sorted by grid cell with
+an offsets array like a CSR matrix, and saved next to the centroid table as <basename>_spatial_index.npz.
+'''
+import pathlib
+import numpy as np
+import pandas as pd
+
+from .config import DeepcellConfig
+from ._helpers._cache import _StageCache, _config_fields
+from ._helpers._tables import _find_table, _read_table
+from ._helpers._names import _deepcell_basename
+from ._helpers import _tables
+from .metrics import _measure, _logger
+
+
+def build_spatial_index(folder, name,
+        compartment='whole-cell',
+        nucleus_channel:str='DAPI',
+        membrane_channel:str='ECad',
+        interior_threshold:float=None,
+        maxima_threshold:float=None):
+    '''
+    Input: 'centroids/<folder>/<name>/<name>_<deepcell config>_centroids.csv' (or .parquet)
+    Output: 'centroids/<folder>/<name>/<name>_<deepcell config>_spatial_index.npz'
+    '''
+    basename = _deepcell_basename(name, compartment, nucleus_channel, membrane_channel, interior_threshold, maxima_threshold)
+    outfolder = pathlib.Path('centroids', folder, name)
+    infile = _find_table(pathlib.Path(outfolder, f'{basename}_centroids'))
+    outfile = pathlib.Path(outfolder, f'{basename}_spatial_index.npz')
+    cache = _StageCache(pathlib.Path(outfolder, f'.{basename}_spatial_index.manifest.json'),
+        [infile], _config_fields('image_mpp', 'spatial_grid_um'), [__file__, _tables.__file__], [outfile])
+    if cache.is_fresh():
+        _logger.info(f'{infile} is unchanged, skipping')
+        return
+    with _measure('spatial_index', sample=name) as m:
+        centroids = _read_table(infile, ['centroid_x_pixels', 'centroid_y_pixels'])
+        index = SpatialIndex(centroids.index.to_numpy(), centroids['centroid_x_pixels'].to_numpy(), centroids['centroid_y_pixels'].to_numpy())
+        index.save(outfile)
+        m.count('cells', len(centroids))
+    cache.record()
+
+
+def load_spatial_index(folder, name,
+        compartment='whole-cell',
+        nucleus_channel:str='DAPI',
+        membrane_channel:str='ECad',
+        interior_threshold:float=None,
+        maxima_threshold:float=None):
+    '''Load the index saved by build_spatial_index.'''
+    basename = _deepcell_basename(name, compartment, nucleus_channel, membrane_channel, interior_threshold, maxima_threshold)
+    infile = pathlib.Path('centroids', folder, name, f'{basename}_spatial_index.npz')
+    if not infile.is_file():
+        raise FileNotFoundError(f'{infile} does not exist or is a directory, run build_spatial_index first')
+    return SpatialIndex.load(infile)
+
+
+class SpatialIndex:
+    '''
+    Uniform grid of centroids. Radius, window and neighbour count queries scan only the grid cells in range,
+    k nearest neighbour queries use a scipy cKDTree built on first use.
+    Query results are Object Ids. Masks (`among`) are boolean Series indexed by Object Id, or arrays in Object Id order.
+    '''
+    # queries are expanded to candidate pairs this many at a time, bounding memory for millions of points
+    batch_size = 1 << 16
+
+    def __init__(self, ids, x, y, mpp:float=None, grid_um:float=None, _sorted:dict=None):
+        self.mpp = mpp if mpp is not None else DeepcellConfig.image_mpp
+        self.grid_px = (grid_um if grid_um is not None else DeepcellConfig.spatial_grid_um) / self.mpp
+        if _sorted is not None:
+            self.__dict__.update(_sorted)
+            self._tree = None
+            return
+        ids, x, y = np.asarray(ids, dtype='int64'), np.asarray(x, dtype='float64'), np.asarray(y, dtype='float64')
+        self.origin = np.array([x.min(initial=0), y.min(initial=0)])
+        gx, gy = self._cell_of(x, y)
+        self.grid_shape = (int(gy.max(initial=0)) + 1, int(gx.max(initial=0)) + 1)
+        cell = gy * self.grid_shape[1] + gx
+        order = np.argsort(cell, kind='stable')
+        self.ids, self.x, self.y = ids[order], x[order], y[order]
+        self.cell_start = np.searchsorted(cell[order], np.arange(self.grid_shape[0] * self.grid_shape[1] + 1))
+        self._tree = None
+
+    def __len__(self):
+        return self.ids.size
+
+    def save(self, path):
+        np.savez(path, ids=self.ids, x=self.x, y=self.y, cell_start=self.cell_start, origin=self.origin,
+            grid_shape=np.array(self.grid_shape), mpp=self.mpp, grid_px=self.grid_px)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            mpp, grid_px = float(f['mpp']), float(f['grid_px'])
+            fields = dict(ids=f['ids'], x=f['x'], y=f['y'], cell_start=f['cell_start'], origin=f['origin'],
+                grid_shape=tuple(int(n) for n in f['grid_shape']))
+        return cls(None, None, None, mpp, grid_px * mpp, _sorted=fields)
+
+    def _cell_of(self, x, y):
+        gx = np.floor((x - self.origin[0]) / self.grid_px).astype('int64')
+        gy = np.floor((y - self.origin[1]) / self.grid_px).astype('int64')
+        return gx, gy
+
+    def _pairs(self, qx, qy, radius_px:float):
+        '''Yield (query index, point index) pairs within radius_px, for batches of queries.'''
+        reach = int(np.ceil(radius_px / self.grid_px))
+        rows, cols = self.grid_shape
+        for b0 in range(0, qx.size, self.batch_size):
+            bx, by = qx[b0:b0+self.batch_size], qy[b0:b0+self.batch_size]
+            gx, gy = self._cell_of(bx, by)
+            queries, points = [], []
+            for dy in range(-reach, reach + 1):
+                for dx in range(-reach, reach + 1):
+                    cx, cy = gx + dx, gy + dy
+                    valid = np.flatnonzero((cx >= 0) & (cx < cols) & (cy >= 0) & (cy < rows))
+                    cell = cy[valid] * cols + cx[valid]
+                    start, end = self.cell_start[cell], self.cell_start[cell + 1]
+                    n = end - start
+                    q = np.repeat(valid, n)
+                    # index of each candidate within its cell's run of sorted points
+                    p = np.repeat(start - np.cumsum(n) + n, n) + np.arange(n.sum())
+                    near = (self.x[p] - bx[q])**2 + (self.y[p] - by[q])**2 <= radius_px**2
+                    queries.append(q[near] + b0)
+                    points.append(p[near])
+            yield np.concatenate(queries), np.concatenate(points)
+
+    def query_radius(self, points, radius_um:float):
+        '''Sorted Object Ids within radius_um of each (x, y) point, as a list of arrays.'''
+        qx, qy = _xy(points)
+        queries, ids = [np.zeros(0, dtype='int64')], [np.zeros(0, dtype='int64')]
+        for q, p in self._pairs(qx, qy, radius_um / self.mpp):
+            # batches are in query order, so sorting within each batch sorts the whole result
+            order = np.lexsort((self.ids[p], q))
+            queries.append(q[order])
+            ids.append(self.ids[p[order]])
+        if qx.size == 0:
+            return []
+        return np.split(np.concatenate(ids), np.searchsorted(np.concatenate(queries), np.arange(1, qx.size)))
+
+    def count_neighbours(self, points, radius_um:float, among=None):
+        '''
+        Number of cells within radius_um of each point, counting only cells where `among` is True if given.
+        Points which are themselves indexed cells count themselves.
+        '''
+        qx, qy = _xy(points)
+        weights = None if among is None else self._mask(among)
+        counts = np.zeros(qx.size, dtype='int64')
+        for q, p in self._pairs(qx, qy, radius_um / self.mpp):
+            counts += np.bincount(q, weights=None if weights is None else weights[p], minlength=qx.size).astype('int64')
+        return counts
+
+    def neighbour_counts(self, radius_um:float, among=None):
+        '''Neighbour count feature for every indexed cell, excluding the cell itself, as a Series indexed by Object Id.'''
+        counts = self.count_neighbours(np.stack((self.x, self.y), axis=1), radius_um, among)
+        counts -= 1 if among is None else self._mask(among).astype('int64')
+        return pd.Series(counts, index=pd.Index(self.ids, name='Object Id')).sort_index()
+
+    def query_knn(self, points, k:int=1):
+        '''Distances in um and Object Ids of the k nearest cells to each point, each of shape (n, k).'''
+        qx, qy = _xy(points)
+        if len(self) == 0:
+            # every neighbour is missing, as when k exceeds the number of cells
+            return np.full((qx.size, k), np.inf), np.full((qx.size, k), -1, dtype=self.ids.dtype)
+        if self._tree is None:
+            from scipy.spatial import cKDTree
+            self._tree = cKDTree(np.stack((self.x, self.y), axis=1))
+        distances, index = self._tree.query(np.stack((qx, qy), axis=1), k=k)
+        distances, index = distances.reshape(qx.size, k), index.reshape(qx.size, k)
+        # missing neighbours (k > number of cells) come back as index n and infinite distance
+        ids = np.where(index < self.ids.size, self.ids[np.minimum(index, self.ids.size - 1)], -1)
+        return distances * self.mpp, ids
+
+    def query_window(self, x0:float, y0:float, x1:float, y1:float):
+        '''Object Ids of cells with x0 <= x < x1 and y0 <= y < y1, in pixels.'''
+        return self.ids[self._window(x0, y0, x1, y1)]
+
+    def query_polygon(self, vertices):
+        '''Object Ids of cells inside a polygon given as (x, y) vertices in pixels.'''
+        from skimage.measure import points_in_poly
+        vertices = np.asarray(vertices, dtype='float64')
+        (x0, y0), (x1, y1) = vertices.min(axis=0), vertices.max(axis=0)
+        p = self._window(x0, y0, np.nextafter(x1, np.inf), np.nextafter(y1, np.inf))
+        inside = points_in_poly(np.stack((self.x[p], self.y[p]), axis=1), vertices)
+        return self.ids[p[inside]]
+
+    def _window(self, x0, y0, x1, y1):
+        (gx0, gx1), (gy0, gy1) = self._cell_of(np.array([x0, x1]), np.array([y0, y1]))
+        gx0, gy0 = max(gx0, 0), max(gy0, 0)
+        gx1, gy1 = min(gx1, self.grid_shape[1] - 1), min(gy1, self.grid_shape[0] - 1)
+        if gx0 > gx1 or gy0 > gy1:
+            return np.zeros(0, dtype='int64')
+        # a grid row is contiguous between its first and last cell in range
+        cols = self.grid_shape[1]
+        rows = np.arange(gy0, gy1 + 1)
+        p = np.concatenate([np.arange(self.cell_start[r*cols + gx0], self.cell_start[r*cols + gx1 + 1]) for r in rows])
+        inside = (self.x[p] >= x0) & (self.x[p] < x1) & (self.y[p] >= y0) & (self.y[p] < y1)
+        return p[inside]
+
+    def _mask(self, among):
+        '''
+        A mask over indexed cells in index order, from a boolean Series indexed by Object Id,
+        or an array in ascending Object Id order (the row order of the centroid table).
+        '''
+        if isinstance(among, pd.Series):
+            return among.reindex(self.ids, fill_value=False).to_numpy(dtype=bool)
+        among = np.asarray(among, dtype=bool)
+        if among.size != self.ids.size:
+            raise ValueError(f'Expected a mask of {self.ids.size} cells, got {among.size}')
+        return among[np.argsort(np.argsort(self.ids, kind='stable'), kind='stable')]
+
+
+def _xy(points):
+    points = np.asarray(points, dtype='float64').reshape(-1, 2)
+    return points[:, 0], points[:, 1]
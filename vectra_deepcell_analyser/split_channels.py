@@ -1,48 +1,93 @@
 import tifffile
-import xmltodict
 import pathlib
-import warnings
+import os
+from concurrent.futures import ThreadPoolExecutor
 
 from ._helpers._get_files import _get_files
+from ._helpers._tiff_window import _TiffWindowReader
+from ._helpers._tiff_writer import _write_tiled
+from ._helpers._cache import _StageCache, _config_fields, _panel_fields
+from ._helpers._zarr_store import _ZarrStore
+from ._helpers import _tiff_window, _tiff_writer, _zarr_store
+from .config import DeepcellConfig
+from .metrics import _measure, _logger
 from .panel_data import ImmunePanel
+from .slide import _channel_pages
+from . import slide
 
 
-def split_immune_qptiff(folder, name=None):
+def split_immune_qptiff(folder, name=None, n_threads:int=None, contiguous:bool=False):
     if name is None:
         for file in _get_files(pathlib.Path('qptiffs', folder), '.*\.qptiff'):
-            split_immune_qptiff(folder, file.rstrip('.qptiff'))
+            split_immune_qptiff(folder, file.rstrip('.qptiff'), n_threads, contiguous)
     else:
-        worker = _SplitQpTiff(folder, name, ImmunePanel)
+        worker = _SplitQpTiff(folder, name, ImmunePanel, n_threads, contiguous)
         worker.process()
 
 
 class _SplitQpTiff:
-    def __init__(self, folder, name, config):
+    '''
+    Splits each mapped qptiff page into its own tiff.
+    Pages are decoded and written concurrently, each streamed in bands of DeepcellConfig.tiff_tile_size rows.
+    Output is a tiled, compressed BigTIFF, or an uncompressed contiguous tiff which can be memory mapped
+    (e.g. by run_pipeline_in_memory) if contiguous is True.
+    With DeepcellConfig.storage = 'zarr' each channel is written to channels/<marker> of the sample's zarr store instead.
+    Skipped if the qptiff, panel and settings are unchanged since the last run,
+    or if DeepcellConfig.channels_from_qptiff is set as the stages then read the qptiff directly.
+    '''
+    def __init__(self, folder, name, config, n_threads=None, contiguous=False):
         self.folder = folder
         self.name = name
         self.config = config
+        self.n_threads = n_threads
+        self.contiguous = contiguous
 
     def process(self):
         input_file = pathlib.Path('qptiffs', self.folder, f'{self.name}.qptiff')
         if not input_file.exists() or not input_file.is_file():
             raise FileNotFoundError(f'{input_file} was not found or is a directory')
-        tf = tifffile.TiffFile(input_file)
+        self.input_file = input_file
+        if DeepcellConfig.channels_from_qptiff and DeepcellConfig.storage == 'tiff':
+            _logger.info(f'{input_file} channels are read in place, no split is needed')
+            return
         pathlib.Path('unstacked', self.folder).mkdir(exist_ok=True, parents=True)
-        self._process_tiff(tf)
-
-    def _process_tiff(self, tf:tifffile.TiffFile):
-        for i in range(self.config.n_channels):
-            self._process_page(tf.pages[i])
-
-    def _process_page(self, page):
-        assert page.tags[270].name == "ImageDescription",\
-            f"Expected tag 270: ImageDescription, found {page.tags[270].name}"
-        im_desc = xmltodict.parse(page.tags[270].value)
-        channel = im_desc['PerkinElmer-QPI-ImageDescription']['Name']
-        if not channel in self.config.channel_map:
-            warnings.warn(f"Unmapped channel \"{channel}\", ignoring.", UserWarning)
+        params = dict(_panel_fields(self.config), contiguous=self.contiguous,
+            **_config_fields('tiff_tile_size', 'tiff_compression', 'storage'))
+        if DeepcellConfig.storage == 'zarr':
+            # zarr chunks are aligned to the segmentation tiles
+            params.update(_config_fields('zarr_compression', 'zarr_compression_level', 'tile_width', 'tile_height'))
+        cache = _StageCache(pathlib.Path('unstacked', self.folder, f'.{self.name}.manifest.json'),
+            [input_file], params, [__file__, slide.__file__, _tiff_window.__file__, _tiff_writer.__file__, _zarr_store.__file__])
+        if cache.is_fresh():
+            _logger.info(f'{input_file} is unchanged, skipping')
             return
-        
-        tifffile.imwrite(
-            pathlib.Path('unstacked', self.folder, f"{self.name}_{self.config.channel_map[channel]}.tif"),
-            page.asarray())
+        with _measure('split', sample=self.name) as m:
+            outputs = self._process_tiff()
+            m.count('channels', len(outputs))
+        cache.record(outputs)
+
+    def _process_tiff(self):
+        pages = [(i, channel) for channel, i in _channel_pages(self.input_file, self.config).items()]
+        n_threads = self.n_threads if self.n_threads is not None else min(len(pages), os.cpu_count())
+        with ThreadPoolExecutor(max(1, n_threads)) as executor:
+            return list(executor.map(lambda page: self._process_page(*page), pages))
+
+    def _process_page(self, index:int, channel:str):
+        outfile = pathlib.Path('unstacked', self.folder, f"{self.name}_{channel}.tif")
+        # each thread has its own file handle, so pages decode in parallel
+        with _measure('split', 'page', sample=self.name, channel=channel), \
+                _TiffWindowReader(self.input_file, page=index) as page:
+            band_height = DeepcellConfig.tiff_tile_size
+            if DeepcellConfig.storage == 'zarr':
+                store = _ZarrStore(self.folder, self.name)
+                store.write_strips(f'channels/{channel}', page.iter_strips(band_height), page.shape, page.dtype)
+                outfile = pathlib.Path(store.path, 'channels', channel)
+            elif self.contiguous:
+                out = tifffile.memmap(outfile, shape=page.shape, dtype=page.dtype, bigtiff=True)
+                for y0, band in page.iter_strips(band_height):
+                    out[y0:y0+band.shape[0]] = band
+                out.flush()
+                del out
+            else:
+                _write_tiled(outfile, page.iter_strips(band_height), page.shape, page.dtype)
+        return outfile
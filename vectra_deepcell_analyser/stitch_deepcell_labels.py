@@ -5,6 +5,14 @@ import re
 import tifffile
 
 from .config import DeepcellConfig
+from ._helpers._union_find import _UnionFind
+from ._helpers._seams import _resolve_seam
+from ._helpers._tiff_writer import _write_tiled
+from ._helpers._cache import _StageCache, _config_fields
+from ._helpers._zarr_store import _channel_reader, _channel_path
+from ._helpers import _seams, _union_find, _tiff_writer
+from .metrics import _measure, _profile, _logger
+from .detect_tissue import _occupied_tiles, _tissue_inputs
 
 def stitch_deepcell_labels(
         folder, name,
@@ -13,11 +21,12 @@ def stitch_deepcell_labels(
         membrane_channel:str='ECad',
         interior_threshold:float=None,
         maxima_threshold:float=None):
-    x_stitch_worker = _StitchDeepcellLabelsX(folder, name, compartment, nucleus_channel, membrane_channel, interior_threshold, maxima_threshold)
-    x_stitch_worker.process()
-    
-    y_stitch_worker = _StitchDeepcellLabelsY(folder, name, compartment, nucleus_channel, membrane_channel, interior_threshold, maxima_threshold)
-    y_stitch_worker.process()
+    if DeepcellConfig.storage == 'zarr':
+        from .pipeline import _ZarrStitcher as worker_class
+    else:
+        worker_class = _StitchDeepcellLabels
+    worker = worker_class(folder, name, compartment, nucleus_channel, membrane_channel, interior_threshold, maxima_threshold)
+    worker.process()
 
 def stitch_deepcell_labels_y(
         folder, name,
@@ -40,6 +49,183 @@ def stitch_deepcell_labels_x(
     x_stitch_worker.process()
 
 
+def _original_shape(folder, name, nucleus_channel):
+    '''The nucleus channel and its dimensions, read from its header.'''
+    p = _channel_path(folder, name, nucleus_channel)
+    if not p.exists():
+        raise FileNotFoundError(f'{p} does not exist. Used to check original image dimensions')
+    with _channel_reader(folder, name, nucleus_channel) as reader:
+        return p, reader.shape
+
+
+class _StitchDeepcellLabels:
+    '''
+    Stitches the full grid of deepcell label tiles, reading each tile once.
+    Each tile owns its unpadded core region. Labels are offset to be unique per tile,
+    labels seen by both tiles of a seam are recorded as equivalent in a union-find,
+    and a single lookup table relabel gives sequential ids for the whole slide.
+    '''
+    def __init__(self, folder, name, compartment, nucleus_channel, membrane_channel, interior_threshold, maxima_threshold):
+        self.folder = folder
+        self.name = name
+        self.compartment = compartment
+        self.nucleus_channel = nucleus_channel
+        self.membrane_channel = membrane_channel
+        self.interior_threshold = interior_threshold if interior_threshold is not None else DeepcellConfig.interior_threshold
+        self.maxima_threshold = maxima_threshold if maxima_threshold is not None else DeepcellConfig.maxima_threshold
+
+        self.shape_file, self.original_shape = _original_shape(folder, name, nucleus_channel)
+
+        self.tile_basename = f'{name}_{compartment}_{nucleus_channel}_{membrane_channel}_{str(int(self.interior_threshold*1000))}_{str(int(self.maxima_threshold*1000))}'
+        self.tiles_folder = pathlib.Path('deepcell_labelled_tiles', folder, name, self.tile_basename)
+        if not self.tiles_folder.is_dir():
+            raise FileNotFoundError(f'{self.tiles_folder} is not a directory')
+
+    def process(self):
+        '''Stitch, unless the label tiles, stitching settings and code are unchanged since the last run.'''
+        outfolder = pathlib.Path('deepcell_labelled', self.folder, self.name)
+        pattern = re.compile(f'{self.tile_basename}_\\d+_\\d+\\.tif')
+        tiles = [pathlib.Path(self.tiles_folder, f) for f in sorted(os.listdir(self.tiles_folder)) if pattern.fullmatch(f)]
+        cache = _StageCache(pathlib.Path(outfolder, f'.{self.tile_basename}.manifest.json'),
+            tiles + [self.shape_file] + _tissue_inputs(self.folder, self.name),
+            _config_fields('tile_width', 'tile_height', 'tile_padding_x', 'tile_padding_y',
+                'stitch_iou_threshold', 'stitch_min_fragment_size', 'tiff_tile_size', 'tiff_compression', 'skip_background_tiles'),
+            [__file__, _seams.__file__, _union_find.__file__, _tiff_writer.__file__],
+            [pathlib.Path(outfolder, f'{self.tile_basename}.tif')])
+        if cache.is_fresh():
+            _logger.info(f'{self.tiles_folder} is unchanged, skipping')
+            return
+        self._stitch()
+        cache.record()
+
+    def _stitch(self):
+        self.occupied = _occupied_tiles(self.folder, self.name)
+        with _measure('stitch', sample=self.name) as m:
+            self.metrics = m
+            self._stitch_passes()
+            m.count('tiles', len(self.offsets))
+
+    def _stitch_passes(self):
+        self.union_find = _UnionFind()
+        self.drops = []
+        self.offsets = {}
+        self.bands = {}
+        self.present = np.zeros(1, dtype=bool)
+
+        # first pass resolves every seam, keeping the composed seam bands, and finds which labels survive
+        self._keep_strips(self._mark_present(self._iter_stitched_strips()))
+        present = self.present
+        present[np.concatenate(self.drops + [np.zeros(0, dtype='int64')])] = False
+        self.union_find.grow(present.size)
+        lut = self.union_find.lookup_table(present).astype('uint32')
+        self.metrics.count('cells', lut.max(initial=0))
+        self.metrics.count('dropped_fragments', sum(d.size for d in self.drops))
+
+        # second pass relabels and streams each tile row to file, so every pixel is written once
+        self._write_labels((y, lut[strip]) for y, strip in self._kept_strips())
+
+    def _keep_strips(self, strips):
+        '''
+        Consume the first pass. The kept seam bands, O(seam area) rather than slide area, are enough for
+        _kept_strips to recompose each tile row from its tiles again without resolving any seam.
+        '''
+        for _ in strips:
+            pass
+
+    def _kept_strips(self):
+        return self._iter_stitched_strips()
+
+    def _mark_present(self, strips):
+        '''Pass the strips through, recording which labels survive into self.present.'''
+        for y0, strip in strips:
+            for y in range(0, strip.shape[0], DeepcellConfig.strip_height):
+                seen = np.bincount(strip[y:y+DeepcellConfig.strip_height].reshape(-1)) > 0
+                if seen.size > self.present.size:
+                    self.present = np.concatenate((self.present, np.zeros(seen.size - self.present.size, dtype=bool)))
+                self.present[:seen.size] |= seen
+            yield y0, strip
+
+    def _write_labels(self, strips):
+        self.outfolder = pathlib.Path('deepcell_labelled', self.folder, self.name)
+        self.outfolder.mkdir(exist_ok=True, parents=True)
+        _write_tiled(pathlib.Path(self.outfolder, f'{self.tile_basename}.tif'), strips, self.original_shape, 'uint32')
+
+    def _origin(self, x:int, y:int):
+        return max(0, x - DeepcellConfig.tile_padding_x), max(0, y - DeepcellConfig.tile_padding_y)
+
+    def _load_tile(self, x:int, y:int):
+        x0, y0 = self._origin(x, y)
+        tile = tifffile.imread(pathlib.Path(self.tiles_folder, f'{self.tile_basename}_{x0}_{y0}.tif'))
+        # older segmentation output kept a trailing channel axis
+        return tile.reshape(tile.shape[:2])
+
+    def _iter_stitched_strips(self):
+        '''
+        Yield (y0, strip) for each tile row of the stitched slide, with labels before relabelling.
+        Each tile row is composed over its padded rows first, resolving the vertical seams between its tiles,
+        and the horizontal seam with the row above is then resolved on the two composed rows across the whole width.
+        So corners, where both seams overlap, are resolved once from what the vertical seams left.
+        A strip is only yielded once the seam with the tile row below has been resolved,
+        so at most two padded tile rows are held in memory.
+        '''
+        height, width = self.original_shape
+        offset = 0
+        above = None
+        for y in range(0, height, DeepcellConfig.tile_height):
+            row_y0 = max(0, y - DeepcellConfig.tile_padding_y)
+            row = np.zeros((min(y + DeepcellConfig.tile_height + DeepcellConfig.tile_padding_y, height) - row_y0, width), dtype='uint32')
+            left = None
+            for x in range(0, width, DeepcellConfig.tile_width):
+                with _measure('stitch', 'tile', sample=self.name, x=x, y=y):
+                    x0, _ = self._origin(x, y)
+                    if self.occupied is None or (x, y) in self.occupied:
+                        tile = self._load_tile(x, y).astype('uint32')
+                    else:
+                        # background tiles were never segmented
+                        tile = np.zeros((row.shape[0], min(x + DeepcellConfig.tile_width + DeepcellConfig.tile_padding_x, width) - x0),
+                            dtype='uint32')
+                    self.offsets[(x, y)] = offset
+                    offset += int(np.max(tile, initial=0))
+                    tile[tile>0] += self.offsets[(x, y)]
+                    x1 = min(x + DeepcellConfig.tile_width, width)
+                    row[:, x:x1] = tile[:, x-x0:x1-x0]
+                    if left is not None:
+                        # tiles of a row share their padded rows, so the band spans the whole seam
+                        s0, s1 = x - DeepcellConfig.tile_padding_x, min(x + DeepcellConfig.tile_padding_x, width)
+                        row[:, s0:s1] = self._join_seam((x, y), left[1][:, s0-left[0]:s1-left[0]], tile[:, s0-x0:s1-x0], 1, x - s0)
+                    left = (x0, tile)
+            if above is not None:
+                above_y, above_y0, above_row = above
+                s0, s1 = y - DeepcellConfig.tile_padding_y, min(y + DeepcellConfig.tile_padding_y, height)
+                band = self._join_seam((None, y), above_row[s0-above_y0:s1-above_y0], row[s0-row_y0:s1-row_y0], 0, y - s0)
+                above_row[s0-above_y0:s1-above_y0] = band
+                row[s0-row_y0:s1-row_y0] = band
+                yield above_y, above_row[above_y-above_y0:y-above_y0]
+            above = (y, row_y0, row)
+        if above is not None:
+            above_y, above_y0, above_row = above
+            yield above_y, above_row[above_y-above_y0:]
+
+    def _join_seam(self, key, l, r, axis, mid):
+        '''
+        Resolve the band of a seam, returning the composed band. axis=1 is a vertical seam, axis=0 a horizontal one.
+        Bands are kept by key, the grid position of the tile (x, y) after a vertical seam or (None, y) of the tile row
+        after a horizontal one, and returned as they were when the seam is met again.
+        '''
+        if key in self.bands:
+            return self.bands[key]
+        if l.shape[axis] <= mid:
+            return l
+        with _profile('stitch.resolve_seam'):
+            band, merges, drops = _resolve_seam(l, r, axis, mid,
+                DeepcellConfig.stitch_iou_threshold, DeepcellConfig.stitch_min_fragment_size)
+        self.union_find.union_pairs(merges[0], merges[1])
+        self.drops.append(drops)
+        self.metrics.count('seams')
+        self.bands[key] = band
+        return band
+
+
 class _StitchDeepcellLabelsX:
     def __init__(self, folder, name, compartment, nucleus_channel, membrane_channel, interior_threshold, maxima_threshold):
         self.folder = folder
@@ -50,11 +236,7 @@ class _StitchDeepcellLabelsX:
         self.interior_threshold = interior_threshold if interior_threshold is not None else DeepcellConfig.interior_threshold
         self.maxima_threshold = maxima_threshold if maxima_threshold is not None else DeepcellConfig.maxima_threshold
     
-        p = pathlib.Path('unstacked', folder, f'{name}_{nucleus_channel}.tif')
-        if not p.is_file():
-            raise FileNotFoundError(f'{p} does not exist or is a directory. Used to check original image dimensions')
-        im = tifffile.TiffFile(p)
-        self.original_shape = im.pages[0].shape
+        _, self.original_shape = _original_shape(folder, name, nucleus_channel)
 
         self.tile_basename = f'{name}_{compartment}_{nucleus_channel}_{membrane_channel}_{str(int(self.interior_threshold*1000))}_{str(int(self.maxima_threshold*1000))}'
         self.tiles_folder = pathlib.Path('deepcell_labelled_tiles', folder, name, self.tile_basename)
@@ -64,93 +246,61 @@ class _StitchDeepcellLabelsX:
     def process(self):
         self.outfolder = pathlib.Path('deepcell_labelled_tiles_x_stitched', self.folder, self.name, self.tile_basename)
         self.outfolder.mkdir(exist_ok=True, parents=True)
+        self.occupied = _occupied_tiles(self.folder, self.name)
 
         for y in range(0, self.original_shape[0], DeepcellConfig.tile_height):
-            y0 = max(0, y-DeepcellConfig.tile_padding_y)
-            self._stitch_x(y0)
+            self._stitch_x(y)
 
     def _stitch_x(self, y):
-        print(f'Stitching y0:{y}')
-        ims = []
-        for x in range(0, self.original_shape[1], DeepcellConfig.tile_width):
-            x0 = max(0, x - DeepcellConfig.tile_padding_x)
-            im = tifffile.TiffFile(pathlib.Path(
-                self.tiles_folder, f'{self.tile_basename}_{x0}_{y}.tif'))
-            ims.append(im)
-        stitched = np.zeros((ims[0].pages[0].shape[0], self.original_shape[1]), dtype='uint32')
+        y0 = max(0, y-DeepcellConfig.tile_padding_y)
+        _logger.debug(f'Stitching y0:{y0}')
+        height, width = min(y + DeepcellConfig.tile_height + DeepcellConfig.tile_padding_y, self.original_shape[0]) - y0, self.original_shape[1]
+        xs = list(range(0, width, DeepcellConfig.tile_width))
+        tiles = [self._load_tile(x, y, height) for x in xs]
+        stitched = np.zeros((height, width), dtype='uint32')
 
         offsets = [0]
-        for i, im in enumerate(ims):
-            x0 = i*DeepcellConfig.tile_width
-            x1 = (i+1)*DeepcellConfig.tile_width
-            x0 += DeepcellConfig.tile_padding_x if i > 0 else 0
-            x1 -= DeepcellConfig.tile_padding_x if i < len(ims)-1 else 0
-            tile_x0 = 2*DeepcellConfig.tile_padding_x
-            tile_x1 = tile_x0 + DeepcellConfig.tile_width - 2*DeepcellConfig.tile_padding_x
-            tile_x0 = 0 if i <= 0 else tile_x0
-            tile_x1 -= DeepcellConfig.tile_padding_x if i <= 0 else 0
-            
-            tile = im.pages[0].asarray()
-            offsets.append(offsets[-1] + np.max(tile))
-            tile = tile[:, tile_x0:tile_x1]
+        for i, (x, tile) in enumerate(zip(xs, tiles)):
+            offsets.append(offsets[-1] + int(np.max(tile, initial=0)))
             tile[tile>0] += offsets[i]
-            stitched[:, x0:x1] = tile
-        print(f'Done basic stitch y0:{y}')
-        self.overflow_cid = offsets[-1] + 1
-
-        for i in range(len(ims)-1):
-            print(f'Solving overlap #{i}')
-            x0 = (i+1)*DeepcellConfig.tile_width - DeepcellConfig.tile_padding_x
-            x1 = (i+1)*DeepcellConfig.tile_width + DeepcellConfig.tile_padding_x
-            lx0 = DeepcellConfig.tile_width
-            if i == 0: lx0 -= DeepcellConfig.tile_padding_x
-            rx1 = DeepcellConfig.tile_padding_x * 2
-            l = ims[i].pages[0].asarray()[:, lx0:]
-            l[l>0] += offsets[i]
-            r = ims[i+1].pages[0].asarray()[:, :rx1]
-            r[r>0] += offsets[i+1]
-            self._solve_overlap(
-                l, r, stitched, x0, x1)
-        
-        outfile = pathlib.Path(self.outfolder, f'{self.tile_basename}_{y}.tif')
+            x0 = x + (DeepcellConfig.tile_padding_x if i > 0 else 0)
+            x1 = x + DeepcellConfig.tile_width - DeepcellConfig.tile_padding_x if i < len(xs)-1 else width
+            tile_x0 = max(0, x - DeepcellConfig.tile_padding_x)
+            stitched[:, x0:x1] = tile[:, x0-tile_x0:x1-tile_x0]
+        _logger.debug(f'Done basic stitch y0:{y0}')
+        self.union_find = _UnionFind(offsets[-1] + 1)
+        self.drops = []
+
+        for i in range(len(xs)-1):
+            _logger.debug(f'Solving overlap #{i}')
+            x0 = xs[i+1] - DeepcellConfig.tile_padding_x
+            l = tiles[i][:, x0-max(0, xs[i]-DeepcellConfig.tile_padding_x):]
+            r = tiles[i+1][:, :DeepcellConfig.tile_padding_x*2]
+            self._solve_overlap(l, r, stitched, x0, x0 + l.shape[1])
+
+        lut = self.union_find.lookup_table().astype('uint32')
+        lut[np.concatenate(self.drops + [np.zeros(0, dtype='int64')])] = 0
+        stitched = lut[stitched]
+
+        outfile = pathlib.Path(self.outfolder, f'{self.tile_basename}_{y0}.tif')
         tifffile.imwrite(outfile, stitched)
 
-    def _solve_overlap(self, l, r, stitched, x0, x1):
-        cs = set(l[:,l.shape[1]//2].reshape(-1))
-        cs.add(0)
-        cs.remove(0)
-        lmask = np.zeros(l.shape, dtype=bool)
-        lmask[:,:l.shape[1]//2] = True
-        overlap_mask = np.isin(l, list(cs))
-        lmask[overlap_mask] = True
-
-        rmask = np.ones(l.shape, dtype=bool)
-        rmask[:,:l.shape[1]//2] = False
-        cs = set(r[:,r.shape[1]//2]).union(set(r[overlap_mask]))
-        cs.add(0)
-        cs.remove(0)
-        rmask[np.isin(r, list(cs))] = False
-
-        stitched[:,x0:x1][lmask] = l[lmask]
-        stitched[:,x0:x1][rmask] = r[rmask]
-        stitched = self._fill_holes(l, r, lmask, rmask, stitched, x0, x1)
-        return stitched
+    def _load_tile(self, x:int, y:int, height:int):
+        x0 = max(0, x - DeepcellConfig.tile_padding_x)
+        if self.occupied is not None and (x, y) not in self.occupied:
+            # background tiles were never segmented
+            return np.zeros((height, min(x + DeepcellConfig.tile_width + DeepcellConfig.tile_padding_x, self.original_shape[1]) - x0),
+                dtype='uint32')
+        y0 = max(0, y - DeepcellConfig.tile_padding_y)
+        tile = tifffile.imread(pathlib.Path(self.tiles_folder, f'{self.tile_basename}_{x0}_{y0}.tif'))
+        return tile.reshape(tile.shape[:2]).astype('uint32')
 
-    def _fill_holes(self, l, r, lmask, rmask, stitched, x0, x1):
-        print(f'Filling holes')
-        candidates = (~(lmask|rmask))&((l>0)|(r>0))
-        missing = 0
-        for i, j in zip(*candidates.nonzero()):
-            if stitched[:,x0:x1][i, j] > 0 or l[i,j]<=0 or r[i,j]<=0:
-                continue
-            lm = (l==l[i,j]) & (stitched[:,x0:x1]<=0)
-            rm = (r==r[i,j]) & (stitched[:,x0:x1]<=0)
-            m = lm|rm
-            if m.sum() > 50:
-                missing += 1
-                stitched[:,x0:x1][m] = self.overflow_cid
-                self.overflow_cid += 1
-        print(f'Filled {missing} missing cells')
+    def _solve_overlap(self, l, r, stitched, x0, x1):
+        band, merges, drops = _resolve_seam(l, r, 1, l.shape[1]//2,
+            DeepcellConfig.stitch_iou_threshold, DeepcellConfig.stitch_min_fragment_size)
+        stitched[:,x0:x1] = band
+        self.union_find.union_pairs(merges[0], merges[1])
+        self.drops.append(drops)
         return stitched
 
 
@@ -164,11 +314,7 @@ class _StitchDeepcellLabelsY:
         self.interior_threshold = interior_threshold if interior_threshold is not None else DeepcellConfig.interior_threshold
         self.maxima_threshold = maxima_threshold if maxima_threshold is not None else DeepcellConfig.maxima_threshold
     
-        p = pathlib.Path('unstacked', folder, f'{name}_{nucleus_channel}.tif')
-        if not p.is_file():
-            raise FileNotFoundError(f'{p} does not exist or is a directory. Used to check original image dimensions')
-        im = tifffile.TiffFile(p)
-        self.original_shape = im.pages[0].shape
+        _, self.original_shape = _original_shape(folder, name, nucleus_channel)
 
         self.tile_basename = f'{name}_{compartment}_{nucleus_channel}_{membrane_channel}_{str(int(self.interior_threshold*1000))}_{str(int(self.maxima_threshold*1000))}'
         self.tiles_folder = pathlib.Path('deepcell_labelled_tiles_x_stitched', folder, name, self.tile_basename)
@@ -182,85 +328,51 @@ class _StitchDeepcellLabelsY:
         self._stitch_y()
 
     def _stitch_y(self):
-        ims = []
-        for y in range(0, self.original_shape[0], DeepcellConfig.tile_height):
-            y0 = max(0, y - DeepcellConfig.tile_padding_y)
-            im = tifffile.TiffFile(pathlib.Path(
-                self.tiles_folder, f'{self.tile_basename}_{y0}.tif'))
-            ims.append(im)
-        stitched = np.zeros(self.original_shape, dtype='uint32')
-
+        '''
+        Streams the x stitched rows to file in two passes. The first offsets each row and resolves its seam with
+        the row above, keeping only the seam bands. The second reads the rows again and writes each core and band once.
+        '''
+        height = self.original_shape[0]
+        rows = [max(0, y - DeepcellConfig.tile_padding_y) for y in range(0, height, DeepcellConfig.tile_height)]
+        self.union_find = _UnionFind()
+        self.drops = []
+        self.bands = []
         offsets = [0]
-        for i, im in enumerate(ims):
-            y0 = i*DeepcellConfig.tile_height
-            y1 = (i+1)*DeepcellConfig.tile_height
-            y0 += DeepcellConfig.tile_padding_y if i > 0 else 0
-            y1 -= DeepcellConfig.tile_padding_y if i < len(ims)-1 else 0
-            tile_y0 = 2*DeepcellConfig.tile_padding_y
-            tile_y1 = tile_y0 + DeepcellConfig.tile_height - 2*DeepcellConfig.tile_padding_y
-            tile_y0 = 0 if i <= 0 else tile_y0
-            tile_y1 -= DeepcellConfig.tile_padding_y if i <= 0 else 0
-            
-            tile = im.pages[0].asarray()
-            offsets.append(offsets[-1] + np.max(tile))
-            tile = tile[tile_y0:tile_y1,:]
+        above = None
+        for i, row_y0 in enumerate(rows):
+            tile = self._load_row(row_y0)
+            offsets.append(offsets[-1] + int(np.max(tile, initial=0)))
             tile[tile>0] += offsets[i]
-            stitched[y0:y1,:] = tile
-        self.overflow_cid = offsets[-1] + 1
-
-        for i in range(len(ims)-1):
-            outfile = pathlib.Path(self.outfolder, f'{self.tile_basename}.tif')
-            tifffile.imwrite(outfile, stitched)
-            print(f'Solving overlap #{i}')
-            y0 = (i+1)*DeepcellConfig.tile_height - DeepcellConfig.tile_padding_y
-            y1 = (i+1)*DeepcellConfig.tile_height + DeepcellConfig.tile_padding_y
-            ly0 = DeepcellConfig.tile_height
-            if i == 0: ly0 -= DeepcellConfig.tile_padding_y
-            ry1 = DeepcellConfig.tile_padding_y * 2
-            l = ims[i].pages[0].asarray()[ly0:, :]
-            l[l>0] += offsets[i]
-            r = ims[i+1].pages[0].asarray()[:ry1, :]
-            r[r>0] += offsets[i+1]
-            self._solve_overlap(
-                l, r, stitched, y0, y1)
-        
+            if above is not None:
+                _logger.debug(f'Solving overlap #{i-1}')
+                self._solve_overlap(above, tile[:DeepcellConfig.tile_padding_y*2])
+            above = tile[(i+1)*DeepcellConfig.tile_height - DeepcellConfig.tile_padding_y - row_y0:].copy()
+
+        self.union_find.grow(offsets[-1] + 1)
+        lut = self.union_find.lookup_table().astype('uint32')
+        lut[np.concatenate(self.drops + [np.zeros(0, dtype='int64')])] = 0
+
         outfile = pathlib.Path(self.outfolder, f'{self.tile_basename}.tif')
-        tifffile.imwrite(outfile, stitched)
+        _write_tiled(outfile, self._iter_strips(rows, offsets, lut), self.original_shape, 'uint32')
 
-    def _solve_overlap(self, l, r, stitched, y0, y1):
-        cs = set(l[l.shape[0]//2,:].reshape(-1))
-        cs.add(0)
-        cs.remove(0)
-        lmask = np.zeros(l.shape, dtype=bool)
-        lmask[:l.shape[0]//2,:] = True
-        overlap_mask = np.isin(l, list(cs))
-        lmask[overlap_mask] = True
-
-        rmask = np.ones(l.shape, dtype=bool)
-        rmask[:l.shape[0]//2,:] = False
-        cs = set(r[r.shape[0]//2,:]).union(set(r[overlap_mask]))
-        cs.add(0)
-        cs.remove(0)
-        rmask[np.isin(r, list(cs))] = False
-
-        stitched[y0:y1,:][lmask] = l[lmask]
-        stitched[y0:y1,:][rmask] = r[rmask]
-        stitched = self._fill_holes(l, r, lmask, rmask, stitched, y0, y1)
-        return stitched
+    def _iter_strips(self, rows, offsets, lut):
+        for i, row_y0 in enumerate(rows):
+            tile = self._load_row(row_y0)
+            tile[tile>0] += offsets[i]
+            y0 = i*DeepcellConfig.tile_height + (DeepcellConfig.tile_padding_y if i > 0 else 0)
+            if i < len(rows)-1:
+                y1 = (i+1)*DeepcellConfig.tile_height - DeepcellConfig.tile_padding_y
+                yield y0, lut[tile[y0-row_y0:y1-row_y0]]
+                yield y1, lut[self.bands[i]]
+            else:
+                yield y0, lut[tile[y0-row_y0:]]
+
+    def _load_row(self, y0):
+        return tifffile.imread(pathlib.Path(self.tiles_folder, f'{self.tile_basename}_{y0}.tif')).astype('uint32')
 
-    def _fill_holes(self, l, r, lmask, rmask, stitched, y0, y1):
-        print(f'Filling holes')
-        candidates = (~(lmask|rmask))&((l>0)|(r>0))
-        missing = 0
-        for i, j in zip(*candidates.nonzero()):
-            if stitched[y0:y1,:][i, j] > 0 or l[i,j]<=0 or r[i,j]<=0:
-                continue
-            lm = (l==l[i,j]) & (stitched[y0:y1,:]<=0)
-            rm = (r==r[i,j]) & (stitched[y0:y1,:]<=0)
-            m = lm|rm
-            if m.sum() > 50:
-                missing += 1
-                stitched[y0:y1,:][m] = self.overflow_cid
-                self.overflow_cid += 1
-        print(f'Filled {missing} missing cells')
-        return stitched
\ No newline at end of file
+    def _solve_overlap(self, l, r):
+        band, merges, drops = _resolve_seam(l, r, 0, l.shape[0]//2,
+            DeepcellConfig.stitch_iou_threshold, DeepcellConfig.stitch_min_fragment_size)
+        self.bands.append(band)
+        self.union_find.union_pairs(merges[0], merges[1])
+        self.drops.append(drops)
@@ -0,0 +1,135 @@
+'''
+Lazy readers for the centroid and marker tables.
+
+With DeepcellConfig.table_format = 'parquet' (needs pyarrow) calculate_centroids and compute_immune_markers write typed,
+compressed Parquet in row groups of DeepcellConfig.parquet_row_group_size, sorted by Object Id. Readers then load only
+the selected columns, and only the row groups whose Object Id range holds the selected ids:
+
+    centroids = vda.tables.open_centroids('experiment', 'sample')
+    centroids.read(['centroid_x_pixels', 'centroid_y_pixels'], object_ids=[12, 40])
+    cells = vda.tables.read_cells('experiment', 'sample', ['centroid_x_pixels', 'centroid_y_pixels', 'CD8'])
+
+CSV tables are read the same way, parsing only the selected columns.
+'''
+import pathlib
+import numpy as np
+import pandas as pd
+
+from .config import DeepcellConfig
+from ._helpers._tables import _find_table, _read_table, _import_pyarrow
+from ._helpers._names import _deepcell_basename
+
+
+def open_centroids(folder, name,
+        compartment='whole-cell',
+        nucleus_channel:str='DAPI',
+        membrane_channel:str='ECad',
+        interior_threshold:float=None,
+        maxima_threshold:float=None):
+    basename = _deepcell_basename(name, compartment, nucleus_channel, membrane_channel, interior_threshold, maxima_threshold)
+    return CellTable(_find_table(pathlib.Path('centroids', folder, name, f'{basename}_centroids')))
+
+
+def open_markers(folder, name,
+        compartment='whole-cell',
+        nucleus_channel:str='DAPI',
+        membrane_channel:str='ECad',
+        interior_threshold:float=None,
+        maxima_threshold:float=None):
+    basename = _deepcell_basename(name, compartment, nucleus_channel, membrane_channel, interior_threshold, maxima_threshold)
+    return CellTable(_find_table(pathlib.Path('output', folder, name, basename)))
+
+
+def read_cells(folder, name, columns=None, object_ids=None, **deepcell_config):
+    '''
+    Centroid and marker columns of the same cells, joined on Object Id.
+    `deepcell_config` takes the compartment, channels and thresholds as for open_centroids.
+    '''
+    centroids = open_centroids(folder, name, **deepcell_config)
+    markers = open_markers(folder, name, **deepcell_config)
+    if columns is None:
+        centroid_columns, marker_columns = None, None
+    else:
+        for c in columns:
+            if c not in centroids.columns and c not in markers.columns:
+                raise KeyError(f'"{c}" is not a centroid or marker column')
+        centroid_columns = [c for c in columns if c in centroids.columns]
+        marker_columns = [c for c in columns if c not in centroids.columns]
+    tables = []
+    if centroid_columns is None or centroid_columns:
+        tables.append(centroids.read(centroid_columns, object_ids))
+    if marker_columns is None or marker_columns:
+        tables.append(markers.read(marker_columns, object_ids))
+    cells = pd.concat(tables, axis=1, join='inner')
+    return cells if columns is None else cells[list(columns)]
+
+
+class CellTable:
+    '''A centroid or marker table, read on demand. Results are DataFrames indexed by Object Id.'''
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+        self._parquet = None
+        self._columns = None
+
+    @property
+    def parquet(self):
+        if self._parquet is None and self.path.suffix == '.parquet':
+            pa = _import_pyarrow()
+            self._parquet = pa.parquet.ParquetFile(self.path)
+        return self._parquet
+
+    @property
+    def columns(self):
+        if self._columns is None:
+            if self.parquet is not None:
+                names = self.parquet.schema_arrow.names
+            else:
+                names = list(pd.read_csv(self.path, nrows=0).columns)
+            self._columns = [c for c in names if c != 'Object Id']
+        return self._columns
+
+    def __len__(self):
+        if self.parquet is not None:
+            return self.parquet.metadata.num_rows
+        return len(pd.read_csv(self.path, usecols=['Object Id']))
+
+    def read(self, columns=None, object_ids=None):
+        '''Read the given columns (all if None), of the given Object Ids only if not None.'''
+        if self.parquet is None:
+            table = _read_table(self.path, columns)
+        elif object_ids is None:
+            table = self.parquet.read(columns=self._with_id(columns)).to_pandas().set_index('Object Id')
+        else:
+            groups = self._row_groups(object_ids)
+            table = self.parquet.read_row_groups(groups, columns=self._with_id(columns)).to_pandas().set_index('Object Id')
+        if object_ids is not None:
+            table = table[table.index.isin(np.asarray(object_ids))]
+        return table
+
+    def iter_batches(self, columns=None, batch_size:int=None):
+        '''Yield the table in DataFrames of up to batch_size rows (a row group for Parquet by default).'''
+        batch_size = batch_size if batch_size is not None else DeepcellConfig.parquet_row_group_size
+        if self.parquet is None:
+            usecols = None if columns is None else ['Object Id'] + list(columns)
+            for chunk in pd.read_csv(self.path, index_col='Object Id', usecols=usecols, chunksize=batch_size):
+                yield chunk if columns is None else chunk[list(columns)]
+            return
+        for batch in self.parquet.iter_batches(batch_size=batch_size, columns=self._with_id(columns)):
+            yield batch.to_pandas().set_index('Object Id')
+
+    def _with_id(self, columns):
+        return None if columns is None else ['Object Id'] + [c for c in columns if c != 'Object Id']
+
+    def _row_groups(self, object_ids):
+        '''Row groups whose Object Id statistics range holds any of the ids.'''
+        ids = np.unique(np.asarray(object_ids))
+        column = self.parquet.schema_arrow.get_field_index('Object Id')
+        groups = []
+        for i in range(self.parquet.num_row_groups):
+            stats = self.parquet.metadata.row_group(i).column(column).statistics
+            if stats is None or not stats.has_min_max:
+                groups.append(i)
+                continue
+            if np.searchsorted(ids, stats.max, side='right') > np.searchsorted(ids, stats.min, side='left'):
+                groups.append(i)
+        return groups
@@ -3,10 +3,22 @@ import pathlib
 import warnings
 
 from ._helpers._get_files import _get_files
+from ._helpers._cache import _StageCache, _config_fields
+from ._helpers._zarr_store import _channel_reader, _channel_path
+from ._helpers import _tiff_window, _zarr_store
 from .config import DeepcellConfig
+from .detect_tissue import _occupied_tiles, _tissue_inputs
+from .slide import open_slide
+from . import slide
+from .metrics import _measure, _logger
 
 def tile_for_deepcell(folder, name=None):
-    if name is None:
+    if name is None and DeepcellConfig.channels_from_qptiff:
+        for file in _get_files(pathlib.Path('qptiffs', folder), '.*\.qptiff'):
+            sample = file[:-len('.qptiff')]
+            for marker in open_slide(folder, sample).markers:
+                tile_for_deepcell(folder, f'{sample}_{marker}')
+    elif name is None:
         for file in _get_files(pathlib.Path('unstacked', folder), '.*\.tif'):
             tile_for_deepcell(folder, file.rstrip('.tif'))
     else:
@@ -20,22 +32,48 @@ class _TileForDeepcell:
         self.name = name
 
     def process(self):
+        if DeepcellConfig.storage == 'zarr':
+            _logger.info(f'{self.name} is read by window from the zarr store, no tiles are needed')
+            return
         pathlib.Path('tiled_for_deepcell', self.folder, self.name).mkdir(exist_ok=True, parents=True)
-        self._tile(tifffile.imread(
-            pathlib.Path('unstacked', self.folder, f'{self.name}.tif')))
+        # name is <sample>_<marker>, the tissue mask is per sample
+        sample, _, marker = self.name.rpartition('_')
+        infile = _channel_path(self.folder, sample, marker) if sample else pathlib.Path('unstacked', self.folder, f'{self.name}.tif')
+        self.occupied = _occupied_tiles(self.folder, sample)
+        cache = _StageCache(pathlib.Path('tiled_for_deepcell', self.folder, f'.{self.name}.manifest.json'),
+            [infile] + _tissue_inputs(self.folder, sample),
+            _config_fields('tile_width', 'tile_height', 'tile_padding_x', 'tile_padding_y', 'skip_background_tiles'),
+            [__file__, slide.__file__, _tiff_window.__file__, _zarr_store.__file__])
+        if cache.is_fresh():
+            _logger.info(f'{infile} is unchanged, skipping')
+            return
+        with _measure('tile', sample=self.name) as m:
+            if infile.suffix == '.qptiff':
+                # only the windows of each tile are decoded from the qptiff page
+                with _channel_reader(self.folder, sample, marker) as reader:
+                    outputs = self._tile(reader)
+            else:
+                outputs = self._tile(tifffile.imread(infile))
+            m.count('tiles', len(outputs))
+        cache.record(outputs)
     
     def _tile(self, image):
         if image.ndim < 2:
             raise ValueError(f'Image should have ndim>=2, not {image.ndim}')
 
+        outputs = []
         for x in range(0, image.shape[1], DeepcellConfig.tile_width):
             for y in range(0, image.shape[0], DeepcellConfig.tile_height):
                 x0 = max(0, x - DeepcellConfig.tile_padding_x)
                 y0 = max(0, y - DeepcellConfig.tile_padding_y)
                 x1 = min(x + DeepcellConfig.tile_width + DeepcellConfig.tile_padding_x, image.shape[1])
                 y1 = min(y + DeepcellConfig.tile_height + DeepcellConfig.tile_padding_y, image.shape[0])
-                tifffile.imwrite(
-                    pathlib.Path('tiled_for_deepcell', self.folder, self.name,
-                        f'{self.name}_{x0}_{y0}.png'),
-                    image[y0:y1, x0:x1, ...])
+                outfile = pathlib.Path('tiled_for_deepcell', self.folder, self.name, f'{self.name}_{x0}_{y0}.png')
+                if self.occupied is not None and (x, y) not in self.occupied:
+                    # a background tile left from an earlier run would otherwise still be segmented
+                    outfile.unlink(missing_ok=True)
+                    continue
+                tifffile.imwrite(outfile, image[y0:y1, x0:x1])
+                outputs.append(outfile)
+        return outputs
 